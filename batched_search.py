@@ -0,0 +1,161 @@
+# Beam search loop over several source sentences at once, independent of
+# how the decoder steps are computed (Theano functions or plain NumPy)
+import numpy
+
+
+class BatchedSearch(object):
+    """Beam search over several input sentences at once.
+
+    The hypotheses of sentence `s` are the rows ``s * beam_size`` to
+    ``(s + 1) * beam_size - 1`` of the states. Every step computes the
+    next words of all the hypotheses of all the sentences at once, the
+    best `beam_size` continuations are then chosen separately for each
+    sentence.
+
+    Finished hypotheses are handled like in Blocks' `BeamSearch`, they
+    are continued with `eol_symbol` at no cost until all of them are
+    finished. A sentence whose maximum length is reached is frozen the
+    same way, its hypotheses end up truncated to that length.
+
+    Subclasses provide `beam_size`, `compiled` and `compile`, and the
+    decoder steps with the interface of `BeamSearch`:
+    `compute_initial_states_and_contexts`, which returns the states of
+    ``n_sentences * beam_size`` hypotheses, `compute_logprobs` and
+    `compute_next_states`. With a shortlist, `compute_logprobs` is given
+    a `shortlist` keyword argument and returns the costs of those words
+    only.
+
+    """
+    float_dtype = 'float32'
+
+    def prepare_inputs(self, seqs, pad_idx):
+        """Pads sentences into an (input, input_mask) pair of batches."""
+        max_length = max(len(seq) for seq in seqs)
+        input_ = numpy.zeros((len(seqs), max_length), dtype='int64') + pad_idx
+        input_mask = numpy.zeros((len(seqs), max_length),
+                                 dtype=self.float_dtype)
+        for i, seq in enumerate(seqs):
+            input_[i, :len(seq)] = seq
+            input_mask[i, :len(seq)] = 1
+        return input_, input_mask
+
+    def search(self, input_values, eol_symbol, max_lengths,
+               ignore_first_eol=False, shortlist=None):
+        """Performs beam search.
+
+        Parameters
+        ----------
+        input_values : dict
+            The inputs of the encoder, having one row per sentence.
+        eol_symbol : int
+            End of sequence symbol.
+        max_lengths : list of int
+            Maximum length of the output of each sentence.
+        ignore_first_eol : bool
+            If ``True``, the end if sequence symbol generated at the first
+            iteration is ignored.
+        shortlist : numpy.ndarray, optional
+            Sorted words the outputs are restricted to, they have to
+            include `eol_symbol`.
+
+        Returns
+        -------
+        results : list of tuples
+            For each sentence the (outputs, costs) of its hypotheses, as
+            returned by `BeamSearch.search`.
+
+        """
+        if not self.compiled:
+            self.compile()
+
+        beam_size = self.beam_size
+        max_lengths = numpy.asarray(max_lengths)
+        n_sentences = len(max_lengths)
+        offsets = numpy.repeat(numpy.arange(n_sentences) * beam_size,
+                               beam_size)
+
+        # Outputs are chosen among the columns of the log-probabilities,
+        # which are the shortlisted words if there is a shortlist
+        eol_column = eol_symbol
+        logprobs_kwargs = {}
+        if shortlist is not None:
+            shortlist = numpy.asarray(shortlist)
+            eol_column = numpy.searchsorted(shortlist, eol_symbol)
+            if eol_column == len(shortlist) or \
+                    shortlist[eol_column] != eol_symbol:
+                raise ValueError("The shortlist has to contain eol_symbol")
+            logprobs_kwargs['shortlist'] = shortlist
+
+        contexts, states, _ = \
+            self.compute_initial_states_and_contexts(input_values)
+
+        all_outputs = states['outputs'][None, :]
+        all_masks = numpy.ones_like(all_outputs, dtype=self.float_dtype)
+        all_costs = numpy.zeros_like(all_outputs, dtype=self.float_dtype)
+
+        for i in range(max_lengths.max()):
+            # Freeze the sentences that reached their maximum length
+            all_masks[-1][numpy.repeat(max_lengths <= i, beam_size)] = 0
+            if all_masks[-1].sum() == 0:
+                break
+
+            logprobs = self.compute_logprobs(contexts, states,
+                                             **logprobs_kwargs)
+            next_costs = (all_costs[-1, :, None] +
+                          logprobs * all_masks[-1, :, None])
+            (finished,) = numpy.where(all_masks[-1] == 0)
+            next_costs[finished, :eol_column] = numpy.inf
+            next_costs[finished, eol_column + 1:] = numpy.inf
+
+            # At the first step the beam of every sentence is effectively
+            # a single hypothesis
+            vocab_size = next_costs.shape[1]
+            if i == 0:
+                candidates = next_costs[::beam_size]
+            else:
+                candidates = next_costs.reshape(
+                    (n_sentences, beam_size * vocab_size))
+            args = numpy.argpartition(candidates, beam_size - 1,
+                                      axis=1)[:, :beam_size]
+            rows = numpy.arange(n_sentences)[:, None]
+            order = numpy.argsort(candidates[rows, args], axis=1)
+            args = args[rows, order]
+            chosen_costs = candidates[rows, args].flatten()
+            args = args.flatten()
+            indexes = offsets + args // vocab_size
+            outputs = args % vocab_size
+            if shortlist is not None:
+                outputs = shortlist[outputs]
+
+            # Rearrange everything
+            for name in states:
+                states[name] = states[name][indexes]
+            all_outputs = all_outputs[:, indexes]
+            all_masks = all_masks[:, indexes]
+            all_costs = all_costs[:, indexes]
+
+            # Record chosen output and compute new states
+            states.update(self.compute_next_states(contexts, states,
+                                                   outputs))
+            all_outputs = numpy.vstack([all_outputs, outputs[None, :]])
+            all_costs = numpy.vstack([all_costs, chosen_costs[None, :]])
+            mask = outputs != eol_symbol
+            if ignore_first_eol and i == 0:
+                mask[:] = 1
+            all_masks = numpy.vstack([all_masks, mask[None, :]])
+
+        all_outputs = all_outputs[1:]
+        all_masks = all_masks[:-1]
+        all_costs = all_costs[1:] - all_costs[:-1]
+        return [self.result_to_lists(
+                    tuple(array[:, s * beam_size:(s + 1) * beam_size]
+                          for array in (all_outputs, all_masks, all_costs)))
+                for s in range(n_sentences)]
+
+    @staticmethod
+    def result_to_lists(result):
+        outputs, masks, costs = [array.T for array in result]
+        outputs = [list(output[:int(mask.sum())])
+                   for output, mask in zip(outputs, masks)]
+        costs = list(costs.T.sum(axis=0))
+        return outputs, costs
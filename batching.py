@@ -0,0 +1,444 @@
+# Batching transformers for the parallel training streams
+import logging
+from itertools import islice
+
+import numpy
+
+from fuel.transformers import Transformer
+
+logger = logging.getLogger(__name__)
+
+# Source of the dataset offsets of the training batches, see ResumableStream
+DATASET_OFFSET = 'dataset_offset'
+
+
+class RemapWordIdx(object):
+    def __init__(self, mappings):
+        self.mappings = mappings
+
+    def __call__(self, sentence_pair):
+        for mapping in self.mappings:
+            sentence_pair[mapping[0]][numpy.where(
+                sentence_pair[mapping[0]] == mapping[1])] = mapping[2]
+        return sentence_pair
+
+
+class _oov_to_unk(object):
+    def __init__(self, src_vocab_size=30000, trg_vocab_size=30000,
+                 unk_id=1):
+        self.src_vocab_size = src_vocab_size
+        self.trg_vocab_size = trg_vocab_size
+        self.unk_id = unk_id
+
+    def __call__(self, sentence_pair):
+        return ([x if x < self.src_vocab_size else self.unk_id
+                 for x in sentence_pair[0]],
+                [x if x < self.trg_vocab_size else self.unk_id
+                 for x in sentence_pair[1]])
+
+
+class BatchRemapWordIdx(object):
+    """Maps OOV words to UNK and EOS to its index on a padded batch.
+
+    Array-level replacement of the per-example `_oov_to_unk` mapping
+    followed by `RemapWordIdx` on the padded batch, with the same result:
+    indices not smaller than the vocabulary size become `unk_id`, then
+    zeros (the EOS index of the vocabularies, and the padding) become
+    `src_eos_idx` or `trg_eos_idx`. The batch is modified in place.
+
+    """
+    def __init__(self, src_vocab_size=30000, trg_vocab_size=30000,
+                 unk_id=1, src_eos_idx=0, trg_eos_idx=0,
+                 source_idx=0, target_idx=2):
+        self.mappings = [(source_idx, src_vocab_size, src_eos_idx),
+                         (target_idx, trg_vocab_size, trg_eos_idx)]
+        self.unk_id = unk_id
+
+    def __call__(self, batch):
+        for idx, vocab_size, eos_idx in self.mappings:
+            seqs = batch[idx]
+            seqs[seqs >= vocab_size] = self.unk_id
+            seqs[seqs == 0] = eos_idx
+        return batch
+
+
+class SampledTargetVocabulary(object):
+    """Selects the target words of the softmax of a training batch.
+
+    The candidates are the distinct target words of the batch, completed
+    with the most frequent words up to `n_candidates` words, so that the
+    softmax is normalized over a similar number of words in every batch.
+    Returns the sorted candidates and the target batch as positions in
+    them, to be added as sources of padded batches whose words are
+    remapped, see `BatchRemapWordIdx`.
+
+    Parameters
+    ----------
+    n_candidates : int
+        Minimum number of candidate words of a batch.
+    target_idx : int
+        Index of the target sentences in the batch.
+    frequent : array of int, optional
+        Target word indices by decreasing frequency, at least
+        `n_candidates` of them. Defaults to the smallest indices, which
+        assumes the vocabulary is numbered by decreasing frequency, like
+        the WMT15 vocabularies and the ones of synthetic_corpus.py.
+
+    """
+    def __init__(self, n_candidates, target_idx=2, frequent=None):
+        self.n_candidates = n_candidates
+        self.target_idx = target_idx
+        if frequent is None:
+            frequent = numpy.arange(n_candidates)
+        if len(frequent) < n_candidates:
+            raise ValueError("{} frequent words given for {} "
+                             "candidates".format(len(frequent), n_candidates))
+        self.frequent = numpy.asarray(frequent[:n_candidates],
+                                      dtype='int64')
+
+    def __call__(self, batch):
+        target = batch[self.target_idx]
+        words = numpy.unique(target)
+        n_frequent = self.n_candidates - len(words)
+        if n_frequent > 0:
+            frequent = self.frequent[~numpy.in1d(self.frequent, words)]
+            words = numpy.union1d(words, frequent[:n_frequent])
+        return (words.astype('int64'),
+                numpy.searchsorted(words, target).astype('int64'))
+
+
+def _make_batch(examples):
+    return tuple(list(source_data) for source_data in zip(*examples))
+
+
+class SortedGroupBatch(Transformer):
+    """Batches groups of examples sorted by length.
+
+    Reads `batch_size * sort_k_batches` examples at a time, sorts them by
+    `key` and splits them into batches of `batch_size`, like the `Batch`,
+    `SortMapping`, `Unpack` and `Batch` transformers it replaces.
+    `position` is where to resume after the last batch returned: the
+    offset in the dataset of the group and the number of its batches
+    already returned. A resumed epoch reads the group again from there and
+    drops these batches, see :class:`ResumableStream`.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream`
+        Stream of (source, target) examples read from `examples`.
+    examples : :class:`SeekableExamples`
+        The example stream of the dataset.
+    batch_size : int
+        Number of examples of a batch.
+    sort_k_batches : int
+        Number of batches sorted together.
+    key : callable
+        Sort key of an example.
+
+    """
+    def __init__(self, data_stream, examples, batch_size, sort_k_batches,
+                 key, **kwargs):
+        super(SortedGroupBatch, self).__init__(data_stream, **kwargs)
+        self.produces_examples = False
+        self.examples = examples
+        self.batch_size = batch_size
+        self.group_size = batch_size * sort_k_batches
+        self.key = key
+        self.batches = []
+        self.group_offset = 0
+        self.returned = 0
+        self.skip = 0
+
+    @property
+    def position(self):
+        if self.batches:
+            return {'offset': self.group_offset, 'skip': self.returned}
+        return {'offset': self.examples.offset}
+
+    def get_epoch_iterator(self, **kwargs):
+        iterator = super(SortedGroupBatch, self).get_epoch_iterator(**kwargs)
+        self.batches = []
+        resumed = self.examples.resumed
+        self.skip = resumed.get('skip', 0) if resumed else 0
+        return iterator
+
+    def _read_group(self):
+        self.group_offset = self.examples.offset
+        group = list(islice(self.child_epoch_iterator, self.group_size))
+        if not group:
+            raise StopIteration
+        group.sort(key=self.key)
+        # The first group of a resumed epoch drops the batches returned
+        # before the checkpoint
+        self.returned, self.skip = self.skip, 0
+        self.batches = [_make_batch(group[i:i + self.batch_size])
+                        for i in range(self.returned * self.batch_size,
+                                       len(group), self.batch_size)]
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        while not self.batches:
+            self._read_group()
+        self.returned += 1
+        return self.batches.pop(0)
+
+
+class TokenBudgetBatch(Transformer):
+    """Groups sentence pairs into length buckets and batches them by size.
+
+    Every incoming pair is put in the bucket of its (source, target)
+    lengths, a bucket being `bucket_width` tokens wide on each side. A
+    bucket is emitted as a batch as soon as adding another pair would
+    make its padded size, ie. the number of sentences times the longest
+    sentence of either side, exceed `max_tokens`. Batches of short
+    sentences are therefore larger than batches of long ones and contain
+    little padding. Remaining buckets are flushed at the end of an epoch.
+
+    With `examples`, `position` is where to resume after the last batch
+    returned: the offset in the dataset of the first example of every
+    bucket, and the offset `end` of the next example. A resumed epoch reads
+    the dataset again from the first bucket on, and only puts back in the
+    buckets the examples which were in them, so that they are the same as
+    when the position was taken, see :class:`ResumableStream`.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream`
+        Stream of (source, target) examples.
+    max_tokens : int
+        Maximum number of padded tokens of the longer side in a batch.
+    bucket_width : int
+        Width of the length buckets in tokens.
+    examples : :class:`SeekableExamples`, optional
+        The example stream of the dataset, if the batches are resumed.
+
+    """
+    def __init__(self, data_stream, max_tokens, bucket_width=10,
+                 examples=None, **kwargs):
+        super(TokenBudgetBatch, self).__init__(data_stream, **kwargs)
+        self.produces_examples = False
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.examples = examples
+        self.buckets = {}
+        self.starts = {}
+        self.replay = None
+        self.end = None
+
+    @property
+    def position(self):
+        end = self.examples.offset
+        return {'offset': min(self.starts.values() + [end]), 'end': end,
+                'buckets': [list(key) + [start]
+                            for key, start in sorted(self.starts.items())]}
+
+    def get_epoch_iterator(self, **kwargs):
+        self.buckets = {}
+        self.starts = {}
+        iterator = super(TokenBudgetBatch, self).get_epoch_iterator(**kwargs)
+        self.replay = None
+        resumed = self.examples.resumed if self.examples else None
+        if resumed and 'buckets' in resumed:
+            self.replay = {tuple(bucket[:-1]): bucket[-1]
+                           for bucket in resumed['buckets']}
+            self.end = resumed['end']
+        return iterator
+
+    def _replayed(self, key, offset):
+        """Whether a resumed epoch already batched the example."""
+        if offset >= self.end:
+            self.replay = None
+            return False
+        return offset < self.replay.get(key, self.end)
+
+    def _bucket_key(self, example):
+        return tuple(len(sentence) // self.bucket_width
+                     for sentence in example)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        for example in self.child_epoch_iterator:
+            key = self._bucket_key(example)
+            offset = self.examples.last_offset if self.examples else None
+            if self.replay is not None and self._replayed(key, offset):
+                continue
+            bucket = self.buckets.setdefault(key, ([], 0))
+            examples, max_length = bucket
+            new_max_length = max(max_length, max(map(len, example)))
+            if examples and \
+                    (len(examples) + 1) * new_max_length > self.max_tokens:
+                self.buckets[key] = ([example], max(map(len, example)))
+                self.starts[key] = offset
+                return _make_batch(examples)
+            if not examples:
+                self.starts[key] = offset
+            examples.append(example)
+            self.buckets[key] = (examples, new_max_length)
+
+        # Epoch is over, flush the remaining buckets
+        for key in sorted(self.buckets):
+            examples, _ = self.buckets.pop(key)
+            self.starts.pop(key, None)
+            if examples:
+                return _make_batch(examples)
+        raise StopIteration
+
+
+class SeekableExamples(Transformer):
+    """Tracks the offset in the dataset of an example stream and seeks it.
+
+    Wraps the example stream of the training dataset. `offset` is the
+    offset of the next example to be read: its index for a dataset with
+    the `shard_id`, `num_shards`, `start` and `position` attributes of
+    :class:`BinarizedParallelText`, otherwise the number of examples read
+    in the epoch. `last_offset` is the offset of the last example read.
+    After :meth:`seek` the next epoch starts at the offset of the given
+    position, the dataset is reopened there if it has a `start`, otherwise
+    the examples before the offset are read and dropped right here. The
+    position the epoch resumed from is kept as `resumed` for the batching
+    transformer.
+
+    """
+    def __init__(self, data_stream, **kwargs):
+        super(SeekableExamples, self).__init__(data_stream, **kwargs)
+        self.count = 0
+        self.last_offset = None
+        self.positions = None
+        self.resumed = None
+
+    @property
+    def dataset(self):
+        dataset = getattr(self.data_stream, 'dataset', None)
+        return dataset if hasattr(dataset, 'start') else None
+
+    @property
+    def shard_id(self):
+        return getattr(self.dataset, 'shard_id', 0)
+
+    @property
+    def offset(self):
+        if self.dataset is not None:
+            return self.dataset.position
+        return self.count
+
+    def seek(self, positions):
+        """Starts the next epoch at the position of each shard.
+
+        Parameters
+        ----------
+        positions : dict
+            Positions by shard id, dicts with the `offset` to start at and
+            the state of the batching transformer. If the number of shards
+            changed, every shard starts at the smallest offset, without
+            the batching state.
+
+        """
+        self.positions = positions
+
+    def get_epoch_iterator(self, **kwargs):
+        position = None
+        if self.positions:
+            position = self.positions.get(self.shard_id)
+            num_shards = getattr(self.dataset, 'num_shards', 1)
+            if len(self.positions) != num_shards or position is None:
+                position = {'offset': min(
+                    shard['offset'] for shard in self.positions.values())}
+            self.positions = None
+        self.resumed = position
+        offset = position['offset'] if position else None
+        if offset and self.dataset is not None:
+            self.dataset.start = offset
+            self.data_stream.reset()
+            self.dataset.start = None
+        self.count = 0
+        iterator = super(SeekableExamples, self).get_epoch_iterator(**kwargs)
+        if offset and self.dataset is None:
+            for _ in xrange(offset):
+                next(self.child_epoch_iterator)
+            self.count = offset
+        if offset:
+            logger.info("Resuming the epoch at example {} of shard "
+                        "{}".format(self.offset, self.shard_id))
+        return iterator
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        self.last_offset = self.offset
+        data = next(self.child_epoch_iterator)
+        self.count += 1
+        return data
+
+
+class DatasetOffset(object):
+    """Adds the shard id and `position` of a batching transformer to batches.
+
+    To be mapped on the batches as the `dataset_offset` source, in the
+    process reading the dataset, ie. before the prefetching. `batches` is
+    a :class:`SortedGroupBatch` or :class:`TokenBudgetBatch` reading from
+    a :class:`SeekableExamples`.
+
+    """
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __call__(self, batch):
+        return ((self.batches.examples.shard_id, self.batches.position),)
+
+
+class ResumableStream(Transformer):
+    """Keeps track of the position of the training in the dataset.
+
+    Removes the `dataset_offset` source added by :class:`DatasetOffset`
+    from the batches, `offsets` maps the shard ids to the position after
+    the last batch given to the main loop. To resume the training,
+    :meth:`resume_from` makes the :class:`SeekableExamples` of the
+    pipeline start the next epoch at these positions, before any batch is
+    assembled, so that resuming costs the same at any point of an epoch.
+    The batching transformer rebuilds the sort group or the length buckets
+    it had then, so that the resumed epoch neither replays nor skips
+    examples. It should wrap the whole pipeline, including the
+    prefetching.
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream`
+        The training pipeline, with a `dataset_offset` source.
+    examples : :class:`SeekableExamples`
+        The example stream of the dataset in the pipeline.
+
+    """
+    def __init__(self, data_stream, examples, **kwargs):
+        super(ResumableStream, self).__init__(data_stream, **kwargs)
+        self.produces_examples = False
+        self.examples = examples
+        self.offset_idx = data_stream.sources.index(DATASET_OFFSET)
+        self.sources = tuple(source for source in data_stream.sources
+                             if source != DATASET_OFFSET)
+        self.offsets = {}
+
+    def resume_from(self, offsets):
+        # Checkpoints of older versions only have the offsets
+        self.examples.seek({int(shard_id): position
+                            if isinstance(position, dict)
+                            else {'offset': position}
+                            for shard_id, position in offsets.items()})
+
+    def get_epoch_iterator(self, **kwargs):
+        self.offsets = {}
+        iterator = super(ResumableStream, self).get_epoch_iterator(**kwargs)
+        # Data workers started by the iterator have their own copy of the
+        # positions, they only apply to this epoch
+        self.examples.positions = None
+        return iterator
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        data = next(self.child_epoch_iterator)
+        shard_id, position = data[self.offset_idx]
+        self.offsets[shard_id] = position
+        return tuple(value for i, value in enumerate(data)
+                     if i != self.offset_idx)
@@ -0,0 +1,124 @@
+# Beam search decoding several source sentences in a single batch
+import numpy
+from theano import config, tensor
+
+from blocks.filter import VariableFilter
+from blocks.roles import INPUT, OUTPUT
+from blocks.search import BeamSearch
+
+from batched_search import BatchedSearch
+from function_cache import compile_function
+
+
+class BatchedBeamSearch(BatchedSearch, BeamSearch):
+    """Beam search over several input sentences at once.
+
+    Every sentence is encoded once, and the attended representation, its
+    mask and the attention preprocessing of the representation are
+    computed once per sentence as well. Inside the decoder step functions
+    they are broadcast to the hypotheses of the sentence. The search
+    itself is done by :class:`BatchedSearch`.
+
+    The functions compiled here are loaded from `function_cache` if
+    given, Blocks compiles the initial states as usual.
+
+    """
+    attended_name = 'attended'
+    float_dtype = config.floatX
+
+    def __init__(self, beam_size, samples, function_cache=None):
+        super(BatchedBeamSearch, self).__init__(beam_size, samples)
+        self.function_cache = function_cache
+
+    def _function(self, name, inputs, outputs, **kwargs):
+        return compile_function(self.function_cache, 'beam_search_' + name,
+                                inputs, outputs, **kwargs)
+
+    def _compile_context_broadcast(self):
+        attention = self.generator.transition.attention
+        attended = self.contexts[self.context_names.index(self.attended_name)]
+        preprocessed = VariableFilter(
+            applications=[attention.preprocess], roles=[OUTPUT])(
+                self.inner_cg)
+        self.preprocess_computer = self._function(
+            'preprocess', [attended], preprocessed[0])
+
+        # The step functions take the per sentence contexts and gather them
+        # for every hypothesis, instead of the tiled contexts
+        beam_to_sentence = tensor.lvector('beam_to_sentence')
+        sentence_contexts = [context.type(context.name)
+                             for context in self.contexts]
+        sentence_preprocessed = preprocessed[0].type('preprocessed_attended')
+        self.step_inputs = (sentence_contexts +
+                            [sentence_preprocessed, beam_to_sentence])
+        self.step_givens = dict(
+            [(context, sentence_context[:, beam_to_sentence])
+             for context, sentence_context in zip(self.contexts,
+                                                  sentence_contexts)] +
+            [(var, sentence_preprocessed[:, beam_to_sentence])
+             for var in preprocessed])
+
+    def _compile_next_state_computer(self):
+        next_states = [VariableFilter(bricks=[self.generator],
+                                      name=name,
+                                      roles=[OUTPUT])(self.inner_cg)[-1]
+                       for name in self.state_names]
+        next_outputs = VariableFilter(
+            applications=[self.generator.readout.emit], roles=[OUTPUT])(
+                self.inner_cg.variables)
+        self.next_state_computer = self._function(
+            'next_states',
+            self.step_inputs + self.input_states + next_outputs, next_states,
+            givens=self.step_givens, on_unused_input='ignore')
+
+    def _compile_logprobs_computer(self):
+        probs = VariableFilter(
+            applications=[self.generator.readout.emitter.probs],
+            roles=[OUTPUT])(self.inner_cg)[0]
+        logprobs = -tensor.log(probs)
+        self.logprobs_computer = self._function(
+            'logprobs', self.step_inputs + self.input_states, logprobs,
+            givens=self.step_givens, on_unused_input='ignore')
+
+    def _compile_shortlist_logprobs_computer(self):
+        # The output layer restricted to the columns of the shortlist
+        post_merge = self.generator.readout.post_merge
+        softmax, = [brick for brick in post_merge.children
+                    if brick.name == 'softmax1']
+        hidden = VariableFilter(applications=[softmax.apply],
+                                roles=[INPUT])(self.inner_cg)[0]
+        shortlist = tensor.lvector('shortlist')
+        readouts = (tensor.dot(hidden, softmax.W[:, shortlist]) +
+                    softmax.b[shortlist])
+        logprobs = -tensor.log(tensor.nnet.softmax(readouts))
+        self.shortlist_logprobs_computer = self._function(
+            'shortlist_logprobs',
+            self.step_inputs + self.input_states + [shortlist], logprobs,
+            givens=self.step_givens, on_unused_input='ignore')
+
+    def compile(self):
+        self._compile_context_broadcast()
+        super(BatchedBeamSearch, self).compile()
+
+    def compute_logprobs(self, contexts, states, shortlist=None):
+        if shortlist is None:
+            return super(BatchedBeamSearch, self).compute_logprobs(contexts,
+                                                                   states)
+        if not hasattr(self, 'shortlist_logprobs_computer'):
+            self._compile_shortlist_logprobs_computer()
+        input_states = [states[name] for name in self.input_state_names]
+        return self.shortlist_logprobs_computer(
+            *(list(contexts.values()) + input_states + [shortlist]))
+
+    def compute_initial_states_and_contexts(self, inputs):
+        """Encodes every sentence once and expands the states to beams."""
+        contexts, states, n_sentences = super(
+            BatchedBeamSearch, self).compute_initial_states_and_contexts(
+                inputs)
+        contexts['preprocessed_attended'] = \
+            self.preprocess_computer(contexts[self.attended_name])
+        contexts['beam_to_sentence'] = numpy.repeat(
+            numpy.arange(n_sentences), self.beam_size)
+        for name in states:
+            states[name] = numpy.repeat(states[name], self.beam_size, axis=0)
+        return contexts, states, n_sentences * self.beam_size
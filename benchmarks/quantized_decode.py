@@ -0,0 +1,86 @@
+# Memory, speed and BLEU of decoding the validation set with the embeddings
+# and the output layer stored as float32, float16 and int8, see
+# quantization.py. The model is converted to every storage in a temporary
+# directory and decoded with the NumPy engine, which keeps it quantized.
+#
+#   python benchmarks/quantized_decode.py --proto get_config_wmt15_fi_en_40k \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import config
+from bleu import BleuScorer
+from checkpoint import load_param_values, save_npz
+from numpy_model import NumpyTranslator
+from quantization import STORAGE_DTYPES, params_nbytes, quantize_params
+
+
+def run(translator, lines, batch_size, scorer):
+    """Translates `lines`, returns (seconds, BLEU)."""
+    start_time = time.time()
+    translations = translator.translate_lines(lines, batch_size)
+    elapsed = time.time() - start_time
+    scorer.reset()
+    for i, translation in enumerate(translations):
+        scorer.add(i, translation)
+    return elapsed, scorer.score()
+
+
+def main(args):
+    conf = getattr(config, args.proto)()
+    lines = [line.strip() for line in open(conf['val_set'])]
+    if args.sentences:
+        lines = lines[:args.sentences]
+    scorer = BleuScorer(conf['val_set_grndtruth'])
+    batch_size = args.batch_size or conf['val_batch_size']
+    params = load_param_values(args.model)
+
+    print "{} sentences, target vocabulary {}, batch size {}".format(
+        len(lines), conf['trg_vocab_size'], batch_size)
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for dtype in args.dtypes:
+            path = os.path.join(directory, dtype + '.npz')
+            save_npz(path, quantize_params(params, dtype))
+            translator = NumpyTranslator(conf, path,
+                                         beam_size=args.beam_size)
+            memory = params_nbytes(translator.model.params) / 2. ** 20
+            seconds, bleu = run(translator, lines, batch_size, scorer)
+            results[dtype] = memory, bleu
+            print ("{:8}: {:8.1f} MB of parameters, {:8.1f} MB file, "
+                   "{:7.1f} s, BLEU {:6.2f}".format(
+                       dtype, memory, os.path.getsize(path) / 2. ** 20,
+                       seconds, bleu))
+    finally:
+        shutil.rmtree(directory)
+    if 'float32' in results:
+        full_memory, full_bleu = results['float32']
+        for dtype in args.dtypes:
+            if dtype != 'float32':
+                memory, bleu = results[dtype]
+                print "{:8}: {:.1f} MB saved, BLEU difference {:+.2f}".format(
+                    dtype, full_memory - memory, bleu - full_bleu)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Compare decoding with quantized parameters")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config the model was trained with")
+    parser.add_argument("--dtypes", nargs='+', choices=STORAGE_DTYPES,
+                        default=list(STORAGE_DTYPES))
+    parser.add_argument("--beam-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--sentences", type=int, default=0,
+                        help="Only translate the first sentences")
+    main(parser.parse_args())
@@ -0,0 +1,88 @@
+# Micro-benchmark of the OOV-to-UNK and EOS remapping stage of the training
+# stream: per-example _oov_to_unk followed by RemapWordIdx on the padded
+# batch, against the single array-level BatchRemapWordIdx pass.
+#
+#   python benchmarks/remap.py --batch-size 80 --repeats 200
+import argparse
+import os
+import sys
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from batching import BatchRemapWordIdx, RemapWordIdx, _oov_to_unk
+
+
+def _pad(seqs):
+    padded = numpy.zeros((len(seqs), max(map(len, seqs))), dtype='int64')
+    mask = numpy.zeros(padded.shape, dtype='float32')
+    for i, seq in enumerate(seqs):
+        padded[i, :len(seq)] = seq
+        mask[i, :len(seq)] = 1
+    return padded, mask
+
+
+def synthetic_batch(batch_size, seq_len, vocab_size, rng):
+    """Sentence pairs with EOS (0) appended and ~5% out of vocabulary ids."""
+    def sentence():
+        seq = rng.randint(2, int(vocab_size * 1.05),
+                          size=rng.randint(1, seq_len)).tolist()
+        return seq + [0]
+    return ([sentence() for _ in range(batch_size)],
+            [sentence() for _ in range(batch_size)])
+
+
+def old_stage(pairs, oov, remap):
+    pairs = [oov(pair) for pair in zip(*pairs)]
+    source, source_mask = _pad([pair[0] for pair in pairs])
+    target, target_mask = _pad([pair[1] for pair in pairs])
+    return remap([source, source_mask, target, target_mask])
+
+
+def new_stage(pairs, remap):
+    source, source_mask = _pad(pairs[0])
+    target, target_mask = _pad(pairs[1])
+    return remap([source, source_mask, target, target_mask])
+
+
+def main(args):
+    rng = numpy.random.RandomState(1234)
+    pairs = synthetic_batch(args.batch_size, args.seq_len,
+                            args.vocab_size, rng)
+    eos_idx = args.vocab_size - 1
+    oov = _oov_to_unk(args.vocab_size, args.vocab_size, unk_id=1)
+    remap = RemapWordIdx([(0, 0, eos_idx), (2, 0, eos_idx)])
+    batch_remap = BatchRemapWordIdx(args.vocab_size, args.vocab_size,
+                                    unk_id=1, src_eos_idx=eos_idx,
+                                    trg_eos_idx=eos_idx)
+
+    old = old_stage(pairs, oov, remap)
+    new = new_stage(pairs, batch_remap)
+    assert all(numpy.array_equal(o, n) for o, n in zip(old, new))
+
+    # Padding is done by both stages, time it on its own to report the
+    # cost of the remapping alone
+    timings = [
+        ('padding only', lambda: (_pad(pairs[0]), _pad(pairs[1]))),
+        ('_oov_to_unk + RemapWordIdx', lambda: old_stage(pairs, oov, remap)),
+        ('BatchRemapWordIdx', lambda: new_stage(pairs, batch_remap))]
+    results = {}
+    for name, fn in timings:
+        results[name] = min(timeit.repeat(fn, number=args.repeats,
+                                          repeat=3)) / args.repeats
+        print "{:30}: {:8.1f} us/batch".format(name, results[name] * 1e6)
+    padding = results['padding only']
+    print "Remapping speedup (padding excluded): {:.1f}x".format(
+        (results['_oov_to_unk + RemapWordIdx'] - padding) /
+        max(results['BatchRemapWordIdx'] - padding, 1e-9))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=80)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--vocab-size", type=int, default=40001)
+    parser.add_argument("--repeats", type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,76 @@
+# Load generator for serve.py: sends sentences from concurrent clients and
+# reports the latency percentiles and the throughput.
+#
+#   python serve.py --max-batch-size 16 --max-wait-ms 10 model.npz &
+#   python benchmarks/serve_load.py --input newsdev2015.tok.fi \
+#       --concurrency 32 --requests 2000
+import argparse
+import json
+import threading
+import time
+import urllib2
+
+import numpy
+
+
+def _client(url, sentences, results, lock):
+    while True:
+        with lock:
+            if not sentences:
+                return
+            sentence = sentences.pop()
+        start_time = time.time()
+        try:
+            reply = json.loads(urllib2.urlopen(
+                url, json.dumps({'source': sentence})).read())
+            error = False
+        except (urllib2.URLError, ValueError):
+            reply = {}
+            error = True
+        latency = time.time() - start_time
+        with lock:
+            results.append((latency, reply.get('batch_size', 0), error))
+
+
+def run(url, sentences, concurrency):
+    """Sends all the sentences, returns (latencies, batch sizes, errors)."""
+    sentences = list(reversed(sentences))
+    results = []
+    lock = threading.Lock()
+    clients = [threading.Thread(target=_client,
+                                args=(url, sentences, results, lock))
+               for _ in range(concurrency)]
+    start_time = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start_time
+    latencies, batch_sizes, errors = zip(*results)
+    return numpy.asarray(latencies), numpy.asarray(batch_sizes), \
+        sum(errors), elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the latency of the translation server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/translate")
+    parser.add_argument("--input", required=True,
+                        help="Tokenized source sentences, one per line")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="Number of sentences sent, cycling the input")
+    args = parser.parse_args()
+
+    lines = [line.strip() for line in open(args.input) if line.strip()]
+    sentences = [lines[i % len(lines)] for i in range(args.requests)]
+    latencies, batch_sizes, errors, elapsed = run(args.url, sentences,
+                                                  args.concurrency)
+    p50, p95, p99 = numpy.percentile(1000 * latencies, [50, 95, 99])
+    print "Requests: {} ({} errors), concurrency {}".format(
+        len(latencies), errors, args.concurrency)
+    print "Latency: p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+        p50, p95, p99)
+    print "Throughput: {:.2f} sentences/s".format(len(latencies) / elapsed)
+    print "Mean batch size: {:.2f}".format(batch_sizes.mean())
@@ -0,0 +1,99 @@
+# Speed and BLEU of decoding the validation set with and without the
+# vocabulary shortlist of shortlist.py.
+#
+#   python shortlist.py --proto get_config_wmt15_fi_en_40k --prefix lex
+#   python benchmarks/shortlist_decode.py --engine numpy --shortlist lex \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import config
+from bleu import BleuScorer
+from translate import Translator
+from vocab import sentence_to_ids
+
+
+def run(translator, lines, batch_size, use_shortlist, scorer):
+    """Translates `lines`, returns (seconds, BLEU, mean shortlist size)."""
+    sizes = []
+    if use_shortlist:
+        # Shortlists are computed again by the translator, this only
+        # records their sizes
+        order = numpy.argsort([len(line.split()) for line in lines],
+                              kind='mergesort')
+        for start in range(0, len(lines), batch_size):
+            seqs = [sentence_to_ids(lines[i], translator.vocab,
+                                    translator.config['src_vocab_size'],
+                                    translator.unk_idx, translator.eos_idx)
+                    for i in order[start:start + batch_size]]
+            sizes.append(len(translator.shortlist.candidates(
+                seqs, [translator.trg_eos_idx, translator.unk_idx])))
+    start_time = time.time()
+    translations = translator.translate_lines(lines, batch_size,
+                                              use_shortlist=use_shortlist)
+    elapsed = time.time() - start_time
+    scorer.reset()
+    for i, translation in enumerate(translations):
+        scorer.add(i, translation)
+    return elapsed, scorer.score(), numpy.mean(sizes) if sizes else None
+
+
+def main(args):
+    conf = getattr(config, args.proto)()
+    conf['shortlist'] = args.shortlist or conf['shortlist']
+    if not conf['shortlist']:
+        raise ValueError("No lexical table given, see shortlist.py")
+    if args.engine == 'numpy':
+        from numpy_model import NumpyTranslator as translator_class
+    else:
+        translator_class = Translator
+    translator = translator_class(conf, args.model, beam_size=args.beam_size)
+
+    lines = [line.strip() for line in open(conf['val_set'])]
+    if args.sentences:
+        lines = lines[:args.sentences]
+    scorer = BleuScorer(conf['val_set_grndtruth'])
+    batch_size = args.batch_size or conf['val_batch_size']
+
+    # Warm up, eg. compiles the Theano functions
+    translator.translate_lines(lines[:batch_size], batch_size, False)
+    translator.translate_lines(lines[:batch_size], batch_size, True)
+
+    print "{} sentences, target vocabulary {}, batch size {}".format(
+        len(lines), conf['trg_vocab_size'], batch_size)
+    full_time, full_bleu, _ = run(translator, lines, batch_size, False,
+                                  scorer)
+    print "{:10}: {:7.1f} s, BLEU {:6.2f}".format("full", full_time,
+                                                 full_bleu)
+    short_time, short_bleu, size = run(translator, lines, batch_size, True,
+                                       scorer)
+    print ("{:10}: {:7.1f} s, BLEU {:6.2f}, {:.0f} words per "
+           "batch".format("shortlist", short_time, short_bleu, size))
+    print "Speedup: {:.2f}x, BLEU difference {:+.2f}".format(
+        full_time / short_time, short_bleu - full_bleu)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Compare decoding with and without the shortlist")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config the model was trained with")
+    parser.add_argument("--engine", choices=['theano', 'numpy'],
+                        default='numpy')
+    parser.add_argument("--shortlist", default=None,
+                        help="Prefix of the lexical table, defaults to "
+                             "config['shortlist']")
+    parser.add_argument("--beam-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--sentences", type=int, default=0,
+                        help="Only translate the first sentences")
+    main(parser.parse_args())
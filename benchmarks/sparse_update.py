@@ -0,0 +1,99 @@
+# Time per update of the embeddings with the dense GradientDescent against
+# the row-sparse GradientDescent_SubtensorFix of subtensor_gradient.py, for
+# the two lookup tables of model.py (source embeddings and target feedback).
+#
+#   THEANO_FLAGS=device=cpu,floatX=float32 python benchmarks/sparse_update.py \
+#       --vocab-sizes 40001 200001 --step-rule AdaDelta
+import argparse
+import os
+import sys
+import timeit
+
+import numpy
+import theano
+from theano import tensor
+
+from blocks.algorithms import (
+    AdaDelta, Adam, CompositeRule, GradientDescent, Momentum, RMSProp, Scale,
+    StepClipping)
+from blocks.bricks.lookup import LookupTable
+from blocks.graph import ComputationGraph
+from blocks.initialization import IsotropicGaussian
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from subtensor_gradient import (
+    GradientDescent_SubtensorFix, subtensor_params, subtensor_step_rule)
+
+DENSE_STEP_RULES = {'AdaDelta': AdaDelta, 'Adam': Adam, 'Momentum': Momentum,
+                    'RMSProp': RMSProp, 'Scale': Scale}
+
+
+def build_cost(vocab_size, dim):
+    """A cost of the embeddings of a source and a target batch."""
+    source = tensor.lmatrix('source')
+    target = tensor.lmatrix('target')
+    lookups = [LookupTable(vocab_size, dim, name='embeddings',
+                           weights_init=IsotropicGaussian(0.01)),
+               LookupTable(vocab_size, dim, name='lookuptable',
+                           weights_init=IsotropicGaussian(0.01))]
+    for lookup in lookups:
+        lookup.initialize()
+    cost = (tensor.sqr(lookups[0].apply(source)).sum() +
+            tensor.tanh(lookups[1].apply(target)).sum())
+    return cost, lookups
+
+
+def build_algorithm(vocab_size, dim, step_rule, sparse):
+    cost, lookups = build_cost(vocab_size, dim)
+    cg = ComputationGraph(cost)
+    if sparse:
+        params = subtensor_params(cg, lookups)
+        algorithm = GradientDescent_SubtensorFix(
+            subtensor_params=params, cost=cost, params=cg.parameters,
+            step_rule=CompositeRule([
+                StepClipping(10.), subtensor_step_rule(step_rule, params)]))
+    else:
+        algorithm = GradientDescent(
+            cost=cost, params=cg.parameters,
+            step_rule=CompositeRule([StepClipping(10.),
+                                     DENSE_STEP_RULES[step_rule]()]))
+    algorithm.initialize()
+    return algorithm
+
+
+def main(args):
+    rng = numpy.random.RandomState(1234)
+    print "Device {}, floatX {}, {}, batch {}x{}, embeddings {}".format(
+        theano.config.device, theano.config.floatX, args.step_rule,
+        args.batch_size, args.seq_len, args.dim)
+    for vocab_size in args.vocab_sizes:
+        batch = {name: rng.randint(0, vocab_size,
+                                   size=(args.batch_size, args.seq_len))
+                 for name in ('source', 'target')}
+        times = {}
+        for name, sparse in [('dense', False), ('row-sparse', True)]:
+            algorithm = build_algorithm(vocab_size, args.dim,
+                                        args.step_rule, sparse)
+            algorithm.process_batch(batch)
+            times[name] = min(timeit.repeat(
+                lambda: algorithm.process_batch(batch),
+                number=args.repeats, repeat=3)) / args.repeats
+            print "{:7} words {:10}: {:8.2f} ms/update".format(
+                vocab_size, name, times[name] * 1e3)
+        print "{:7} words speedup: {:.1f}x".format(
+            vocab_size, times['dense'] / times['row-sparse'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sparse updates of the lookup tables")
+    parser.add_argument("--vocab-sizes", type=int, nargs='+',
+                        default=[40001, 200001])
+    parser.add_argument("--step-rule", choices=sorted(DENSE_STEP_RULES),
+                        default='AdaDelta')
+    parser.add_argument("--dim", type=int, default=620)
+    parser.add_argument("--batch-size", type=int, default=80)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=10)
+    main(parser.parse_args())
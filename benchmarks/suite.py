@@ -0,0 +1,309 @@
+# Benchmark suite of the model on CPU with synthetic data: the encoder, the
+# training cost and update, a decoder step and the batched beam search of
+# the BleuValidator, and the stream_fi_en data pipeline, with the dimensions of
+# get_config_wmt15_fi_en_TEST or of a scaled up variant.
+#
+#   THEANO_FLAGS=device=cpu,floatX=float32 python benchmarks/suite.py \
+#       --variant test --save baseline.json
+#   THEANO_FLAGS=device=cpu,floatX=float32 python benchmarks/suite.py \
+#       --variant test --baseline baseline.json --threshold 0.1
+#
+# Every component reports the median and 90th percentile latency over the
+# repeats, its throughput in tokens per second and the peak resident memory
+# of the process after it ran. With --baseline the medians are compared to
+# a saved result, the exit status is 1 if any component is slower than
+# (1 + threshold) times its baseline.
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import theano
+from theano import tensor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import config
+import synthetic_corpus
+
+VARIANTS = {
+    'test': {},
+    'scaled': {'enc_nhids': 500, 'dec_nhids': 500, 'enc_embed': 310,
+               'dec_embed': 310, 'src_vocab_size': 10001,
+               'trg_vocab_size': 10001, 'batch_size': 32},
+}
+
+
+def get_config(variant):
+    conf = config.get_config_wmt15_fi_en_TEST()
+    conf.update(VARIANTS[variant])
+    # The TEST prototype does not define them, EOS is the last word
+    conf.setdefault('src_eos_idx', conf['src_vocab_size'] - 1)
+    conf.setdefault('trg_eos_idx', conf['trg_vocab_size'] - 1)
+    return conf
+
+
+def synthetic_batch(batch_size, seq_len, vocab_size, rng):
+    """A padded batch of sentences of random words and lengths."""
+    lengths = rng.randint(seq_len // 2, seq_len + 1, size=batch_size)
+    words = rng.randint(2, vocab_size - 1, size=(batch_size, seq_len))
+    mask = (numpy.arange(seq_len)[None, :] <
+            lengths[:, None]).astype(theano.config.floatX)
+    return words, mask
+
+
+def max_rss_mb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def measure(function, repeats, tokens):
+    """Times `function`, returns its statistics as a dictionary."""
+    function()
+    times = []
+    for _ in range(repeats):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    median = numpy.median(times)
+    return {'latency_ms': 1e3 * median,
+            'latency_p90_ms': 1e3 * numpy.percentile(times, 90),
+            'tokens_per_second': tokens / median,
+            'max_rss_mb': max_rss_mb()}
+
+
+def build_model(conf):
+    """Builds and initializes the bricks and graphs of model.py."""
+    from blocks.algorithms import AdaDelta, CompositeRule, StepClipping
+    from blocks.filter import VariableFilter
+    from blocks.graph import ComputationGraph
+    from blocks.initialization import Constant, IsotropicGaussian, Orthogonal
+    from blocks.model import Model
+    # Imported here, model parses the command line when imported
+    from model import BidirectionalEncoder, Decoder
+    from function_cache import GradientDescentCached
+
+    source = tensor.lmatrix('source')
+    source_mask = tensor.matrix('source_mask')
+    target = tensor.lmatrix('target')
+    target_mask = tensor.matrix('target_mask')
+    encoder = BidirectionalEncoder(conf['src_vocab_size'], conf['enc_embed'],
+                                   conf['enc_nhids'])
+    decoder = Decoder(conf['trg_vocab_size'], conf['dec_embed'],
+                      conf['dec_nhids'], conf['enc_nhids'] * 2)
+    representation = encoder.apply(source, source_mask)
+    cost = decoder.cost(representation, source_mask, target, target_mask)
+
+    encoder.weights_init = decoder.weights_init = IsotropicGaussian(
+        conf['weight_scale'])
+    encoder.biases_init = decoder.biases_init = Constant(0)
+    encoder.push_initialization_config()
+    decoder.push_initialization_config()
+    encoder.bidir.prototype.weights_init = Orthogonal()
+    decoder.transition.weights_init = Orthogonal()
+    encoder.initialize()
+    decoder.initialize()
+
+    cg = ComputationGraph(cost)
+    algorithm = GradientDescentCached(
+        cost=cost, params=cg.parameters,
+        step_rule=CompositeRule([StepClipping(conf['step_clipping']),
+                                 AdaDelta()]))
+
+    sampling_input = tensor.lmatrix('input')
+    sampling_input_mask = tensor.matrix('input_mask')
+    generated = decoder.generate(
+        sampling_input, encoder.apply(sampling_input, sampling_input_mask),
+        sampling_input_mask)
+    samples, = VariableFilter(
+        bricks=[decoder.sequence_generator], name="outputs")(
+            ComputationGraph(generated[1]))
+    return {'encode': theano.function([source, source_mask], representation),
+            'cost': theano.function([source, source_mask, target,
+                                     target_mask], cost),
+            'algorithm': algorithm,
+            'search_model': Model(generated),
+            'samples': samples}
+
+
+def bench_model(conf, repeats, rng):
+    from beam_search import BatchedBeamSearch
+
+    model = build_model(conf)
+    batch_size, seq_len = conf['batch_size'], conf['seq_len']
+    source, source_mask = synthetic_batch(batch_size, seq_len,
+                                          conf['src_vocab_size'], rng)
+    target, target_mask = synthetic_batch(batch_size, seq_len,
+                                          conf['trg_vocab_size'], rng)
+    tokens = source_mask.sum() + target_mask.sum()
+    results = {}
+
+    results['encoder'] = measure(
+        lambda: model['encode'](source, source_mask), repeats,
+        source_mask.sum())
+    results['decoder_cost'] = measure(
+        lambda: model['cost'](source, source_mask, target, target_mask),
+        repeats, tokens)
+
+    start_time = time.time()
+    model['algorithm'].initialize()
+    compile_time = time.time() - start_time
+    batch = {'source': source, 'source_mask': source_mask,
+             'target': target, 'target_mask': target_mask}
+    results['train_step'] = measure(
+        lambda: model['algorithm'].process_batch(batch), repeats, tokens)
+    results['train_step']['compile_seconds'] = compile_time
+
+    # Decodes val_batch_size sentences like the BleuValidator, the random
+    # model decodes up to the maximum length
+    beam_search = BatchedBeamSearch(beam_size=conf['beam_size'],
+                                    samples=model['samples'])
+    inputs = {var.name: var for var in model['search_model'].inputs}
+    words, mask = synthetic_batch(conf['val_batch_size'], seq_len,
+                                  conf['src_vocab_size'], rng)
+    seqs = [list(row[:int(length)]) + [conf['src_eos_idx']]
+            for row, length in zip(words, mask.sum(axis=1))]
+    input_, input_mask = beam_search.prepare_inputs(seqs,
+                                                    conf['src_eos_idx'])
+    input_values = {inputs['input']: input_,
+                    inputs['input_mask']: input_mask}
+
+    # One decoder step of all the hypotheses
+    beam_search.compile()
+    contexts, states, n_hypotheses = \
+        beam_search.compute_initial_states_and_contexts(input_values)
+    outputs = numpy.zeros(n_hypotheses, dtype='int64')
+
+    def step():
+        beam_search.compute_logprobs(contexts, states)
+        beam_search.compute_next_states(contexts, states, outputs)
+    results['decoder_step'] = measure(step, repeats, n_hypotheses)
+
+    def search():
+        beam_search.search(
+            input_values=input_values,
+            max_lengths=[2 * len(seq) for seq in seqs],
+            eol_symbol=conf['trg_eos_idx'], ignore_first_eol=True)
+    results['beam_search'] = measure(search, max(repeats // 5, 1),
+                                     sum(len(seq) for seq in seqs))
+    return results
+
+
+def bench_pipeline(conf, n_batches, rng):
+    """Reads batches from stream_fi_en over a synthetic corpus."""
+    directory = tempfile.mkdtemp()
+    try:
+        conf.update({name: os.path.join(directory, file_name)
+                     for name, file_name in [
+                         ('src_vocab', 'vocab.fi.pkl'),
+                         ('trg_vocab', 'vocab.en.pkl'),
+                         ('src_data', 'train.fi'), ('trg_data', 'train.en'),
+                         ('val_set', 'dev.fi'),
+                         ('val_set_grndtruth', 'dev.en')]})
+        synthetic_corpus.main(conf, n_batches * conf['batch_size'] * 2, 0,
+                              1.25, rng.randint(2 ** 31))
+        conf.update({'binarized_data': None, 'num_data_workers': 0,
+                     'val_set': None, 'sampled_softmax_size': 0})
+        # stream_fi_en is configured by the config of model.py
+        import model
+        model.config.clear()
+        model.config.update(conf)
+        import stream_fi_en
+
+        iterator = stream_fi_en.masked_stream.get_epoch_iterator(
+            as_dict=True)
+        next(iterator)
+        tokens = 0
+        start_time = time.time()
+        for _ in range(n_batches - 1):
+            batch = next(iterator)
+            tokens += batch['source_mask'].sum() + batch['target_mask'].sum()
+        elapsed = time.time() - start_time
+    finally:
+        shutil.rmtree(directory)
+    return {'latency_ms': 1e3 * elapsed / (n_batches - 1),
+            'tokens_per_second': tokens / elapsed,
+            'max_rss_mb': max_rss_mb()}
+
+
+def compare(results, baseline, threshold):
+    """Prints the changes of the latencies, returns the regressions."""
+    regressions = []
+    for name, result in sorted(results['components'].items()):
+        if name not in baseline['components']:
+            continue
+        before = baseline['components'][name]['latency_ms']
+        ratio = result['latency_ms'] / before
+        regressed = ratio > 1 + threshold
+        print "{:14} {:10.2f} ms -> {:10.2f} ms ({:+6.1f}%){}".format(
+            name, before, result['latency_ms'], 100 * (ratio - 1),
+            "  REGRESSION" if regressed else "")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(args):
+    rng = numpy.random.RandomState(args.seed)
+    conf = get_config(args.variant)
+    components = {}
+    if 'model' in args.components:
+        components.update(bench_model(conf, args.repeats, rng))
+    if 'pipeline' in args.components:
+        components['pipeline'] = bench_pipeline(conf, args.batches, rng)
+    results = {
+        'variant': args.variant,
+        'config': {name: conf[name] for name in (
+            'enc_nhids', 'dec_nhids', 'enc_embed', 'dec_embed',
+            'src_vocab_size', 'trg_vocab_size', 'batch_size', 'seq_len',
+            'beam_size', 'val_batch_size')},
+        'environment': {'python': platform.python_version(),
+                        'numpy': numpy.__version__,
+                        'theano': theano.__version__,
+                        'device': theano.config.device,
+                        'floatX': theano.config.floatX,
+                        'machine': platform.machine()},
+        'components': components}
+
+    for name, result in sorted(components.items()):
+        print "{:14} {:10.2f} ms {:12.0f} tokens/s {:8.0f} MB".format(
+            name, result['latency_ms'], result['tokens_per_second'],
+            result['max_rss_mb'])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['variant'] != args.variant:
+            raise ValueError("The baseline is of the {} variant".format(
+                baseline['variant']))
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the model components on synthetic data")
+    parser.add_argument("--variant", choices=sorted(VARIANTS),
+                        default='test')
+    parser.add_argument("--components", nargs='+',
+                        choices=['model', 'pipeline'],
+                        default=['model', 'pipeline'])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--batches", type=int, default=200,
+                        help="Batches read from the data pipeline")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--save", default=None,
+                        help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="Compare to the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown reported as a regression")
+    main(parser.parse_args())
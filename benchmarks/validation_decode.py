@@ -0,0 +1,77 @@
+# Wall time of decoding the validation set like the BleuValidator, one
+# sentence per beam search as before the batched search, and val_batch_size
+# sentences per beam search. Both produce the same translations.
+#
+#   python benchmarks/validation_decode.py --proto get_config_wmt15_fi_en_40k \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import config
+from bleu import BleuScorer
+from translate import Translator
+
+
+def run(translator, lines, batch_size, scorer):
+    """Translates `lines`, returns (seconds, BLEU, translations)."""
+    start_time = time.time()
+    translations = translator.translate_lines(lines, batch_size)
+    elapsed = time.time() - start_time
+    scorer.reset()
+    for i, translation in enumerate(translations):
+        scorer.add(i, translation)
+    return elapsed, scorer.score(), translations
+
+
+def main(args):
+    conf = getattr(config, args.proto)()
+    if args.engine == 'numpy':
+        from numpy_model import NumpyTranslator as translator_class
+    else:
+        translator_class = Translator
+    translator = translator_class(conf, args.model, beam_size=args.beam_size)
+
+    lines = [line.strip() for line in open(conf['val_set'])]
+    if args.sentences:
+        lines = lines[:args.sentences]
+    scorer = BleuScorer(conf['val_set_grndtruth'])
+    batch_size = args.batch_size or conf['val_batch_size']
+
+    # Warm up, eg. compiles the Theano functions
+    translator.translate_lines(lines[:batch_size], batch_size)
+
+    print "{} sentences, beam size {}, {} engine".format(
+        len(lines), translator.beam_size, args.engine)
+    results = {}
+    for size in [1, batch_size]:
+        seconds, bleu, translations = run(translator, lines, size, scorer)
+        results[size] = seconds, translations
+        print "{:3} per beam search: {:8.1f} s, {:6.2f} sentences/s, BLEU " \
+              "{:6.2f}".format(size, seconds, len(lines) / seconds, bleu)
+    different = sum(a != b for a, b in zip(results[1][1],
+                                           results[batch_size][1]))
+    print "Speedup: {:.2f}x, {} different translations".format(
+        results[1][0] / results[batch_size][0], different)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Compare decoding the validation set with and without "
+                    "batching the beam search")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config the model was trained with")
+    parser.add_argument("--engine", choices=['theano', 'numpy'],
+                        default='theano')
+    parser.add_argument("--beam-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Defaults to val_batch_size of the config")
+    parser.add_argument("--sentences", type=int, default=0,
+                        help="Only translate the first sentences")
+    main(parser.parse_args())
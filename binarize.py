@@ -0,0 +1,188 @@
+# Converts a tokenized parallel corpus into flat int32 token arrays plus an
+# offsets index, so that training streams can serve sentence pairs straight
+# from numpy.memmap views instead of re-numberizing the text files every run.
+#
+# For each side (src, trg) two .npy files are written next to `prefix`:
+#   <prefix>.<side>.npy      int32 token ids of all sentences, concatenated
+#   <prefix>.<side>.idx.npy  int64 offsets, sentence i is tokens[o[i]:o[i+1]]
+#
+# Numberization mirrors fuel's TextFile(files, vocab, None), ie. no BOS, an
+# EOS token appended and unknown words mapped to the UNK token id.
+import argparse
+import logging
+import numpy
+import os
+import time
+
+from picklable_itertools import iter_, xrange
+
+from fuel.datasets import Dataset
+
+import config
+from vocab import load_vocabulary
+
+logger = logging.getLogger(__name__)
+
+def binarized_paths(prefix, side):
+    return ('{}.{}.npy'.format(prefix, side),
+            '{}.{}.idx.npy'.format(prefix, side))
+
+
+def binarize_file(text_file, vocab, prefix, side, bos_token=None,
+                  eos_token='</S>', unk_token='<UNK>'):
+    """Numberizes a text file into the flat token/offsets format.
+
+    The file is read twice, once to compute the offsets and once to fill
+    the token array, so that the whole corpus never has to be held in
+    memory as Python lists.
+    """
+    tokens_path, offsets_path = binarized_paths(prefix, side)
+    extra = int(bos_token is not None) + int(eos_token is not None)
+
+    lengths = []
+    with open(text_file) as f:
+        for line in f:
+            lengths.append(len(line.split()) + extra)
+    offsets = numpy.zeros(len(lengths) + 1, dtype='int64')
+    numpy.cumsum(lengths, out=offsets[1:])
+
+    unk_idx = vocab[unk_token]
+    tokens = numpy.lib.format.open_memmap(
+        tokens_path, mode='w+', dtype='int32', shape=(int(offsets[-1]),))
+    with open(text_file) as f:
+        for i, line in enumerate(f):
+            seq = [vocab.get(word, unk_idx) for word in line.split()]
+            if bos_token is not None:
+                seq.insert(0, vocab[bos_token])
+            if eos_token is not None:
+                seq.append(vocab[eos_token])
+            tokens[offsets[i]:offsets[i + 1]] = seq
+            if i != 0 and i % 1000000 == 0:
+                logger.info("Binarized {} lines of {}".format(i, text_file))
+    tokens.flush()
+    del tokens
+    numpy.save(offsets_path, offsets)
+    return len(lengths)
+
+
+def load_binarized(prefix, side):
+    """Returns memory-mapped (tokens, offsets) arrays of one side."""
+    tokens_path, offsets_path = binarized_paths(prefix, side)
+    return (numpy.load(tokens_path, mmap_mode='r'),
+            numpy.load(offsets_path, mmap_mode='r'))
+
+
+class BinarizedParallelText(Dataset):
+    """Serves source/target pairs of a corpus written by this module.
+
+    Behaves like the Merge of two TextFile example streams, both sides
+    being read sequentially, but every example is a slice of a memory
+    mapped token array. Multiple training processes reading the same
+    corpus therefore share the page cache.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix the corpus was binarized to.
+    dictionaries : tuple of dict, optional
+        Source and target vocabularies, only kept around for extensions
+        that need to map indices back to words (eg. Sampler).
+
+    Attributes
+    ----------
+    shard_id, num_shards : int
+        Only every `num_shards`-th pair starting at `shard_id` is read,
+        used by the workers of PrefetchingDataStream.
+    start : int or None
+        Index from which the shard is read when the dataset is opened,
+        used to resume an epoch, see `SeekableExamples`.
+    position : int
+        Index of the next pair of the shard.
+
+    """
+    provides_sources = ('source', 'target')
+    example_iteration_scheme = None
+
+    def __init__(self, prefix, dictionaries=None):
+        self.prefix = prefix
+        self.dictionaries = dictionaries
+        self.shard_id = 0
+        self.num_shards = 1
+        self.start = None
+        self.position = 0
+        self._load()
+        super(BinarizedParallelText, self).__init__()
+
+    def _load(self):
+        self.src_tokens, self.src_offsets = load_binarized(self.prefix, 'src')
+        self.trg_tokens, self.trg_offsets = load_binarized(self.prefix, 'trg')
+        if len(self.src_offsets) != len(self.trg_offsets):
+            raise ValueError("Source and target sides of {} have different "
+                             "number of sentences".format(self.prefix))
+
+    @property
+    def num_examples(self):
+        return int(len(self.src_offsets) - 1)
+
+    def open(self):
+        # First pair of the shard from the start on
+        start = self.start or 0
+        start += (self.shard_id - start) % self.num_shards
+        self.position = start
+        return iter_(xrange(start, self.num_examples, self.num_shards))
+
+    def get_data(self, state=None, request=None):
+        if request is not None:
+            raise ValueError
+        i = next(state)
+        self.position = i + self.num_shards
+        return (self.src_tokens[self.src_offsets[i]:self.src_offsets[i + 1]],
+                self.trg_tokens[self.trg_offsets[i]:self.trg_offsets[i + 1]])
+
+    def __getstate__(self):
+        # Never pickle the memory maps, this would dump the whole corpus
+        state = self.__dict__.copy()
+        for attr in ['src_tokens', 'src_offsets',
+                     'trg_tokens', 'trg_offsets']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+
+def main(config, prefix):
+    # Plain dicts, numberizing a whole corpus is dominated by the lookups
+    src_vocab = dict(load_vocabulary(config['src_vocab']).iteritems())
+    trg_vocab = dict(load_vocabulary(config['trg_vocab']).iteritems())
+
+    prefix_dir = os.path.dirname(prefix)
+    if prefix_dir and not os.path.exists(prefix_dir):
+        os.makedirs(prefix_dir)
+
+    start_time = time.time()
+    n_src = binarize_file(config['src_data'], src_vocab, prefix, 'src')
+    n_trg = binarize_file(config['trg_data'], trg_vocab, prefix, 'trg')
+    if n_src != n_trg:
+        raise ValueError("Source and target files have different number "
+                         "of lines: {} vs {}".format(n_src, n_trg))
+    logger.info("Binarized {} sentence pairs to {} in {:.1f} seconds".format(
+        n_src, prefix, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proto",  default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config to use for config")
+    parser.add_argument("--prefix", default=None,
+                        help="Output prefix, defaults to "
+                             "config['binarized_data']")
+    args = parser.parse_args()
+
+    config = getattr(config, args.proto)()
+    prefix = args.prefix if args.prefix else config['binarized_data']
+    if not prefix:
+        raise ValueError("No output prefix given")
+    main(config, prefix)
@@ -0,0 +1,133 @@
+# Corpus BLEU computed exactly like multi-bleu.perl, without spawning perl
+#
+#   python bleu.py reference.txt < translations.txt
+#
+# prints the same line as `perl multi-bleu.perl reference.txt`.
+from collections import Counter
+import argparse
+import math
+import sys
+
+import numpy
+
+
+def _ngrams(words, n):
+    return Counter(tuple(words[i:i + n]) for i in xrange(len(words) - n + 1))
+
+
+def _my_log(x):
+    # multi-bleu.perl's my_log
+    return math.log(x) if x else -9999999999
+
+
+class BleuScorer(object):
+    """Corpus BLEU with the reference n-gram tables computed once.
+
+    Hypotheses are added one sentence at a time, in any order, and the
+    score of the sentences added so far can be computed at any point.
+    Sentence statistics are kept in an array, adding a sentence again
+    replaces its previous statistics.
+
+    Parameters
+    ----------
+    references : str or list of str
+        File(s) with one reference translation per line.
+    max_n : int
+        Maximum n-gram order.
+
+    """
+    def __init__(self, references, max_n=4):
+        if isinstance(references, basestring):
+            references = [references]
+        self.max_n = max_n
+
+        ref_sentences = zip(*[[line.split() for line in open(reference)]
+                              for reference in references])
+        self.ref_lengths = [[len(words) for words in refs]
+                            for refs in ref_sentences]
+        # Clipping counts are the maximum count over the references
+        self.ref_ngrams = []
+        for refs in ref_sentences:
+            ngrams = Counter()
+            for words in refs:
+                for n in range(1, max_n + 1):
+                    ngrams |= _ngrams(words, n)
+            self.ref_ngrams.append(ngrams)
+
+        # Columns: hypothesis length, closest reference length, then the
+        # correct and total n-gram counts of each order
+        self.stats = numpy.zeros((len(self.ref_ngrams), 2 + 2 * max_n),
+                                 dtype='int64')
+        self.added = numpy.zeros(len(self.ref_ngrams), dtype='bool')
+
+    def __len__(self):
+        return len(self.ref_ngrams)
+
+    def reset(self):
+        self.stats[:] = 0
+        self.added[:] = False
+
+    def add(self, index, hypothesis):
+        """Adds the translation of the `index`-th sentence."""
+        words = hypothesis.split()
+        length = len(words)
+        # Closest reference length, the shorter one on ties
+        closest = min(self.ref_lengths[index],
+                      key=lambda ref_length: (abs(length - ref_length),
+                                              ref_length))
+        stats = [length, closest]
+        ref_ngrams = self.ref_ngrams[index]
+        correct, total = [], []
+        for n in range(1, self.max_n + 1):
+            ngrams = _ngrams(words, n)
+            total.append(sum(ngrams.values()))
+            correct.append(sum(min(count, ref_ngrams[ngram])
+                               for ngram, count in ngrams.iteritems()))
+        self.stats[index] = stats + correct + total
+        self.added[index] = True
+
+    def compute(self):
+        """Returns (bleu, precisions, brevity_penalty, hyp_len, ref_len)."""
+        stats = self.stats[self.added].sum(axis=0)
+        hyp_len, ref_len = stats[0], stats[1]
+        correct = stats[2:2 + self.max_n]
+        total = stats[2 + self.max_n:]
+        precisions = [float(c) / t if t else 0.
+                      for c, t in zip(correct, total)]
+        if ref_len == 0:
+            return 0., precisions, 0., hyp_len, ref_len
+        brevity_penalty = 1.
+        if hyp_len < ref_len:
+            brevity_penalty = math.exp(1 - float(ref_len) / hyp_len) \
+                if hyp_len else 0.
+        bleu = brevity_penalty * math.exp(
+            sum(_my_log(p) for p in precisions) / self.max_n)
+        return bleu, precisions, brevity_penalty, hyp_len, ref_len
+
+    def score(self):
+        """Returns the BLEU score as printed by multi-bleu.perl."""
+        return float('{:.2f}'.format(100 * self.compute()[0]))
+
+    def __str__(self):
+        bleu, precisions, brevity_penalty, hyp_len, ref_len = self.compute()
+        if ref_len == 0:
+            return "BLEU = 0, 0/0/0/0 (BP=0, ratio=0, hyp_len=0, ref_len=0)"
+        return ("BLEU = {:.2f}, {} (BP={:.3f}, ratio={:.3f}, hyp_len={}, "
+                "ref_len={})".format(
+                    100 * bleu,
+                    '/'.join('{:.1f}'.format(100 * p) for p in precisions),
+                    brevity_penalty, float(hyp_len) / ref_len, hyp_len,
+                    ref_len))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Corpus BLEU of the translations read from stdin")
+    parser.add_argument("references", nargs='+',
+                        help="Reference file(s), one sentence per line")
+    args = parser.parse_args()
+
+    scorer = BleuScorer(args.references)
+    for i, line in enumerate(sys.stdin):
+        scorer.add(i, line)
+    print scorer
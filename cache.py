@@ -0,0 +1,92 @@
+# LRU cache of translations, keyed by the source index sequence and a
+# fingerprint of the model that translated it
+from collections import OrderedDict
+import cPickle
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def param_fingerprint(params):
+    """Returns a hash of a {name: value} dict of parameter values."""
+    md5 = hashlib.md5()
+    for name in sorted(params):
+        value = params[name]
+        md5.update(name)
+        md5.update(str(value.dtype) + str(value.shape))
+        md5.update(value.tostring())
+    return md5.hexdigest()
+
+
+class TranslationCache(object):
+    """A size-bounded LRU cache of translations.
+
+    Keys are the source sentences as sequences of indices, eg. from
+    :func:`vocab.sentence_to_ids`, together with a fingerprint of the
+    model and the decoding settings, so that translations of a model are
+    never returned for another one.
+
+    Parameters
+    ----------
+    max_size : int
+        Number of translations kept, the least recently used ones are
+        evicted first.
+    path : str, optional
+        File the cache is loaded from if it exists, and saved to by
+        :meth:`save`.
+
+    """
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.entries = cPickle.load(f)
+            self._evict()
+            logger.info("Loaded {} cached translations from {}".format(
+                len(self.entries), path))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, fingerprint, seq):
+        return fingerprint, tuple(int(idx) for idx in seq)
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, fingerprint, seq):
+        """Returns the cached translation of `seq` or None."""
+        key = self._key(fingerprint, seq)
+        translation = self.entries.pop(key, None)
+        if translation is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = translation
+        return translation
+
+    def put(self, fingerprint, seq, translation):
+        key = self._key(fingerprint, seq)
+        self.entries.pop(key, None)
+        self.entries[key] = translation
+        self._evict()
+
+    def get_stats(self):
+        return {'cache_size': len(self.entries), 'cache_hits': self.hits,
+                'cache_misses': self.misses}
+
+    def save(self, path=None):
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(self.entries, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        logger.info("Saved {} cached translations to {}".format(
+            len(self.entries), path))
@@ -0,0 +1,266 @@
+# Reading and writing the parameters saved by the training script
+#
+# Training checkpoints are directories of one .npy file per value, plus a
+# manifest listing the files of the last complete checkpoint:
+#
+#   <path>/manifest.json
+#   <path>/<name>.<version>.npy
+#
+# Files are written in a background thread under new names and the
+# manifest is atomically replaced once all of them are written, so that a
+# crash during a save leaves the previous checkpoint intact. Values that
+# did not change since the previous save keep their file.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+import numpy
+
+from quantization import dequantize_params, quantized_params
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+def load_param_values(path, dequantize=True):
+    """Loads the parameter values of an .npz file saved by `numpy.savez`.
+
+    The keys are the Blocks parameter names as returned by
+    `Model.get_param_values`, numpy drops their leading slash when
+    saving, which is restored here. Parameters stored with reduced
+    precision by quantization.py are converted back to float32, or
+    returned as :class:`QuantizedMatrix` if `dequantize` is ``False``.
+
+    """
+    params = numpy.load(path)
+    params = {('/' + name if not name.startswith('/') else name): params[name]
+              for name in params.files}
+    if dequantize:
+        return dequantize_params(params)
+    return quantized_params(params)
+
+
+def save_npz(path, values):
+    """Saves arrays with `numpy.savez` through a temporary file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        numpy.savez(f, **values)
+    os.rename(tmp_path, path)
+
+
+def _atomic_write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def _digest(value):
+    md5 = hashlib.md5(numpy.ascontiguousarray(value))
+    md5.update(str(value.dtype) + str(value.shape))
+    return md5.hexdigest()
+
+
+class BackgroundWriter(object):
+    """Runs one write at a time in a background thread.
+
+    :meth:`submit` waits for the previous write to finish before starting
+    the next one. Exceptions of a write are raised by the next call to
+    :meth:`submit` or :meth:`wait`. The thread is not a daemon, so that
+    the interpreter finishes the write before exiting.
+
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def _run(self, function, args):
+        try:
+            function(*args)
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def wait(self):
+        """Waits for the current write and raises its error if any."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise IOError("Background write failed:\n{}".format(error))
+
+    def submit(self, function, *args):
+        self.wait()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(function, args))
+        self.thread.start()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['thread'] = None
+        return state
+
+
+class CheckpointWriter(BackgroundWriter):
+    """Writes checkpoints of arrays and byte strings in the background.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint, created if needed.
+    incremental : bool
+        If ``True``, arrays equal to their value in the previous
+        checkpoint written by this writer are not written again.
+
+    """
+    def __init__(self, path, incremental=True):
+        super(CheckpointWriter, self).__init__()
+        self.path = path
+        self.incremental = incremental
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        manifest = _load_manifest(path)
+        self.version = manifest['version'] if manifest else 0
+        # Digests and files of the arrays of the previous checkpoint
+        self.saved = {}
+
+    def save(self, values, metadata, blobs=None):
+        """Writes a checkpoint in the background.
+
+        Parameters
+        ----------
+        values : dict
+            Arrays by name. They must not be modified afterwards, eg. they
+            are copies of the values of shared variables.
+        metadata : dict
+            JSON serializable description of the checkpoint.
+        blobs : dict, optional
+            Byte strings by name, eg. pickled objects.
+
+        """
+        self.submit(self._write, values, metadata, blobs or {})
+
+    def _write(self, values, metadata, blobs):
+        start_time = time.time()
+        self.version += 1
+        arrays, saved = {}, {}
+        n_written = 0
+        for name, value in values.items():
+            digest = _digest(value) if self.incremental else None
+            if digest is not None and self.saved.get(name, (None,))[0] == \
+                    digest:
+                arrays[name] = self.saved[name][1]
+            else:
+                arrays[name] = self._file_name(name, 'npy')
+                numpy.save(os.path.join(self.path, arrays[name]), value)
+                n_written += 1
+            saved[name] = (digest, arrays[name])
+        blob_files = {}
+        for name, data in blobs.items():
+            blob_files[name] = self._file_name(name, 'pkl')
+            with open(os.path.join(self.path, blob_files[name]), 'wb') as f:
+                f.write(data)
+
+        # The checkpoint is complete once the manifest is replaced
+        _atomic_write(os.path.join(self.path, MANIFEST), json.dumps(
+            {'version': self.version, 'metadata': metadata,
+             'arrays': arrays, 'blobs': blob_files}, indent=1))
+        self.saved = saved
+        files = set(arrays.values()) | set(blob_files.values())
+        for file_name in os.listdir(self.path):
+            if file_name != MANIFEST and file_name not in files:
+                os.remove(os.path.join(self.path, file_name))
+        logger.info("Checkpoint {} written to {} in {:.1f} seconds, {} of {} "
+                    "arrays changed".format(self.version, self.path,
+                                            time.time() - start_time,
+                                            n_written, len(values)))
+
+    def _file_name(self, name, extension):
+        return '{}.{}.{}'.format(name.strip('/').replace('/', '-'),
+                                 self.version, extension)
+
+
+def _load_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def load_checkpoint(path, mmap_mode=None):
+    """Loads the last complete checkpoint of a directory.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint.
+    mmap_mode : str, optional
+        Memory-maps the arrays with this mode, see `numpy.load`, so that
+        only the pages actually read are loaded.
+
+    Returns
+    -------
+    checkpoint : tuple or None
+        The (values, blobs, metadata) given to :meth:`CheckpointWriter.save`,
+        or ``None`` if there is no checkpoint.
+
+    """
+    manifest = _load_manifest(path)
+    if manifest is None:
+        return None
+    values = {name: numpy.load(os.path.join(path, file_name),
+                               mmap_mode=mmap_mode)
+              for name, file_name in manifest['arrays'].items()}
+    blobs = {}
+    for name, file_name in manifest['blobs'].items():
+        with open(os.path.join(path, file_name), 'rb') as f:
+            blobs[name] = f.read()
+    return values, blobs, manifest['metadata']
+
+
+def check_checkpoint(path, shapes, prefix='/'):
+    """Checks the arrays of a checkpoint against the expected shapes.
+
+    Only the headers of the files are read, so that a checkpoint which
+    does not match the model fails before the training functions are
+    compiled.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint.
+    shapes : dict
+        Expected shapes by name, eg. of the parameters of the model.
+    prefix : str
+        Only the arrays whose names start with `prefix` are checked.
+
+    Raises
+    ------
+    ValueError
+        If arrays are missing, unexpected or have other shapes.
+
+    """
+    manifest = _load_manifest(path)
+    if manifest is None:
+        raise ValueError("No checkpoint in {}".format(path))
+    saved = {name: numpy.load(os.path.join(path, file_name),
+                              mmap_mode='r').shape
+             for name, file_name in manifest['arrays'].items()
+             if name.startswith(prefix)}
+    errors = ["missing {}".format(name)
+              for name in sorted(set(shapes) - set(saved))]
+    errors += ["unexpected {}".format(name)
+               for name in sorted(set(saved) - set(shapes))]
+    errors += ["{} has shape {} instead of {}".format(
+                   name, saved[name], tuple(shapes[name]))
+               for name in sorted(set(saved) & set(shapes))
+               if saved[name] != tuple(shapes[name])]
+    if errors:
+        raise ValueError("The checkpoint in {} does not match the model: "
+                         "{}".format(path, ', '.join(errors)))
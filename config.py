@@ -21,10 +21,17 @@ def get_config_wmt15_fi_en_40k():
     config['enc_embed'] = 620
     config['dec_embed'] = 620
     config['saveto'] = 'refBlocks3'
+    # Directory of compiled functions, eg. 'compiled', relative to saveto,
+    # shared if absolute, None disables the cache. Needs Theano 0.8
+    config['function_cache'] = None
 
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
+    config['max_tokens_per_batch'] = None  # None for fixed batch_size
+    config['bucket_width'] = 10
+    config['num_data_workers'] = 1  # 0 builds batches in the main process
+    config['prefetch_batches'] = 10
     config['step_rule'] = 'AdaDelta'
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
@@ -41,26 +48,40 @@ def get_config_wmt15_fi_en_40k():
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
     config['trg_data'] = basedir + 'all.tok.clean.shuf.fi-en.en'
+    config['binarized_data'] = None  # prefix written by binarize.py
     config['src_vocab_size'] = 40001
     config['trg_vocab_size'] = 40001
     config['unk_id'] = 1
     config['src_eos_idx'] = 40000
     config['trg_eos_idx'] = 40000
+    # Target words in the softmax of each training batch, 0 for all of them.
+    # The batch words are completed with the smallest indices, which have
+    # to be the most frequent words, as in vocabularies sorted by frequency
+    config['sampled_softmax_size'] = 0
 
     # Early stopping based on bleu related
     config['normalized_bleu'] = True
-    config['bleu_script'] = '/data/lisatmp3/firatorh/turkishParallelCorpora/iwslt14/scripts/multi-bleu.perl'
     config['val_set'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015_1.tok.seg.fi'
     config['val_set_grndtruth'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015_1.tok.en'
     config['val_set_out'] = 'refBlocks3/adadelta_40k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['val_batch_size'] = 16  # sentences decoded per beam search
+    config['val_async'] = False  # decode in a background process
+    config['val_device'] = 'cpu'  # Theano device of the background process
+    config['model_storage'] = 'float32'  # or float16, int8 for best models
+    config['shortlist'] = None  # prefix written by shortlist.py
+    config['shortlist_frequent'] = 2000
+    config['shortlist_translations'] = 10
 
     # Timing related
     config['reload'] = True
     config['save_freq'] = 50
+    config['checkpoint_incremental'] = True  # only save changed values
     config['sampling_freq'] = 1
     config['bleu_val_freq'] = 2000
+    config['profile_freq'] = 100  # stage time percentiles in the log
+    config['throughput_freq'] = 100  # batches per throughput channel
     config['val_burn_in'] = 50000
 
     # Monitoring related
@@ -80,10 +101,17 @@ def get_config_wmt15_fi_en_TEST():
     config['enc_embed'] = 62
     config['dec_embed'] = 62
     config['saveto'] = 'refBlocks3_TEST'
+    # Directory of compiled functions, eg. 'compiled', relative to saveto,
+    # shared if absolute, None disables the cache. Needs Theano 0.8
+    config['function_cache'] = None
 
     # Optimization related
     config['batch_size'] = 8
     config['sort_k_batches'] = 12
+    config['max_tokens_per_batch'] = None  # None for fixed batch_size
+    config['bucket_width'] = 10
+    config['num_data_workers'] = 1  # 0 builds batches in the main process
+    config['prefetch_batches'] = 10
     config['step_rule'] = 'AdaDelta'
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
@@ -100,24 +128,38 @@ def get_config_wmt15_fi_en_TEST():
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
     config['trg_data'] = basedir + 'all.tok.clean.shuf.fi-en.en'
+    config['binarized_data'] = None  # prefix written by binarize.py
     config['src_vocab_size'] = 501
     config['trg_vocab_size'] = 501
     config['unk_id'] = 1
+    # Target words in the softmax of each training batch, 0 for all of them.
+    # The batch words are completed with the smallest indices, which have
+    # to be the most frequent words, as in vocabularies sorted by frequency
+    config['sampled_softmax_size'] = 0
 
     # Early stopping based on bleu related
     config['normalized_bleu'] = True
-    config['bleu_script'] = '/data/lisatmp3/firatorh/turkishParallelCorpora/iwslt14/scripts/multi-bleu.perl'
     config['val_set'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015_TEST.tok.seg.fi'
     config['val_set_grndtruth'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015_TEST.tok.en'
     config['val_set_out'] = 'refBlocks3_TEST/validation_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 2
+    config['val_batch_size'] = 16  # sentences decoded per beam search
+    config['val_async'] = False  # decode in a background process
+    config['val_device'] = 'cpu'  # Theano device of the background process
+    config['model_storage'] = 'float32'  # or float16, int8 for best models
+    config['shortlist'] = None  # prefix written by shortlist.py
+    config['shortlist_frequent'] = 2000
+    config['shortlist_translations'] = 10
 
     # Timing related
     config['reload'] = True
     config['save_freq'] = 1
+    config['checkpoint_incremental'] = True  # only save changed values
     config['sampling_freq'] = 5
     config['bleu_val_freq'] = 10
+    config['profile_freq'] = 100  # stage time percentiles in the log
+    config['throughput_freq'] = 100  # batches per throughput channel
     config['val_burn_in'] = 0
 
     # Monitoring related
@@ -137,10 +179,17 @@ def get_config_wmt15_fi_en_40k_refMultiCG():
     config['enc_embed'] = 620
     config['dec_embed'] = 620
     config['saveto'] = 'refMultiCG'
+    # Directory of compiled functions, eg. 'compiled', relative to saveto,
+    # shared if absolute, None disables the cache. Needs Theano 0.8
+    config['function_cache'] = None
 
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
+    config['max_tokens_per_batch'] = None  # None for fixed batch_size
+    config['bucket_width'] = 10
+    config['num_data_workers'] = 1  # 0 builds batches in the main process
+    config['prefetch_batches'] = 10
     config['step_rule'] = 'AdaDelta'
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
@@ -157,26 +206,40 @@ def get_config_wmt15_fi_en_40k_refMultiCG():
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
     config['trg_data'] = basedir + 'all.tok.clean.shuf.fi-en.en'
+    config['binarized_data'] = None  # prefix written by binarize.py
     config['src_vocab_size'] = 40001
     config['trg_vocab_size'] = 40001
     config['unk_id'] = 1
     config['src_eos_idx'] = 40000
     config['trg_eos_idx'] = 40000
+    # Target words in the softmax of each training batch, 0 for all of them.
+    # The batch words are completed with the smallest indices, which have
+    # to be the most frequent words, as in vocabularies sorted by frequency
+    config['sampled_softmax_size'] = 0
 
     # Early stopping based on bleu related
     config['normalized_bleu'] = True
-    config['bleu_script'] = '/data/lisatmp3/firatorh/turkishParallelCorpora/iwslt14/scripts/multi-bleu.perl'
     config['val_set'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015.tok.seg.fi'
     config['val_set_grndtruth'] = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/dev/newsdev2015.tok.en'
     config['val_set_out'] = config['saveto'] + '/adadelta_40k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['val_batch_size'] = 16  # sentences decoded per beam search
+    config['val_async'] = False  # decode in a background process
+    config['val_device'] = 'cpu'  # Theano device of the background process
+    config['model_storage'] = 'float32'  # or float16, int8 for best models
+    config['shortlist'] = None  # prefix written by shortlist.py
+    config['shortlist_frequent'] = 2000
+    config['shortlist_translations'] = 10
 
     # Timing related
     config['reload'] = True
     config['save_freq'] = 1000
+    config['checkpoint_incremental'] = True  # only save changed values
     config['sampling_freq'] = 13
     config['bleu_val_freq'] = 5000
+    config['profile_freq'] = 100  # stage time percentiles in the log
+    config['throughput_freq'] = 100  # batches per throughput channel
     config['val_burn_in'] = 20000
 
     # Monitoring related
@@ -195,10 +258,17 @@ def get_config_wmt15_de_en_51k_refMultiCG():
     config['enc_embed'] = 620
     config['dec_embed'] = 620
     config['saveto'] = 'refMultiCG_DEEN'
+    # Directory of compiled functions, eg. 'compiled', relative to saveto,
+    # shared if absolute, None disables the cache. Needs Theano 0.8
+    config['function_cache'] = None
 
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
+    config['max_tokens_per_batch'] = None  # None for fixed batch_size
+    config['bucket_width'] = 10
+    config['num_data_workers'] = 1  # 0 builds batches in the main process
+    config['prefetch_batches'] = 10
     config['step_rule'] = 'AdaDelta'
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
@@ -216,29 +286,124 @@ def get_config_wmt15_de_en_51k_refMultiCG():
     config['trg_vocab'] = basedir + 'joint_vocab.sub.en.52k.pkl'
     config['src_data'] = basedir + 'de2en/all.tok.clean.shuf.split.de-en.de'
     config['trg_data'] = basedir + 'de2en/all.tok.clean.shuf.de-en.en'
+    config['binarized_data'] = None  # prefix written by binarize.py
     config['src_vocab_size'] = 200000
     config['trg_vocab_size'] = 51546
     config['unk_id'] = 1
     config['src_eos_idx'] = 0
     config['trg_eos_idx'] = 0
+    # Target words in the softmax of each training batch, 0 for all of them.
+    # The batch words are completed with the smallest indices, which have
+    # to be the most frequent words, as in vocabularies sorted by frequency
+    config['sampled_softmax_size'] = 0
 
     # Early stopping based on bleu related
     config['normalized_bleu'] = True
-    config['bleu_script'] = '/data/lisatmp3/firatorh/turkishParallelCorpora/iwslt14/scripts/multi-bleu.perl'
     config['val_set'] = '/data/lisatmp3/jeasebas/nmt/data/wmt15/full/dev/tok/newstest2013.tok.de'
     config['val_set_grndtruth'] = '/data/lisatmp3/jeasebas/nmt/data/wmt15/full/dev/tok/newstest2013.tok.en'
     config['val_set_out'] = config['saveto'] + '/adadelta_51k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['val_batch_size'] = 16  # sentences decoded per beam search
+    config['val_async'] = False  # decode in a background process
+    config['val_device'] = 'cpu'  # Theano device of the background process
+    config['model_storage'] = 'float32'  # or float16, int8 for best models
+    config['shortlist'] = None  # prefix written by shortlist.py
+    config['shortlist_frequent'] = 2000
+    config['shortlist_translations'] = 10
 
     # Timing related
     config['reload'] = True
     config['save_freq'] = 1000
+    config['checkpoint_incremental'] = True  # only save changed values
     config['sampling_freq'] = 17
     config['bleu_val_freq'] = 5000
+    config['profile_freq'] = 100  # stage time percentiles in the log
+    config['throughput_freq'] = 100  # batches per throughput channel
     config['val_burn_in'] = 60000
 
     # Monitoring related
     config['hook_samples'] = 2
 
     return config
+
+
+def get_config_synthetic_fi_en():
+    # The 40k model on the corpus written by synthetic_corpus.py
+    config = {}
+
+    # Model related
+    config['seq_len'] = 50
+    config['enc_nhids'] = 1000
+    config['dec_nhids'] = 1000
+    config['enc_embed'] = 620
+    config['dec_embed'] = 620
+    config['saveto'] = 'refSynthetic'
+    # Directory of compiled functions, eg. 'compiled', relative to saveto,
+    # shared if absolute, None disables the cache. Needs Theano 0.8
+    config['function_cache'] = None
+
+    # Optimization related
+    config['batch_size'] = 80
+    config['sort_k_batches'] = 12
+    config['max_tokens_per_batch'] = None  # None for fixed batch_size
+    config['bucket_width'] = 10
+    config['num_data_workers'] = 1  # 0 builds batches in the main process
+    config['prefetch_batches'] = 10
+    config['step_rule'] = 'AdaDelta'
+    config['step_clipping'] = 10
+    config['weight_scale'] = 0.01
+
+    # Regularization related
+    config['weight_noise_ff'] = 0.01
+    config['weight_noise_rec'] = False
+    config['dropout'] = 0.5
+
+    # Vocabulary/dataset related
+    basedir = 'synthetic/'
+    config['stream'] = 'stream_fi_en'
+    config['src_vocab'] = basedir + 'vocab.fi.pkl'
+    config['trg_vocab'] = basedir + 'vocab.en.pkl'
+    config['src_data'] = basedir + 'train.fi'
+    config['trg_data'] = basedir + 'train.en'
+    config['binarized_data'] = None  # prefix written by binarize.py
+    config['src_vocab_size'] = 40001
+    config['trg_vocab_size'] = 40001
+    config['unk_id'] = 1
+    config['src_eos_idx'] = 40000
+    config['trg_eos_idx'] = 40000
+    # Target words in the softmax of each training batch, 0 for all of them.
+    # The batch words are completed with the smallest indices, which have
+    # to be the most frequent words, as in vocabularies sorted by frequency
+    config['sampled_softmax_size'] = 0
+
+    # Early stopping based on bleu related
+    config['normalized_bleu'] = True
+    config['val_set'] = basedir + 'dev.fi'
+    config['val_set_grndtruth'] = basedir + 'dev.en'
+    config['val_set_out'] = 'refSynthetic/adadelta_40k_out.txt'
+    config['output_val_set'] = True
+    config['beam_size'] = 20
+    config['val_batch_size'] = 16  # sentences decoded per beam search
+    config['val_async'] = False  # decode in a background process
+    config['val_device'] = 'cpu'  # Theano device of the background process
+    config['model_storage'] = 'float32'  # or float16, int8 for best models
+    config['shortlist'] = None  # prefix written by shortlist.py
+    config['shortlist_frequent'] = 2000
+    config['shortlist_translations'] = 10
+
+    # Timing related
+    config['reload'] = True
+    config['save_freq'] = 50
+    config['checkpoint_incremental'] = True  # only save changed values
+    config['sampling_freq'] = 1
+    config['bleu_val_freq'] = 2000
+    config['profile_freq'] = 100  # stage time percentiles in the log
+    config['throughput_freq'] = 100  # batches per throughput channel
+    config['val_burn_in'] = 50000
+
+    # Monitoring related
+    config['hook_samples'] = 1
+
+    #return ReadOnlyDict(config)
+    return config
@@ -0,0 +1,242 @@
+# Persistent cache of the compiled Theano functions
+#
+# Compiling the training function of the model takes minutes, mostly in the
+# graph optimizations. A FunctionCache pickles the compiled functions to
+#
+#   <path>/<name>.<key>.pkl
+#
+# where the key is a hash of the model dimensions of the config, of the
+# graph and of the library versions, so that a relaunch or another job with
+# the same architecture and the same cache directory loads them instead.
+# The C code of the ops is not pickled, it is found in the Theano compiledir.
+#
+# The shared variables of the functions are replaced by small placeholders
+# in the pickles, which therefore do not hold the parameters, and by the
+# shared variables of the current graph when the functions are loaded. This
+# needs `Function.copy(swap=...)`, ie. Theano 0.8 or later. A function which
+# can not be loaded or saved is an error rather than silently compiled, a
+# stale file has to be removed.
+import cPickle
+import hashlib
+import inspect
+import logging
+import os
+import sys
+import time
+
+import numpy
+import theano
+from theano.compile.pfunc import rebuild_collect_shared
+
+from blocks.algorithms import GradientDescent
+
+logger = logging.getLogger(__name__)
+
+# Entries of the config which change the compiled functions
+MODEL_KEYS = ['src_vocab_size', 'trg_vocab_size', 'enc_embed', 'dec_embed',
+              'enc_nhids', 'dec_nhids', 'step_rule', 'step_clipping',
+              'dropout', 'weight_noise_ff', 'sampled_softmax_size']
+
+
+def library_versions():
+    """Versions of the libraries and settings the compilation depends on.
+
+    The settings are all the Theano flags, whether they come from
+    THEANO_FLAGS, .theanorc or the defaults.
+
+    """
+    import blocks
+    return [sys.version, numpy.__version__, theano.__version__,
+            getattr(blocks, '__version__', None), str(theano.config)]
+
+
+def check_theano():
+    """Raises if the Theano functions can not be cached."""
+    copy = getattr(theano.compile.function_module.Function, 'copy', None)
+    if copy is None or 'swap' not in inspect.getargspec(copy).args:
+        raise RuntimeError("Caching compiled functions needs "
+                           "Function.copy(swap=...), Theano {} does not "
+                           "have it, set config['function_cache'] to "
+                           "None".format(theano.__version__))
+
+
+def _graph_description(inputs, outputs, updates, givens):
+    def debugprint(variables):
+        return theano.printing.debugprint(variables, file='str',
+                                          print_type=True)
+    description = [str((variable.name, variable.type)) for variable in inputs]
+    variables = list(outputs)
+    for variable, value in updates:
+        variables.extend([variable, value])
+    if variables:
+        description.append(debugprint(variables))
+    # The order of a dictionary of givens differs between processes
+    description.extend(sorted(debugprint([variable, value])
+                              for variable, value in givens.items()))
+    return description
+
+
+def _shared_inputs(inputs, outputs, updates, givens):
+    """The shared variables of a function, in the order of `theano.function`.
+
+    This is the order in which `pfunc` adds them to the inputs of the
+    function, it only depends on the graph.
+
+    """
+    _, _, (_, _, _, shared) = rebuild_collect_shared(
+        outputs, inputs=inputs, replace=givens, updates=updates,
+        rebuild_strict=True, copy_inputs_over=True)
+    return shared
+
+
+def _implicit_inputs(function):
+    return [input_.variable for input_ in function.maker.inputs
+            if input_.implicit]
+
+
+def _placeholder(variable):
+    """A shared variable of the same type with a small value."""
+    value = variable.get_value(borrow=True)
+    if not hasattr(value, 'ndim'):
+        # Eg. random states, which are pickled as they are
+        return variable
+    placeholder = theano.shared(
+        numpy.zeros((1,) * value.ndim, dtype=value.dtype),
+        name=variable.name, broadcastable=variable.broadcastable)
+    return placeholder if placeholder.type == variable.type else variable
+
+
+class FunctionCache(object):
+    """Compiles Theano functions or loads them from a directory.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the compiled functions, created if needed.
+    config : dict
+        Configuration of the model, the entries of `MODEL_KEYS` are part
+        of the keys.
+
+    """
+    def __init__(self, path, config):
+        check_theano()
+        self.path = path
+        self.model_config = [(name, config.get(name)) for name in MODEL_KEYS]
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, inputs, outputs, updates=(), givens=None):
+        """Returns the key of a function as a hex digest."""
+        md5 = hashlib.md5()
+        for item in ([name, repr(self.model_config)] + library_versions() +
+                     _graph_description(inputs, outputs, updates,
+                                        givens or {})):
+            md5.update(str(item))
+        return md5.hexdigest()
+
+    def function(self, name, inputs, outputs, updates=None, givens=None,
+                 **kwargs):
+        """Returns a compiled function, see `theano.function`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the function in the cache, the key is added to it.
+
+        """
+        updates = list(updates.items() if hasattr(updates, 'items')
+                       else updates or [])
+        givens = givens or {}
+        start_time = time.time()
+        path = os.path.join(self.path, '{}.{}.pkl'.format(
+            name, self.key(name, inputs, outputs, updates, givens)))
+        if os.path.isfile(path):
+            try:
+                function = self._load(path, _shared_inputs(
+                    inputs, outputs, updates, givens))
+            except Exception:
+                logger.error("Failed to load the compiled function {} from "
+                             "{}, remove the file to compile it "
+                             "again".format(name, path))
+                raise
+            self.hits += 1
+            logger.info("Loaded the compiled function {} from the cache in "
+                        "{:.1f} seconds".format(name,
+                                                time.time() - start_time))
+            return function
+
+        self.misses += 1
+        function = theano.function(inputs, outputs, updates=updates,
+                                   givens=givens, **kwargs)
+        logger.info("Compiled the function {} in {:.1f} seconds".format(
+            name, time.time() - start_time))
+        self._save(path, function)
+        return function
+
+    def _load(self, path, shared):
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(path, 'rb') as f:
+                function = cPickle.load(f)
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+        placeholders = _implicit_inputs(function)
+        if len(placeholders) != len(shared) or any(
+                placeholder.type != variable.type
+                for placeholder, variable in zip(placeholders, shared)):
+            raise ValueError("The shared variables of the compiled function "
+                             "do not match the graph")
+        return function.copy(swap=dict(zip(placeholders, shared)))
+
+    def _save(self, path, function):
+        swap = {}
+        for variable in _implicit_inputs(function):
+            placeholder = _placeholder(variable)
+            if placeholder is not variable:
+                swap[variable] = placeholder
+        # Jobs sharing the directory may write the same function at once
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(function.copy(swap=swap), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def get_stats(self):
+        return "{} functions loaded, {} compiled".format(self.hits,
+                                                        self.misses)
+
+
+def compile_function(function_cache, name, inputs, outputs, **kwargs):
+    """Compiles through `function_cache` unless it is ``None``."""
+    if function_cache is None:
+        return theano.function(inputs, outputs, **kwargs)
+    return function_cache.function(name, inputs, outputs, **kwargs)
+
+
+class GradientDescentCached(GradientDescent):
+    """Gradient descent compiling its update through a :class:`FunctionCache`.
+
+    Parameters
+    ----------
+    function_cache : :class:`FunctionCache`, optional
+        The function is compiled as usual if not given.
+
+    """
+    def __init__(self, function_cache=None, **kwargs):
+        super(GradientDescentCached, self).__init__(**kwargs)
+        self.function_cache = function_cache
+
+    def initialize(self):
+        logger.info("Initializing the training algorithm")
+        all_updates = self.updates
+        # Same order as GradientDescent, for reproducibility
+        for param in self.params:
+            all_updates.append((param, param - self.steps[param]))
+        all_updates += self.step_rule_updates
+        self._function = compile_function(self.function_cache, 'train',
+                                          self.inputs, [],
+                                          updates=all_updates)
+        logger.info("The training algorithm is initialized")
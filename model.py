@@ -3,13 +3,16 @@ from collections import Counter
 import argparse
 import importlib
 import logging
+import os
 import pprint
+import time
 from theano import tensor
 from toolz import merge
 from picklable_itertools.extras import equizip
 
-from blocks.algorithms import (GradientDescent, StepClipping, AdaDelta,
-                               CompositeRule, RemoveNotFinite)
+from blocks.algorithms import (StepClipping, AdaDelta, Adam,
+                               CompositeRule, Momentum, RemoveNotFinite,
+                               RMSProp, Scale)
 from blocks.dump import MainLoopDumpManager
 from blocks.filter import VariableFilter
 from blocks.main_loop import MainLoop
@@ -18,7 +21,7 @@ from blocks.graph import ComputationGraph, apply_noise, apply_dropout
 from blocks.initialization import IsotropicGaussian, Orthogonal, Constant
 from blocks.extensions import Printing
 from blocks.extensions.monitoring import TrainingDataMonitoring
-from blocks.extensions.saveload import LoadFromDump, Dump
+from blocks.extensions.saveload import LoadFromDump
 from blocks.extensions.plot import Plot
 
 from blocks.bricks import (Tanh, Maxout, Linear, FeedforwardSequence,
@@ -36,7 +39,11 @@ from blocks.bricks.sequence_generators import (
 
 import config
 
+from checkpoint import MANIFEST, check_checkpoint
+from function_cache import FunctionCache, GradientDescentCached
+from monitoring import DataWaitTime, StepProfiler, Throughput
 from sampling import BleuValidator, Sampler
+from saveload import Checkpoint, LoadCheckpoint
 
 logger = logging.getLogger(__name__)
 
@@ -46,7 +53,8 @@ parser.add_argument("--proto",  default="get_config_wmt15_fi_en_40k",
                     help="Prototype config to use for config")
 parser.add_argument("--subtensor-fix",  action='store_true',
                     help="Speed up training by fixing Theano issue #2219")
-args = parser.parse_args()
+# Unknown arguments are left to the scripts importing the bricks from here
+args, _ = parser.parse_known_args()
 
 # Make config global, nasty workaround since parameterizing stream
 # will cause erroneous picklable behaviour, find a better solution
@@ -252,16 +260,78 @@ class Decoder(Initializable):
 
         return (cost * target_sentence_mask).sum() / target_sentence_mask.shape[1]
 
+    @application(inputs=['representation', 'source_sentence_mask',
+                         'target_sentence_mask', 'target_sentence',
+                         'target_candidates', 'target_candidate_indices'],
+                 outputs=['cost'])
+    def sampled_cost(self, representation, source_sentence_mask,
+                     target_sentence, target_sentence_mask,
+                     target_candidates, target_candidate_indices):
+        """Cost with the softmax over a subset of the target vocabulary.
+
+        The softmax of every step is normalized over `target_candidates`
+        only, and only their columns of the output layer are computed, as
+        in the importance sampling of Jean et al. (2015) with a uniform
+        proposal over the candidates, for which the correction of the
+        logits vanishes. `target_candidate_indices` are the target words
+        as positions in `target_candidates`, see `SampledTargetVocabulary`.
+
+        """
+        source_sentence_mask = source_sentence_mask.T
+        target_sentence = target_sentence.T
+        target_sentence_mask = target_sentence_mask.T
+        target_candidate_indices = target_candidate_indices.T
+
+        # Same recurrence as SequenceGenerator.cost_matrix
+        generator = self.sequence_generator
+        readout = generator.readout
+        feedback = readout.feedback(target_sentence)
+        results = generator.transition.apply(
+            mask=target_sentence_mask, return_initial_states=True,
+            as_dict=True, attended=representation,
+            attended_mask=source_sentence_mask,
+            **generator.fork.apply(feedback, as_dict=True))
+        states = {name: results[name][:-1] for name in generator._state_names}
+        glimpses = {name: results[name][1:]
+                    for name in generator._glimpse_names}
+        feedback = tensor.roll(feedback, 1, 0)
+        feedback = tensor.set_subtensor(
+            feedback[0],
+            readout.feedback(readout.initial_outputs(
+                target_sentence.shape[1])))
+        sources = merge(states, glimpses, {'feedback': feedback})
+        merged = readout.merge.apply(
+            **{name: sources[name] for name in readout.merge.input_names})
+
+        # The output layer restricted to the columns of the candidates
+        post_merge = readout.post_merge.application_methods
+        for apply_ in post_merge[:-1]:
+            merged = apply_(merged)
+        softmax = post_merge[-1].brick
+        readouts = (tensor.dot(merged, softmax.W[:, target_candidates]) +
+                    softmax.b[target_candidates])
+        readouts = readouts.reshape((-1, readouts.shape[-1]))
+        readouts -= readouts.max(axis=1, keepdims=True)
+        logprobs = readouts - tensor.log(
+            tensor.exp(readouts).sum(axis=1, keepdims=True))
+        indices = target_candidate_indices.flatten()
+        cost = -logprobs[tensor.arange(indices.shape[0]), indices]
+        cost = cost.reshape(target_sentence.shape)
+
+        return (cost * target_sentence_mask).sum() / target_sentence_mask.shape[1]
+
     @application
-    def generate(self, source_sentence, representation):
+    def generate(self, source_sentence, representation,
+                 source_sentence_mask):
         return self.sequence_generator.generate(
             n_steps=2 * source_sentence.shape[1],
             batch_size=source_sentence.shape[0],
             attended=representation,
-            attended_mask=tensor.ones(source_sentence.shape).T)
+            attended_mask=source_sentence_mask.T)
 
 
 def main(config, tr_stream, dev_stream):
+    start_time = time.time()
 
     # Create Theano variables
     source_sentence = tensor.lmatrix('source')
@@ -269,14 +339,25 @@ def main(config, tr_stream, dev_stream):
     target_sentence = tensor.lmatrix('target')
     target_sentence_mask = tensor.matrix('target_mask')
     sampling_input = tensor.lmatrix('input')
+    sampling_input_mask = tensor.matrix('input_mask')
 
     # Construct model
     encoder = BidirectionalEncoder(config['src_vocab_size'], config['enc_embed'],
                                    config['enc_nhids'])
     decoder = Decoder(config['trg_vocab_size'], config['dec_embed'],
                       config['dec_nhids'], config['enc_nhids'] * 2)
-    cost = decoder.cost(encoder.apply(source_sentence, source_sentence_mask),
-                        source_sentence_mask, target_sentence, target_sentence_mask)
+    representation = encoder.apply(source_sentence, source_sentence_mask)
+    if config['sampled_softmax_size']:
+        # The softmax is over the target words selected in the stream
+        target_candidates = tensor.lvector('target_candidates')
+        target_candidate_indices = tensor.lmatrix('target_candidate_indices')
+        cost = decoder.sampled_cost(representation, source_sentence_mask,
+                                    target_sentence, target_sentence_mask,
+                                    target_candidates,
+                                    target_candidate_indices)
+    else:
+        cost = decoder.cost(representation, source_sentence_mask,
+                            target_sentence, target_sentence_mask)
 
     # Initialize model
     encoder.weights_init = decoder.weights_init = IsotropicGaussian(config['weight_scale'])
@@ -324,20 +405,36 @@ def main(config, tr_stream, dev_stream):
         logger.info('    {:15}: {}'.format(value.get_value().shape, name))
     logger.info("Total number of parameters: {}".format(len(enc_dec_param_dict)))
 
+    # Check the checkpoint to resume from before compiling anything
+    checkpoint_path = os.path.join(config['saveto'], 'checkpoint')
+    resume = config['reload'] and os.path.isfile(
+        os.path.join(checkpoint_path, MANIFEST))
+    if resume:
+        check_checkpoint(checkpoint_path,
+                         {name: param.get_value(borrow=True).shape
+                          for name, param in enc_dec_param_dict.iteritems()})
+
+    # Compiled functions are reused by relaunches with the same architecture
+    function_cache = None
+    if config['function_cache']:
+        function_cache = FunctionCache(
+            os.path.join(config['saveto'], config['function_cache']), config)
+
     # Set up training algorithm
     if args.subtensor_fix:
-        assert config['step_rule'] == 'AdaDelta'
-        from subtensor_gradient import GradientDescent_SubtensorFix, AdaDelta_SubtensorFix, subtensor_params
+        from subtensor_gradient import GradientDescent_SubtensorFix, subtensor_params, subtensor_step_rule
         lookups = subtensor_params(cg, [encoder.lookup, decoder.sequence_generator.readout.feedback_brick.lookup])
         algorithm = GradientDescent_SubtensorFix(
             subtensor_params=lookups,
             cost=cost, params=cg.parameters,
             step_rule=CompositeRule([StepClipping(config['step_clipping']),
                                      RemoveNotFinite(0.9),
-                                     AdaDelta_SubtensorFix(subtensor_params=lookups)])
+                                     subtensor_step_rule(config['step_rule'], lookups)]),
+            function_cache=function_cache
         )
     else:
-        algorithm = GradientDescent(
+        algorithm = GradientDescentCached(
+            function_cache=function_cache,
             cost=cost, params=cg.parameters,
             step_rule=CompositeRule([StepClipping(config['step_clipping']),
                                      RemoveNotFinite(0.9),
@@ -345,9 +442,11 @@ def main(config, tr_stream, dev_stream):
         )
 
     # Set up beam search and sampling computation graphs
+    # The mask lets the validation decode padded batches of sentences
     sampling_representation = encoder.apply(
-        sampling_input, tensor.ones(sampling_input.shape))
-    generated = decoder.generate(sampling_input, sampling_representation)
+        sampling_input, sampling_input_mask)
+    generated = decoder.generate(sampling_input, sampling_representation,
+                                 sampling_input_mask)
     search_model = Model(generated)
     samples, = VariableFilter(
         bricks=[decoder.sequence_generator], name="outputs")(
@@ -362,23 +461,38 @@ def main(config, tr_stream, dev_stream):
             model=search_model, config=config, data_stream=tr_stream,
             src_eos_idx=config['src_eos_idx'],
             trg_eos_idx=config['trg_eos_idx'],
+            function_cache=function_cache,
             every_n_batches=config['sampling_freq']),
         BleuValidator(
-            sampling_input, samples=samples, config=config,
+            sampling_input, source_sentence_mask=sampling_input_mask,
+            samples=samples, config=config,
             model=search_model, data_stream=dev_stream,
             src_eos_idx=config['src_eos_idx'],
             trg_eos_idx=config['trg_eos_idx'],
+            function_cache=function_cache,
             every_n_batches=config['bleu_val_freq']),
         TrainingDataMonitoring([cost], after_batch=True),
+        Throughput(n_batches=config['throughput_freq']),
+        StepProfiler(os.path.join(config['saveto'], 'profile.jsonl'),
+                     every_n_batches=config['profile_freq']),
         #Plot('En-Fr', channels=[['decoder_cost_cost']],
         #     after_batch=True),
         Printing(after_batch=True),
-        Dump(config['saveto'], every_n_batches=config['save_freq'])
+        Checkpoint(checkpoint_path,
+                   incremental=config['checkpoint_incremental'],
+                   every_n_batches=config['save_freq']),
+        # Keep last, measures the time spent fetching the next batch
+        DataWaitTime()
     ]
 
-    # Reload model if necessary
+    # Reload model if necessary, from a dump of older versions if there is
+    # no checkpoint, before DataWaitTime which has to stay last
     if config['reload']:
-        extensions += [LoadFromDumpWMT15(config['saveto'])]
+        if resume:
+            extensions.insert(-1, LoadCheckpoint(checkpoint_path,
+                                                 start_time=start_time))
+        else:
+            extensions.insert(-1, LoadFromDumpWMT15(config['saveto']))
 
     # Initialize main loop
     main_loop = MainLoop(
@@ -390,6 +504,8 @@ def main(config, tr_stream, dev_stream):
 
     # Train!
     main_loop.run()
+    if function_cache is not None:
+        logger.info("Function cache: {}".format(function_cache.get_stats()))
 
 
 if __name__ == "__main__":
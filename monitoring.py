@@ -0,0 +1,249 @@
+# Extensions reporting how the training data pipeline keeps up with the
+# updates, values are written to the log so that Printing and Plot pick
+# them up like any other channel.
+from collections import deque
+import json
+import os
+import time
+
+import numpy
+
+from blocks.extensions import SimpleExtension
+
+
+class DataWaitTime(SimpleExtension):
+    """Logs the time spent fetching each batch as `data_wait_time`.
+
+    The time is measured between the end of this extension's `after_batch`
+    call and its next `before_batch` call, which is exactly the time the
+    main loop spends in `next(epoch_iterator)`. It should therefore be the
+    last extension in the list, otherwise the time spent in the extensions
+    following it is accounted as well.
+
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('before_batch', True)
+        kwargs.setdefault('after_batch', True)
+        super(DataWaitTime, self).__init__(**kwargs)
+        self.last_batch_end = None
+        self.wait_time = None
+
+    def do(self, which_callback, *args):
+        if which_callback == 'before_batch':
+            if self.last_batch_end is not None:
+                self.wait_time = time.time() - self.last_batch_end
+        elif which_callback == 'after_batch':
+            if self.wait_time is not None:
+                self.main_loop.log.current_row['data_wait_time'] = \
+                    self.wait_time
+            self.last_batch_end = time.time()
+
+
+class Throughput(SimpleExtension):
+    """Logs the tokens per second and the padding of the masked sources.
+
+    The batches are summed over `n_batches` iterations, after which the
+    channels of every source `x` with a `x_mask` are written to the log:
+
+    * `x_tokens_per_second`, the real tokens, ie. ones in the mask,
+    * `x_padded_tokens_per_second`, the size of the padded batches,
+    * `x_padding_ratio`, the fraction of padding, ie. zeros in the mask,
+    * `x_max_length_mean`, `x_max_length_p50`, `x_max_length_p90` and
+      `x_max_length_max`, the distribution of the padded lengths.
+
+    and `batches_per_second`. Times include everything the main loop
+    does, the first batch is not counted since it includes the
+    compilation of the training function.
+
+    Parameters
+    ----------
+    sources : tuple of str
+        The masked sources.
+    n_batches : int
+        Number of batches the channels are computed over.
+
+    """
+    def __init__(self, sources=('source', 'target'), n_batches=100,
+                 **kwargs):
+        kwargs.setdefault('after_batch', True)
+        super(Throughput, self).__init__(**kwargs)
+        self.sources = sources
+        self.n_batches = n_batches
+        self.start_time = None
+        self._reset()
+
+    def _reset(self):
+        self.batches = 0
+        self.tokens = dict.fromkeys(self.sources, 0)
+        self.padded_tokens = dict.fromkeys(self.sources, 0)
+        self.max_lengths = {source: [] for source in self.sources}
+
+    def do(self, which_callback, *args):
+        if self.start_time is None:
+            self.start_time = time.time()
+            return
+        batch = args[0]
+        self.batches += 1
+        for source in self.sources:
+            mask = batch[source + '_mask']
+            self.tokens[source] += int(mask.sum())
+            self.padded_tokens[source] += mask.size
+            self.max_lengths[source].append(mask.shape[1])
+        if self.batches < self.n_batches:
+            return
+
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        current_row = self.main_loop.log.current_row
+        current_row['batches_per_second'] = self.batches / elapsed
+        for source in self.sources:
+            current_row[source + '_tokens_per_second'] = \
+                self.tokens[source] / elapsed
+            current_row[source + '_padded_tokens_per_second'] = \
+                self.padded_tokens[source] / elapsed
+            current_row[source + '_padding_ratio'] = \
+                1. - self.tokens[source] / float(self.padded_tokens[source])
+            lengths = numpy.asarray(self.max_lengths[source])
+            current_row[source + '_max_length_mean'] = lengths.mean()
+            p50, p90 = numpy.percentile(lengths, [50, 90])
+            current_row[source + '_max_length_p50'] = p50
+            current_row[source + '_max_length_p90'] = p90
+            current_row[source + '_max_length_max'] = lengths.max()
+        self.start_time = time.time()
+        self._reset()
+
+
+class StepProfiler(SimpleExtension):
+    """Times the stages of every iteration and writes them to a trace.
+
+    An iteration is timed from the start of its update to the start of
+    the next one, and split into the stages
+
+    * `update`, the `process_batch` call of the algorithm,
+    * one stage per extension, named after it, eg. `Sampler`,
+      `BleuValidator` or `Checkpoint`, which is the time spent in all its
+      callbacks during the iteration,
+    * `data`, the rest, which is mostly the main loop fetching the next
+      batch from the data stream.
+
+    Each iteration is appended to the JSON-lines file `path` with its
+    stages and the number of tokens of every source `x` with a `x_mask`
+    in its batch, the tokens per second are logged by
+    :class:`Throughput`.
+    Every time the extension is called after a batch, the percentiles of
+    the stages over the last `window` iterations are written to the log
+    as `profile_<stage>_p<percentile>`.
+
+    The callbacks of the other extensions and `process_batch` are
+    wrapped in `before_training` and restored after training, also when
+    it is interrupted or fails. The trace is written line by line, so
+    that it is complete up to a crash.
+
+    Parameters
+    ----------
+    path : str
+        The JSON-lines trace, appended to.
+    window : int
+        Number of iterations of the rolling statistics.
+    percentiles : tuple of int
+        Percentiles of the stage times written to the log.
+
+    """
+    def __init__(self, path, window=1000, percentiles=(50, 90, 99),
+                 **kwargs):
+        kwargs.setdefault('before_training', True)
+        kwargs.setdefault('after_training', True)
+        kwargs.setdefault('on_interrupt', True)
+        kwargs.setdefault('on_error', True)
+        super(StepProfiler, self).__init__(**kwargs)
+        self.path = path
+        self.window = window
+        self.percentiles = percentiles
+        self.trace = None
+        self.iteration_start = None
+        self.iteration = None
+        self.current = {}
+        self.tokens = {}
+        self.stage_times = {}
+
+    def _timed(self, function, stage):
+        def timed(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.current[stage] = (self.current.get(stage, 0.) +
+                                       time.time() - start_time)
+        return timed
+
+    def _process_batch(self, batch):
+        self._finish_iteration(time.time())
+        self.iteration_start = time.time()
+        self.iteration = self.main_loop.status['iterations_done'] + 1
+        self.current = {}
+        self.tokens = {source[:-len('_mask')]: int(mask.sum())
+                       for source, mask in batch.items()
+                       if source.endswith('_mask')}
+        self._update(batch)
+
+    def _finish_iteration(self, end_time):
+        if self.iteration_start is None:
+            return
+        total = end_time - self.iteration_start
+        stages = dict(self.current)
+        stages['data'] = max(total - sum(stages.values()), 0.)
+        for stage in self.stage_times:
+            self.stage_times[stage].append(stages.get(stage, 0.))
+        self.trace.write(json.dumps(
+            {'iteration': self.iteration, 'time': round(total, 6),
+             'stages': {stage: round(value, 6)
+                        for stage, value in stages.items() if value},
+             'tokens': self.tokens},
+            sort_keys=True, separators=(',', ':')) + '\n')
+        self.iteration_start = None
+
+    def _start(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Line buffered
+        self.trace = open(self.path, 'a', 1)
+        algorithm = self.main_loop.algorithm
+        self._update = self._timed(algorithm.process_batch, 'update')
+        algorithm.process_batch = self._process_batch
+        self.stage_times['update'] = deque(maxlen=self.window)
+        self.stage_times['data'] = deque(maxlen=self.window)
+        for extension in self.main_loop.extensions:
+            if extension is not self:
+                extension.dispatch = self._timed(extension.dispatch,
+                                                 extension.name)
+                self.stage_times[extension.name] = deque(maxlen=self.window)
+
+    def _stop(self):
+        if self.trace is None:
+            return
+        self._finish_iteration(time.time())
+        if 'process_batch' in self.main_loop.algorithm.__dict__:
+            del self.main_loop.algorithm.process_batch
+        for extension in self.main_loop.extensions:
+            if 'dispatch' in extension.__dict__:
+                del extension.dispatch
+        self.trace.close()
+        self.trace = None
+
+    def do(self, which_callback, *args):
+        if which_callback == 'before_training':
+            self._start()
+            return
+        if which_callback in ('after_training', 'on_interrupt', 'on_error'):
+            self._stop()
+            return
+
+        if not self.stage_times.get('data'):
+            return
+        current_row = self.main_loop.log.current_row
+        for stage, times in self.stage_times.items():
+            for percentile, value in zip(
+                    self.percentiles,
+                    numpy.percentile(list(times), self.percentiles)):
+                current_row['profile_{}_p{}'.format(
+                    stage.lower(), percentile)] = value
@@ -0,0 +1,252 @@
+# The RNNsearch model of model.py implemented with NumPy only, for decoding
+# on the CPU without compiling the Theano graph
+#
+# Parameters are read by their Blocks names, as saved by the BleuValidator,
+# eg. /bidirectionalencoder/bidirectionalwmt15/forward.state_to_state. The
+# beam search is the one of batched_search.py, so that the translations are
+# the same as those of the Theano sampling graph up to rounding.
+import numpy
+
+from batched_search import BatchedSearch
+from quantization import QuantizedMatrix
+from translate import Translator
+
+ENCODER = '/bidirectionalencoder'
+GENERATOR = '/decoder/sequencegenerator'
+TRANSITION = GENERATOR + '/att_trans'
+ATTENTION = TRANSITION + '/attention'
+READOUT = GENERATOR + '/readout'
+POST_MERGE = READOUT + '/initializablefeedforwardsequence'
+
+# Sequences of the GatedRecurrent transitions, computed by the forks
+GRU_INPUTS = ('inputs', 'update_inputs', 'reset_inputs')
+
+
+def _sigmoid(x):
+    return 0.5 * (1 + numpy.tanh(0.5 * x))
+
+
+def _dot(x, weights):
+    if isinstance(weights, QuantizedMatrix):
+        return weights.rdot(x)
+    return x.dot(weights)
+
+
+class NumpyRNNsearch(object):
+    """The bidirectional encoder and the decoder steps of the RNNsearch.
+
+    Computes the same functions as `BidirectionalEncoder` and the
+    `Decoder` sequence generator: GRUs with update and reset gates, the
+    `SequenceContentAttention` with its preprocessed attended, the
+    `GRUInitialState` and the maxout readout. The time is the first axis
+    of every sequence, like in Blocks.
+
+    Parameters
+    ----------
+    params : dict
+        Parameter values by Blocks names, eg. from
+        :func:`checkpoint.load_param_values`. The embeddings and the
+        output layer can be :class:`QuantizedMatrix`.
+
+    """
+    def __init__(self, params):
+        self.params = params
+
+    def _linear(self, x, brick):
+        output = _dot(x, self.params[brick + '.W'])
+        if brick + '.b' in self.params:
+            output += self.params[brick + '.b']
+        return output
+
+    def _gru_step(self, transition, states, inputs, update_inputs,
+                  reset_inputs, mask=None):
+        params = self.params
+        reset_values = _sigmoid(
+            states.dot(params[transition + '.state_to_reset']) +
+            reset_inputs)
+        next_states = numpy.tanh(
+            (states * reset_values).dot(
+                params[transition + '.state_to_state']) + inputs)
+        update_values = _sigmoid(
+            states.dot(params[transition + '.state_to_update']) +
+            update_inputs)
+        next_states = (next_states * update_values +
+                       states * (1 - update_values))
+        if mask is not None:
+            next_states = (mask[:, None] * next_states +
+                           (1 - mask[:, None]) * states)
+        return next_states
+
+    def _encode_direction(self, embeddings, mask, fork, transition,
+                          reverse):
+        inputs = [self._linear(embeddings, fork + '/fork_' + name)
+                  for name in GRU_INPUTS]
+        dim = self.params[transition + '.state_to_state'].shape[0]
+        states = numpy.zeros((embeddings.shape[1], dim),
+                             dtype=embeddings.dtype)
+        outputs = numpy.empty(embeddings.shape[:2] + (dim,),
+                              dtype=embeddings.dtype)
+        steps = range(len(embeddings))
+        for t in (reversed(steps) if reverse else steps):
+            states = self._gru_step(
+                transition, states, *[sequence[t] for sequence in inputs],
+                mask=mask[t])
+            outputs[t] = states
+        return outputs
+
+    def encode(self, source_sentence, source_sentence_mask):
+        """Returns the (time, batch, features) representation of a batch."""
+        source_sentence = source_sentence.T
+        source_sentence_mask = source_sentence_mask.T
+        embeddings = self.params[ENCODER + '/embeddings.W'][source_sentence]
+        bidir = ENCODER + '/bidirectionalwmt15'
+        return numpy.concatenate(
+            [self._encode_direction(embeddings, source_sentence_mask,
+                                    ENCODER + '/fwd_fork', bidir + '/forward',
+                                    reverse=False),
+             self._encode_direction(embeddings, source_sentence_mask,
+                                    ENCODER + '/back_fork',
+                                    bidir + '/backward', reverse=True)],
+            axis=2)
+
+    def initial_states(self, representation):
+        """Computes the decoder states from the first backward states."""
+        initializer = TRANSITION + '/decoder/state_initializer/linear_0'
+        attended_dim = self.params[initializer + '.W'].shape[0]
+        return numpy.tanh(self._linear(representation[0, :, -attended_dim:],
+                                       initializer))
+
+    def preprocess(self, representation):
+        return self._linear(representation, ATTENTION + '/preprocess')
+
+    def weighted_averages(self, states, representation, preprocessed, mask):
+        """Computes the attention glimpses of groups of hypotheses.
+
+        Parameters
+        ----------
+        states : numpy.ndarray
+            Decoder states, the rows of sentence `s` being the `s`-th group
+            of ``len(states) / n_sentences`` rows.
+        representation, preprocessed : numpy.ndarray
+            Encoded sentences and their preprocessing, one column per
+            sentence.
+        mask : numpy.ndarray
+            The (time, sentence) mask of the representation.
+
+        """
+        n_sentences = representation.shape[1]
+        transformed = states.dot(
+            self.params[ATTENTION + '/state_trans/transform_states.W'])
+        transformed = transformed.reshape((n_sentences, -1,
+                                           transformed.shape[-1]))
+        # (time, sentence, hypothesis) energies
+        energies = self._linear(
+            numpy.tanh(preprocessed[:, :, None, :] + transformed[None]),
+            ATTENTION + '/energy_comp/linear')[..., 0]
+        energies -= energies.max(axis=0)
+        weights = numpy.exp(energies) * mask[:, :, None]
+        weights /= weights.sum(axis=0)
+        averages = numpy.matmul(weights.transpose(1, 2, 0),
+                                representation.transpose(1, 0, 2))
+        return averages.reshape((len(states), -1))
+
+    def _feedback(self, outputs):
+        # The initial output -1 has a zero embedding
+        lookup = self.params[READOUT + '/lookupfeedbackwmt15/lookuptable.W']
+        feedback = lookup[numpy.maximum(outputs, 0)]
+        feedback[outputs < 0] = 0
+        return feedback
+
+    def logprobs(self, states, outputs, weighted_averages, shortlist=None):
+        """Returns the negative log-probabilities of the next words.
+
+        With a `shortlist` of words, the softmax is computed over these
+        words only, and only their columns of the output layer are used.
+
+        """
+        merge = READOUT + '/merge/transform_'
+        merged = (self._linear(states, merge + 'states') +
+                  self._linear(self._feedback(outputs), merge + 'feedback') +
+                  self._linear(weighted_averages,
+                               merge + 'weighted_averages'))
+        merged += self.params[POST_MERGE + '/maxout_bias.b']
+        maxout = merged.reshape(merged.shape[:-1] +
+                                (merged.shape[-1] // 2, 2)).max(axis=-1)
+        hidden = self._linear(maxout, POST_MERGE + '/softmax0')
+        if shortlist is None:
+            readouts = self._linear(hidden, POST_MERGE + '/softmax1')
+        else:
+            readouts = hidden.dot(
+                self.params[POST_MERGE + '/softmax1.W'][:, shortlist])
+            readouts += self.params[POST_MERGE + '/softmax1.b'][shortlist]
+        readouts -= readouts.max(axis=1)[:, None]
+        return numpy.log(numpy.exp(readouts).sum(axis=1))[:, None] - readouts
+
+    def next_states(self, states, outputs, weighted_averages):
+        """Feeds back the chosen words and computes the next states."""
+        feedback = self._feedback(outputs)
+        inputs = [self._linear(feedback, GENERATOR + '/fork/fork_' + name) +
+                  self._linear(weighted_averages,
+                               TRANSITION + '/distribute/fork_' + name)
+                  for name in GRU_INPUTS]
+        return self._gru_step(TRANSITION + '/decoder', states, *inputs)
+
+
+class NumpyBeamSearch(BatchedSearch):
+    """Batched beam search running a :class:`NumpyRNNsearch`.
+
+    The `input_values` of :meth:`search` are the ``input`` and
+    ``input_mask`` batches of source sentences.
+
+    """
+    compiled = True
+
+    def __init__(self, model, beam_size):
+        self.model = model
+        self.beam_size = beam_size
+
+    def compile(self):
+        pass
+
+    def compute_initial_states_and_contexts(self, inputs):
+        representation = self.model.encode(inputs['input'],
+                                           inputs['input_mask'])
+        n_hypotheses = representation.shape[1] * self.beam_size
+        contexts = {'attended': representation,
+                    'attended_mask': inputs['input_mask'].T,
+                    'preprocessed_attended':
+                        self.model.preprocess(representation)}
+        states = {'outputs': -numpy.ones(n_hypotheses, dtype='int64'),
+                  'states': numpy.repeat(
+                      self.model.initial_states(representation),
+                      self.beam_size, axis=0)}
+        return contexts, states, n_hypotheses
+
+    def compute_logprobs(self, contexts, states, shortlist=None):
+        # The glimpses are kept as a state, so that they are reordered with
+        # the hypotheses and reused to compute the next states
+        states['weighted_averages'] = self.model.weighted_averages(
+            states['states'], contexts['attended'],
+            contexts['preprocessed_attended'], contexts['attended_mask'])
+        return self.model.logprobs(states['states'], states['outputs'],
+                                   states['weighted_averages'], shortlist)
+
+    def compute_next_states(self, contexts, states, outputs):
+        return {'outputs': outputs,
+                'states': self.model.next_states(
+                    states['states'], outputs, states['weighted_averages'])}
+
+
+class NumpyTranslator(Translator):
+    """A :class:`Translator` running the model with NumPy.
+
+    Parameters stored with reduced precision stay quantized in memory.
+
+    """
+    dequantize = False
+
+    def _build(self, params):
+        self.model = NumpyRNNsearch(params)
+        self.source_sentence = 'input'
+        self.source_sentence_mask = 'input_mask'
+        self.beam_search = NumpyBeamSearch(self.model, self.beam_size)
@@ -0,0 +1,148 @@
+# Runs a data stream pipeline in background worker processes, so that the
+# batches of the next updates are assembled while Theano is busy with the
+# current one.
+import logging
+import time
+import traceback
+
+from multiprocessing import Process, Queue
+
+from fuel.streams import AbstractDataStream
+from fuel.transformers import Transformer
+
+logger = logging.getLogger(__name__)
+
+
+class _WorkerError(object):
+    def __init__(self, message):
+        self.message = message
+
+
+def _get_dataset(data_stream):
+    while hasattr(data_stream, 'data_stream'):
+        data_stream = data_stream.data_stream
+    return data_stream.dataset
+
+
+def _worker_main(data_stream, queue, worker_id, num_workers):
+    """Loops over epochs of the (forked) pipeline and fills the queue."""
+    try:
+        if num_workers > 1:
+            dataset = _get_dataset(data_stream)
+            dataset.shard_id = worker_id
+            dataset.num_shards = num_workers
+            # Reopen the dataset, its state was created before sharding
+            data_stream.reset()
+        while True:
+            for batch in data_stream.get_epoch_iterator():
+                queue.put(batch)
+            queue.put(StopIteration)
+    except Exception:
+        queue.put(_WorkerError(traceback.format_exc()))
+
+
+class PrefetchingDataStream(Transformer):
+    """Prefetches batches of a data stream in background processes.
+
+    Every worker runs a forked copy of the whole wrapped pipeline and
+    pushes ready, padded batches into its own bounded queue, which are
+    consumed in round-robin order so that the batch order is
+    deterministic for a given number of workers. With more than one
+    worker the underlying dataset has to support sharding through its
+    `shard_id` and `num_shards` attributes (eg. BinarizedParallelText).
+
+    Parameters
+    ----------
+    data_stream : :class:`AbstractDataStream`
+        The pipeline to run in the workers.
+    num_workers : int
+        Number of worker processes.
+    max_store : int
+        Maximum number of batches each worker prefetches.
+
+    Attributes
+    ----------
+    last_wait_time : float
+        Seconds the last call to `get_data` blocked waiting for a batch.
+
+    """
+    def __init__(self, data_stream, num_workers=1, max_store=10, **kwargs):
+        super(PrefetchingDataStream, self).__init__(data_stream, **kwargs)
+        self.num_workers = num_workers
+        self.max_store = max_store
+        self.last_wait_time = 0.
+        self.workers = None
+        self.queues = None
+
+    def _start_workers(self):
+        logger.info("Starting {} data worker(s), prefetching up to {} "
+                    "batches each".format(self.num_workers, self.max_store))
+        self.queues = [Queue(self.max_store)
+                       for _ in range(self.num_workers)]
+        self.workers = []
+        for i, queue in enumerate(self.queues):
+            worker = Process(target=_worker_main,
+                             args=(self.data_stream, queue, i,
+                                   self.num_workers))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self._active = range(self.num_workers)
+        self._next = 0
+
+    def _stop_workers(self):
+        if self.workers:
+            for worker in self.workers:
+                worker.terminate()
+        self.workers = None
+        self.queues = None
+
+    def get_epoch_iterator(self, **kwargs):
+        # Skip Transformer.get_epoch_iterator, the wrapped stream is only
+        # ever iterated inside the workers
+        if self.workers is None:
+            self._start_workers()
+        self._active = range(self.num_workers)
+        self._next = 0
+        return AbstractDataStream.get_epoch_iterator(self, **kwargs)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        if self.workers is None:
+            self._start_workers()
+        start_time = time.time()
+        while self._active:
+            self._next %= len(self._active)
+            worker_id = self._active[self._next]
+            data = self.queues[worker_id].get()
+            if isinstance(data, _WorkerError):
+                self._stop_workers()
+                raise RuntimeError("Data worker {} failed:\n{}".format(
+                    worker_id, data.message))
+            if data is StopIteration:
+                self._active.remove(worker_id)
+                continue
+            self._next += 1
+            self.last_wait_time = time.time() - start_time
+            return data
+        raise StopIteration
+
+    def reset(self):
+        self._stop_workers()
+        self.data_stream.reset()
+
+    def next_epoch(self):
+        pass
+
+    def close(self):
+        self._stop_workers()
+        self.data_stream.close()
+
+    def __getstate__(self):
+        # Processes and queues can not be pickled, workers are restarted
+        # lazily after unpickling
+        state = self.__dict__.copy()
+        state['workers'] = None
+        state['queues'] = None
+        return state
@@ -0,0 +1,181 @@
+# Reduced precision storage of the largest parameters of the model: the
+# source and target embeddings and the output layer softmax1.W, whose size
+# grows with the vocabularies.
+#
+# They are stored either as float16, or as int8 with one float32 scale per
+# word, saved as `<name>.scale` next to the matrix. Existing models are
+# converted with
+#
+#   python quantization.py --dtype int8 \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz model.int8.npz
+#
+# Loading dequantizes them to float32 for Theano, while the NumPy engine
+# keeps them quantized and dequantizes the rows it looks up.
+import argparse
+import logging
+import os
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Quantized parameters and their axis of words
+QUANTIZED_PARAMS = {
+    '/bidirectionalencoder/embeddings.W': 0,
+    '/decoder/sequencegenerator/readout/lookupfeedbackwmt15/lookuptable.W': 0,
+    '/decoder/sequencegenerator/readout/initializablefeedforwardsequence/'
+    'softmax1.W': 1,
+}
+SCALE_SUFFIX = '.scale'
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+
+def quantize(value, dtype, axis=0):
+    """Returns the (values, scales) of a matrix stored as `dtype`.
+
+    For int8 every word, ie. every slice along `axis`, is scaled so that
+    its largest absolute value is 127, `scales` are the float32 factors
+    restoring the values. For float16 `scales` is ``None``.
+
+    """
+    if dtype == 'float16':
+        return value.astype('float16'), None
+    if dtype != 'int8':
+        raise ValueError("Unknown storage {}".format(dtype))
+    other_axis = 1 - axis
+    scales = (numpy.abs(value).max(axis=other_axis) / 127.).astype('float32')
+    safe_scales = numpy.where(scales > 0, scales, 1)
+    values = numpy.round(value / numpy.expand_dims(safe_scales, other_axis))
+    return numpy.clip(values, -127, 127).astype('int8'), scales
+
+
+class QuantizedMatrix(object):
+    """A matrix stored as float16 or int8, dequantized when indexed.
+
+    Indexing returns float32 values like indexing the original matrix,
+    eg. ``matrix[ids]`` for the rows of a lookup table or
+    ``matrix[:, shortlist]`` for columns of the output layer.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The float16 or int8 values.
+    scales : numpy.ndarray or None
+        The scale of every word of int8 values.
+    axis : int
+        Axis of the words.
+
+    """
+    def __init__(self, values, scales=None, axis=0):
+        self.values = values
+        self.scales = scales
+        self.axis = axis
+        self.shape = values.shape
+        self.dtype = values.dtype
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (0 if self.scales is None
+                                     else self.scales.nbytes)
+
+    def __getitem__(self, key):
+        values = self.values[key].astype('float32')
+        if self.scales is None:
+            return values
+        key = key if isinstance(key, tuple) else (key,)
+        scales = self.scales[key[self.axis] if len(key) > self.axis
+                             else slice(None)]
+        if self.axis == 0:
+            scales = scales.reshape(scales.shape +
+                                    (1,) * (values.ndim - scales.ndim))
+        return values * scales
+
+    def rdot(self, x, chunk_size=4096):
+        """Returns ``x.dot(matrix)``, dequantizing blocks of columns."""
+        output = numpy.empty(x.shape[:-1] + self.shape[1:], dtype='float32')
+        for start in range(0, self.shape[1], chunk_size):
+            columns = slice(start, start + chunk_size)
+            output[..., columns] = x.dot(self[:, columns])
+        return output
+
+    def dequantize(self):
+        return self[:]
+
+    def tostring(self):
+        return self.values.tostring() + (
+            '' if self.scales is None else self.scales.tostring())
+
+
+def quantize_params(params, dtype):
+    """Returns the values to save for parameters stored as `dtype`.
+
+    Only the parameters of `QUANTIZED_PARAMS` are converted, the others
+    and everything stored as float32 are returned as they are.
+
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError("Unknown storage {}".format(dtype))
+    if dtype == 'float32':
+        return params
+    saved = {}
+    for name, value in params.items():
+        if name not in QUANTIZED_PARAMS:
+            saved[name] = value
+            continue
+        saved[name], scales = quantize(value, dtype, QUANTIZED_PARAMS[name])
+        if scales is not None:
+            saved[name + SCALE_SUFFIX] = scales
+    return saved
+
+
+def quantized_params(saved):
+    """Wraps the quantized values of a saved model in QuantizedMatrix."""
+    params = {}
+    for name, value in saved.items():
+        if name.endswith(SCALE_SUFFIX):
+            continue
+        if value.dtype in (numpy.float16, numpy.int8):
+            value = QuantizedMatrix(value, saved.get(name + SCALE_SUFFIX),
+                                    QUANTIZED_PARAMS.get(name, 0))
+        params[name] = value
+    return params
+
+
+def dequantize_params(saved):
+    """Returns the float32 parameters of a saved model."""
+    return {name: (value.dequantize() if isinstance(value, QuantizedMatrix)
+                   else value)
+            for name, value in quantized_params(saved).items()}
+
+
+def params_nbytes(params):
+    """Memory taken by parameters, quantized or not."""
+    return sum(value.nbytes for value in params.values())
+
+
+def main(model_path, output_path, dtype):
+    # Imported here, checkpoint imports this module
+    from checkpoint import load_param_values, save_npz
+
+    params = load_param_values(model_path)
+    quantized = quantize_params(params, dtype)
+    save_npz(output_path, quantized)
+    logger.info("Parameters take {:.1f} MB instead of {:.1f} MB, the file "
+                "{:.1f} MB instead of {:.1f} MB".format(
+                    params_nbytes(quantized) / 2. ** 20,
+                    params_nbytes(params) / 2. ** 20,
+                    os.path.getsize(output_path) / 2. ** 20,
+                    os.path.getsize(model_path) / 2. ** 20))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Store the embeddings and the output layer of a saved "
+                    "model with reduced precision")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("output", help="Converted parameters (.npz)")
+    parser.add_argument("--dtype", choices=STORAGE_DTYPES[1:],
+                        default='float16')
+    args = parser.parse_args()
+    main(args.model, args.output, args.dtype)
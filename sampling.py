@@ -1,18 +1,35 @@
+import cPickle
+import json
 import logging
 import numpy
 import operator
 import os
-import re
-import signal
+import subprocess
+import sys
+import threading
 import time
 
 from blocks.extensions import SimpleExtension
 from blocks.search import BeamSearch
 
-from subprocess import Popen, PIPE
+from Queue import Empty, Queue
+
+from beam_search import BatchedBeamSearch
+from bleu import BleuScorer
+from checkpoint import BackgroundWriter, load_param_values, save_npz
+from function_cache import compile_function
+from quantization import quantize_params
+from vocab import ids_to_sentence, invert_vocabulary, sentence_to_ids
 
 logger = logging.getLogger(__name__)
 
+# Script of the validation worker
+VALIDATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'validate.py')
+# Seconds between the checks that the validation worker is alive while
+# waiting for its results
+RESULT_TIMEOUT = 10
+
 
 class SamplingBase(object):
 
@@ -20,6 +37,14 @@ class SamplingBase(object):
         return self._get_attr_rec(getattr(obj, attr), attr) \
             if hasattr(obj, attr) else obj
 
+    def _get_dictionaries(self, sources):
+        # Either the Merge of two TextFile streams or a single dataset
+        # providing both sides, eg. BinarizedParallelText
+        if hasattr(sources, 'data_streams'):
+            return [data_stream.dataset.dictionary
+                    for data_stream in sources.data_streams]
+        return sources.dataset.dictionaries
+
     def _get_true_length(self, seq, eos_idx):
         try:
             return seq.tolist().index(eos_idx) + 1
@@ -31,18 +56,11 @@ class SamplingBase(object):
                 for x in seq]
 
     def _parse_input(self, line):
-        seqin = line.split()
-        seqlen = len(seqin)
-        seq = numpy.zeros(seqlen+1, dtype='int64')
-        for idx, sx in enumerate(seqin):
-            seq[idx] = self.vocab.get(sx, self.unk_idx)
-            if seq[idx] >= self.config['src_vocab_size']:
-                seq[idx] = self.unk_idx
-        seq[-1] = self.eos_idx
-        return seq
+        return sentence_to_ids(line, self.vocab, self.config['src_vocab_size'],
+                               self.unk_idx, self.eos_idx)
 
     def _idx_to_word(self, seq, ivocab):
-        return " ".join([ivocab.get(idx, "<UNK>") for idx in seq])
+        return ids_to_sentence(seq, ivocab)
 
 
 class Sampler(SimpleExtension, SamplingBase):
@@ -50,7 +68,7 @@ class Sampler(SimpleExtension, SamplingBase):
     def __init__(self, model, data_stream, config,
                  src_vocab=None, trg_vocab=None, src_ivocab=None,
                  trg_ivocab=None, src_eos_idx=-1, trg_eos_idx=-1,
-                 **kwargs):
+                 function_cache=None, **kwargs):
         super(Sampler, self).__init__(**kwargs)
         self.model = model
         self.config = config
@@ -61,7 +79,9 @@ class Sampler(SimpleExtension, SamplingBase):
         self.trg_ivocab = trg_ivocab
         self.src_eos_idx = src_eos_idx
         self.trg_eos_idx = trg_eos_idx
-        self.sampling_fn = model.get_theano_function()
+        self.sampling_fn = compile_function(
+            function_cache, 'sampling', model.inputs, model.outputs,
+            updates=model.updates)
 
     def do(self, which_callback, *args):
 
@@ -72,14 +92,14 @@ class Sampler(SimpleExtension, SamplingBase):
         # WARNING: Source and target indices from data stream
         #  can be different
         if not self.src_vocab:
-            self.src_vocab = sources.data_streams[0].dataset.dictionary
+            self.src_vocab = self._get_dictionaries(sources)[0]
         if not self.trg_vocab:
-            self.trg_vocab = sources.data_streams[1].dataset.dictionary
+            self.trg_vocab = self._get_dictionaries(sources)[1]
         if not self.src_ivocab:
-            self.src_ivocab = {v: k for k, v in self.src_vocab.items()}
+            self.src_ivocab = invert_vocabulary(self.src_vocab)
             self.src_ivocab[self.src_eos_idx] = '</S>'
         if not self.trg_ivocab:
-            self.trg_ivocab = {v: k for k, v in self.trg_vocab.items()}
+            self.trg_ivocab = invert_vocabulary(self.trg_vocab)
             self.trg_ivocab[self.trg_eos_idx] = '</S>'
 
         # Randomly select source samples from the current batch
@@ -94,9 +114,12 @@ class Sampler(SimpleExtension, SamplingBase):
 
         input_ = src_batch[sample_idx, :]
         target_ = trg_batch[sample_idx, :]
+        input_values = {'input': input_,
+                        'input_mask': batch['source_mask'][sample_idx, :]}
 
         # Sample
-        _1, outputs, _2, _3, costs = (self.sampling_fn(input_))
+        _1, outputs, _2, _3, costs = (self.sampling_fn(
+            *[input_values[var.name] for var in self.model.inputs]))
         outputs = outputs.T
         costs = list(costs.T)
 
@@ -115,13 +138,41 @@ class Sampler(SimpleExtension, SamplingBase):
             print ""
 
 
-class BleuValidator(SimpleExtension, SamplingBase):
+def _read_results(stream, results):
+    """Queues the results of the validation worker, then ``None``."""
+    for line in iter(stream.readline, ''):
+        results.put(json.loads(line))
+    results.put(None)
 
+
+def _send_snapshot(worker, iteration, snapshot, values):
+    save_npz(snapshot, values)
+    worker.stdin.write(json.dumps({'iteration': iteration,
+                                   'snapshot': snapshot}) + '\n')
+    worker.stdin.flush()
+
+
+class BleuValidator(SimpleExtension, SamplingBase):
+    """Decodes the validation set and keeps the best models by BLEU.
+
+    With ``config['val_async']`` the main loop only saves a snapshot of the
+    parameters in the background, which is decoded and scored by the
+    validate.py worker, so training goes on during validation. The worker
+    runs in a new interpreter on the Theano device of
+    ``config['val_device']``, and builds its own validator that decodes
+    like this one. Finished validations are collected after the next
+    batch, a snapshot that makes it into the best models is renamed to the
+    model file. At the end of training the pending validations are waited
+    for. A worker that dies fails training with a RuntimeError.
+
+    """
     def __init__(self, source_sentence, samples, model, data_stream,
                  config, n_best=1, track_n_models=1, trg_ivocab=None,
-                 src_eos_idx=-1, trg_eos_idx=-1, **kwargs):
+                 src_eos_idx=-1, trg_eos_idx=-1, source_sentence_mask=None,
+                 function_cache=None, **kwargs):
         super(BleuValidator, self).__init__(**kwargs)
         self.source_sentence = source_sentence
+        self.source_sentence_mask = source_sentence_mask
         self.samples = samples
         self.model = model
         self.data_stream = data_stream
@@ -142,10 +193,34 @@ class BleuValidator(SimpleExtension, SamplingBase):
         self.eos_idx = self.src_eos_idx  #self.vocab[self.eos_sym]
         self.best_models = []
         self.val_bleu_curve = []
-        self.beam_search = BeamSearch(beam_size=self.config['beam_size'],
-                                      samples=samples)
-        self.multibleu_cmd = ['perl', self.config['bleu_script'],
-                              self.config['val_set_grndtruth'], '<']
+
+        # Validation in a background process
+        self.asynchronous = config.get('val_async', False)
+        self.worker = None
+        self.results = None
+        self.pending = 0
+        if self.asynchronous:
+            self.add_condition('after_batch', predicate=self._has_results,
+                               arguments=('collect',))
+            self.add_condition('after_training', arguments=('collect',))
+
+        # Sentences can only be decoded in batches if the sampling graph
+        # takes a mask for the padding
+        if self.source_sentence_mask is not None:
+            self.beam_search = BatchedBeamSearch(
+                beam_size=self.config['beam_size'], samples=samples,
+                function_cache=function_cache)
+            self.batch_size = self.config['val_batch_size']
+        else:
+            self.beam_search = BeamSearch(beam_size=self.config['beam_size'],
+                                          samples=samples)
+            self.batch_size = 1
+
+        # Best models and snapshots are saved in the background
+        self.writer = BackgroundWriter()
+
+        # Reference n-grams are counted once for all the validations
+        self.bleu_scorer = BleuScorer(self.config['val_set_grndtruth'])
 
         # Create saving directory if it does not exist
         if not os.path.exists(self.config['saveto']):
@@ -168,103 +243,228 @@ class BleuValidator(SimpleExtension, SamplingBase):
 
     def do(self, which_callback, *args):
 
+        if self.asynchronous:
+            self._collect_results(block=which_callback == 'after_training')
+            if args[-1:] == ('collect',):
+                return
+
         # Track validation burn in
         if self.main_loop.status['iterations_done'] <= \
                 self.config['val_burn_in']:
             return
 
+        if self.asynchronous:
+            self._start_validation()
+            return
+
         # Get current model parameters
         self.model.set_param_values(
             self.main_loop.model.get_param_values())
 
         # Evaluate and save if necessary
-        self._save_model(self._evaluate_model())
+        bleu_score = self._evaluate_model()
+        self.val_bleu_curve.append(bleu_score)
+        self._save_model(bleu_score)
+
+    def _start_worker(self):
+        # The worker decodes with the same indices as the validator
+        config = dict(self.config, src_eos_idx=self.src_eos_idx,
+                      trg_eos_idx=self.trg_eos_idx)
+        config_path = os.path.join(self.config['saveto'], 'val_config.pkl')
+        with open(config_path, 'wb') as f:
+            cPickle.dump(config, f, cPickle.HIGHEST_PROTOCOL)
+
+        # Later flags take precedence, so that the worker does not share
+        # the device of the training process
+        device = self.config.get('val_device', 'cpu')
+        env = dict(os.environ)
+        env['THEANO_FLAGS'] = ','.join(
+            flags for flags in [env.get('THEANO_FLAGS'), 'device=' + device]
+            if flags)
+        logger.info("Starting the validation worker on {}".format(device))
+        self.worker = subprocess.Popen(
+            [sys.executable, VALIDATE_SCRIPT, config_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            close_fds=True)
+        self.results = Queue()
+        reader = threading.Thread(target=_read_results,
+                                  args=(self.worker.stdout, self.results))
+        reader.daemon = True
+        reader.start()
+
+    def _start_validation(self):
+        if self.worker is None:
+            self._start_worker()
+
+        # The snapshot is written in the background and then sent to the
+        # worker
+        iteration = self.main_loop.status['iterations_done']
+        snapshot = os.path.join(self.config['saveto'],
+                                'val_snapshot_{}.npz'.format(iteration))
+        self.writer.submit(_send_snapshot, self.worker, iteration, snapshot,
+                           self.main_loop.model.get_param_values())
+        self.pending += 1
+        if self.pending > 1:
+            logger.warning("{} validations pending, validation is slower "
+                           "than bleu_val_freq".format(self.pending))
+
+    def _has_results(self, log):
+        return self.pending > 0 and not self.results.empty()
+
+    def _collect_results(self, block=False):
+        if block and self.pending > 0:
+            # Raises if the last snapshot could not be sent
+            self.writer.wait()
+        while self.pending > 0:
+            try:
+                result = self.results.get(block, RESULT_TIMEOUT)
+            except Empty:
+                if not block:
+                    break
+                if self.worker.poll() is None:
+                    continue
+                result = None
+            if result is None:
+                status = self.worker.wait()
+                self._stop_worker()
+                raise RuntimeError("Validation worker exited with status {} "
+                                   "during a validation".format(status))
+            if 'error' in result:
+                self._stop_worker()
+                raise RuntimeError("Validation of iteration {} failed:\n{}"
+                                   .format(result['iteration'],
+                                           result['error']))
+            iteration = result['iteration']
+            snapshot = result['snapshot']
+            bleu_score = result['bleu']
+            self.pending -= 1
+            logger.info("BLEU of iteration {}: {}".format(iteration,
+                                                          bleu_score))
+            self.val_bleu_curve.append(bleu_score)
+            self._save_model(bleu_score, snapshot=snapshot)
+            if os.path.isfile(snapshot):
+                os.remove(snapshot)
+        if block:
+            self._stop_worker()
+
+    def _stop_worker(self):
+        if self.worker is not None:
+            # The worker exits at the end of its input
+            self.worker.stdin.close()
+            for _ in range(10):
+                if self.worker.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                self.worker.terminate()
+        self.worker = None
+        self.results = None
+        self.pending = 0
+
+    def __getstate__(self):
+        # The worker is restarted by the next validation after unpickling
+        state = self.__dict__.copy()
+        state['worker'] = None
+        state['results'] = None
+        state['pending'] = 0
+        return state
 
     def _evaluate_model(self):
 
         logger.info("Started Validation: ")
         val_start_time = time.time()
-        mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
+        self.bleu_scorer.reset()
         total_cost = 0.0
 
         # Get target vocabulary
         if not self.trg_ivocab:
             sources = self._get_attr_rec(self.main_loop, 'data_stream')
-            trg_vocab = sources.data_streams[1].dataset.dictionary
-            self.trg_ivocab = {v: k for k, v in trg_vocab.items()}
+            trg_vocab = self._get_dictionaries(sources)[1]
+            self.trg_ivocab = invert_vocabulary(trg_vocab)
 
         if self.verbose:
             ftrans = open(self.config['val_set_out'], 'w')
 
-        for i, line in enumerate(self.data_stream.get_epoch_iterator()):
-            """
-            Load the sentence, retrieve the sample, write to file
-            """
-
+        # Load the whole validation set, sentences of similar lengths are
+        # decoded together
+        seqs = []
+        for line in self.data_stream.get_epoch_iterator():
             line[0][-1] = self.src_eos_idx
-            seq = self._oov_to_unk(line[0])
-            input_ = numpy.tile(seq, (self.config['beam_size'], 1))
-
-            # draw sample, checking to ensure we don't get an empty string back
-            trans, costs = \
-                self.beam_search.search(
-                    input_values={self.source_sentence: input_},
-                    max_length=3*len(seq), eol_symbol=self.trg_eos_idx,
-                    ignore_first_eol=True)
-
-            nbest_idx = numpy.argsort(costs)[:self.n_best]
-            for j, best in enumerate(nbest_idx):
-                try:
-                    total_cost += costs[best]
-                    trans_out = trans[best]
-
-                    # convert idx to words
-                    trans_out = self._idx_to_word(trans_out[:-1], self.trg_ivocab)
-
-                except ValueError:
-                    print "Can NOT find a translation for line: {}".format(i+1)
-                    trans_out = '<UNK>'
-
-                if j == 0:
-                    # Write to subprocess and file if it exists
-                    print >> mb_subprocess.stdin, trans_out
-                    if self.verbose:
-                        print >> ftrans, trans_out
-
-            if i != 0 and i % 100 == 0:
-                print "Translated {} lines of validation set...".format(i)
-
-            mb_subprocess.stdin.flush()
+            seqs.append(self._oov_to_unk(line[0]))
+        order = numpy.argsort([len(seq) for seq in seqs], kind='mergesort')
+
+        translations = [None] * len(seqs)
+        for start in range(0, len(seqs), self.batch_size):
+            batch_idx = order[start:start + self.batch_size]
+            results = self._search([seqs[i] for i in batch_idx])
+
+            for i, (trans, costs) in zip(batch_idx, results):
+                nbest_idx = numpy.argsort(costs)[:self.n_best]
+                for j, best in enumerate(nbest_idx):
+                    try:
+                        total_cost += costs[best]
+                        trans_out = trans[best]
+
+                        # convert idx to words
+                        trans_out = self._idx_to_word(trans_out[:-1],
+                                                      self.trg_ivocab)
+
+                    except ValueError:
+                        print "Can NOT find a translation for line: {}".format(i+1)
+                        trans_out = '<UNK>'
+
+                    if j == 0:
+                        translations[i] = trans_out
+                        self.bleu_scorer.add(i, trans_out)
+
+            if start // 100 != (start + len(batch_idx)) // 100:
+                print "Translated {} lines of validation set, {}".format(
+                    start + len(batch_idx), self.bleu_scorer)
+
+        # Write to file if it exists
+        if self.verbose:
+            for trans_out in translations:
+                print >> ftrans, trans_out
+            ftrans.close()
 
         print "Total cost of the validation: {}".format(total_cost)
         self.data_stream.reset()
-        if self.verbose:
-            ftrans.close()
 
-        # send end of file, read output.
-        mb_subprocess.stdin.close()
-        stdout = mb_subprocess.stdout.readline()
-        print "output ", stdout
-        out_parse = re.match(r'BLEU = [-.0-9]+', stdout)
-        logger.info("Validation Took: {} minutes".format(
-            float(time.time() - val_start_time) / 60.))
-        assert out_parse is not None
-
-        # extract the score
-        bleu_score = float(out_parse.group()[6:])
-        self.val_bleu_curve.append(bleu_score)
+        print "output ", self.bleu_scorer
+        logger.info("Validation Took: {} minutes ({} sentences, {} per "
+                    "beam search)".format(
+                        float(time.time() - val_start_time) / 60.,
+                        len(seqs), self.batch_size))
+
+        bleu_score = self.bleu_scorer.score()
         print bleu_score
-        mb_subprocess.terminate()
 
         return bleu_score
 
+    def _search(self, seqs):
+        """Returns the (outputs, costs) of the beam of each sentence."""
+        if self.batch_size == 1:
+            input_ = numpy.tile(seqs[0], (self.config['beam_size'], 1))
+            return [self.beam_search.search(
+                input_values={self.source_sentence: input_},
+                max_length=3*len(seqs[0]), eol_symbol=self.trg_eos_idx,
+                ignore_first_eol=True)]
+
+        input_, input_mask = self.beam_search.prepare_inputs(
+            seqs, self.src_eos_idx)
+        return self.beam_search.search(
+            input_values={self.source_sentence: input_,
+                          self.source_sentence_mask: input_mask},
+            max_lengths=[3*len(seq) for seq in seqs],
+            eol_symbol=self.trg_eos_idx, ignore_first_eol=True)
+
     def _is_valid_to_save(self, bleu_score):
         if not self.best_models or min(self.best_models,
            key=operator.attrgetter('bleu_score')).bleu_score < bleu_score:
             return True
         return False
 
-    def _save_model(self, bleu_score):
+    def _save_model(self, bleu_score, snapshot=None):
         if self._is_valid_to_save(bleu_score):
             model = ModelInfo(bleu_score, self.config['saveto'])
 
@@ -272,6 +472,7 @@ class BleuValidator(SimpleExtension, SamplingBase):
             if len(self.best_models) >= self.track_n_models:
                 old_model = self.best_models[0]
                 if old_model.path and os.path.isfile(old_model.path):
+                    self.writer.wait()
                     logger.info("Deleting old model %s" % old_model.path)
                     os.remove(old_model.path)
                 self.best_models.remove(old_model)
@@ -279,13 +480,20 @@ class BleuValidator(SimpleExtension, SamplingBase):
             self.best_models.append(model)
             self.best_models.sort(key=operator.attrgetter('bleu_score'))
 
-            # Save the model here
-            s = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # Save the model here, files are replaced atomically. The
+            # embeddings and output layer are stored with the precision of
+            # config['model_storage'], see quantization.py
             logger.info("Saving new model {}".format(model.path))
-            numpy.savez(model.path, **self.main_loop.model.get_param_values())
-            numpy.savez(os.path.join(self.config['saveto'],'val_bleu_scores.npz'),
-                        bleu_scores=self.val_bleu_curve)
-            signal.signal(signal.SIGINT, s)
+            storage = self.config.get('model_storage', 'float32')
+            if snapshot and storage == 'float32':
+                os.rename(snapshot, model.path)
+            else:
+                values = (load_param_values(snapshot) if snapshot
+                          else self.main_loop.model.get_param_values())
+                self.writer.submit(save_npz, model.path,
+                                   quantize_params(values, storage))
+            save_npz(os.path.join(self.config['saveto'], 'val_bleu_scores.npz'),
+                     {'bleu_scores': self.val_bleu_curve})
 
 
 class ModelInfo:
@@ -0,0 +1,145 @@
+# Extensions saving and reloading training checkpoints, see checkpoint.py
+import cPickle
+import logging
+import time
+
+from blocks.extensions import SimpleExtension
+
+from checkpoint import CheckpointWriter, load_checkpoint
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the names of the step rule state in the checkpoints
+STEP_RULE = 'step_rule/'
+
+
+def get_step_rule_values(algorithm):
+    """Returns the values of the shared variables updated by the step rule.
+
+    These are eg. the AdaDelta accumulators and the `last_updated` rows
+    of the row-sparse step rules. They are named after their position in
+    `algorithm.step_rule_updates`, which is the same for the same model
+    and step rule.
+
+    """
+    return {'{}{}'.format(STEP_RULE, i): variable.get_value()
+            for i, (variable, _) in enumerate(algorithm.step_rule_updates)}
+
+
+def set_step_rule_values(algorithm, values):
+    """Sets the step rule state if the checkpoint has the same one."""
+    variables = [variable for variable, _ in algorithm.step_rule_updates]
+    names = ['{}{}'.format(STEP_RULE, i) for i in range(len(variables))]
+    saved = [name for name in values if name.startswith(STEP_RULE)]
+    if sorted(saved) != sorted(names) or any(
+            values[name].shape != variable.get_value(borrow=True).shape
+            for name, variable in zip(names, variables)):
+        logger.warning("The step rule state of the checkpoint does not "
+                       "match the step rule, it is not loaded")
+        return
+    for name, variable in zip(names, variables):
+        variable.set_value(values[name])
+
+
+class Checkpoint(SimpleExtension):
+    """Saves the parameters, the step rule state and the log.
+
+    The values are copied to the host and the log pickled in the main
+    loop, they are then written in a background thread by a
+    :class:`CheckpointWriter`. The time the training is blocked, which
+    includes waiting for the previous write to finish, is logged as
+    `checkpoint_stall_time`. The positions in the dataset of a
+    :class:`ResumableStream` are saved as `dataset_offsets`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint.
+    incremental : bool
+        Only write the values which changed since the previous save.
+
+    """
+    def __init__(self, path, incremental=True, **kwargs):
+        kwargs.setdefault('after_training', True)
+        super(Checkpoint, self).__init__(**kwargs)
+        self.writer = CheckpointWriter(path, incremental=incremental)
+
+    def do(self, which_callback, *args):
+        start_time = time.time()
+        values = self.main_loop.model.get_param_values()
+        values.update(get_step_rule_values(self.main_loop.algorithm))
+        log = cPickle.dumps(self.main_loop.log, cPickle.HIGHEST_PROTOCOL)
+        status = self.main_loop.status
+        metadata = {'iterations_done': status['iterations_done'],
+                    'epochs_done': status['epochs_done']}
+        if hasattr(self.main_loop.data_stream, 'offsets'):
+            # Pairs, JSON objects only have string keys
+            metadata['dataset_offsets'] = sorted(
+                self.main_loop.data_stream.offsets.items())
+        self.writer.save(values, metadata, {'log': log})
+        if which_callback == 'after_training':
+            self.writer.wait()
+        stall_time = time.time() - start_time
+        self.main_loop.log.current_row['checkpoint_stall_time'] = stall_time
+        logger.info("Checkpoint of iteration {} stalled training for {:.2f} "
+                    "seconds".format(status['iterations_done'], stall_time))
+
+
+class LoadCheckpoint(SimpleExtension):
+    """Loads a checkpoint saved by :class:`Checkpoint` before training.
+
+    The arrays are memory-mapped and copied straight into the shared
+    variables. If the data stream is a :class:`ResumableStream`, the
+    epoch is resumed at the positions in the dataset of the checkpoint. The time from
+    `start_time` to the end of the first update is logged as
+    `time_to_first_update`. Does nothing if there is no checkpoint in
+    `path`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the checkpoint.
+    start_time : float, optional
+        Start of the run, defaults to the creation of the extension.
+
+    """
+    def __init__(self, path, start_time=None, **kwargs):
+        kwargs.setdefault('before_training', True)
+        super(LoadCheckpoint, self).__init__(**kwargs)
+        self.path = path
+        self.start_time = start_time or time.time()
+        self.time_to_first_update = None
+        self.add_condition('after_batch', predicate=self._first_update)
+
+    def _first_update(self, log):
+        return self.time_to_first_update is None
+
+    def do(self, which_callback, *args):
+        if which_callback == 'after_batch':
+            self.time_to_first_update = time.time() - self.start_time
+            self.main_loop.log.current_row['time_to_first_update'] = \
+                self.time_to_first_update
+            logger.info("First update {:.1f} seconds after the start".format(
+                self.time_to_first_update))
+            return
+
+        load_start_time = time.time()
+        checkpoint = load_checkpoint(self.path, mmap_mode='r')
+        if checkpoint is None:
+            logger.info("No checkpoint found in {}".format(self.path))
+            return
+        values, blobs, metadata = checkpoint
+        self.main_loop.model.set_param_values(
+            {name: value for name, value in values.items()
+             if not name.startswith(STEP_RULE)})
+        set_step_rule_values(self.main_loop.algorithm, values)
+        self.main_loop.log = cPickle.loads(blobs['log'])
+        # The epoch is restarted by the main loop, at the saved position
+        self.main_loop.log.status['epoch_started'] = False
+        if metadata.get('dataset_offsets') and \
+                hasattr(self.main_loop.data_stream, 'resume_from'):
+            self.main_loop.data_stream.resume_from(
+                dict(metadata['dataset_offsets']))
+        logger.info("Loaded the checkpoint of iteration {} from {} in {:.1f} "
+                    "seconds".format(metadata['iterations_done'], self.path,
+                                     time.time() - load_start_time))
@@ -0,0 +1,232 @@
+# Serves translations over HTTP on localhost, batching concurrent requests
+#
+#   python serve.py --proto get_config_wmt15_fi_en_40k --port 8000 \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz
+#
+#   curl -d '{"source": "tokenized source sentence"}' \
+#       http://127.0.0.1:8000/translate
+#
+# Requests are queued, and a single decoding thread translates up to
+# max_batch_size of them with one beam search, waiting at most max_wait_ms
+# after the first queued request for more to arrive. GET /stats returns
+# the counters of the server.
+import argparse
+import json
+import logging
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+
+import config
+
+from cache import TranslationCache
+from translate import Translator
+
+logger = logging.getLogger(__name__)
+
+
+class _Request(object):
+    def __init__(self, source):
+        self.source = source
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.translation = None
+        self.error = None
+        self.stats = {}
+
+
+class DynamicBatcher(object):
+    """Translates queued sentences in batches from a background thread.
+
+    Parameters
+    ----------
+    translator : :class:`Translator`
+        The model, only ever used by the batching thread.
+    max_batch_size : int
+        Maximum number of sentences decoded together.
+    max_wait_ms : float
+        Time the first sentence of a batch waits for others at most.
+
+    """
+    def __init__(self, translator, max_batch_size=16, max_wait_ms=10.):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'errors': 0,
+                      'decoding_seconds': 0.}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def translate(self, source):
+        """Queues a sentence and blocks until it is translated."""
+        request = _Request(source)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.translation, request.stats
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get(
+                    timeout=max(deadline - time.time(), 0)))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start_time = time.time()
+            try:
+                translations = self.translator.translate_lines(
+                    [request.source for request in batch],
+                    self.max_batch_size)
+                error = None
+            except Exception as e:
+                logger.exception("Translation failed")
+                translations = [None] * len(batch)
+                error = str(e)
+            end_time = time.time()
+
+            with self.lock:
+                self.stats['requests'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['errors'] += len(batch) if error else 0
+                self.stats['decoding_seconds'] += end_time - start_time
+            for request, translation in zip(batch, translations):
+                request.translation = translation
+                request.error = error
+                request.stats = {
+                    'queue_ms': 1000 * (start_time - request.arrival_time),
+                    'decode_ms': 1000 * (end_time - start_time),
+                    'latency_ms': 1000 * (end_time - request.arrival_time),
+                    'batch_size': len(batch)}
+                request.done.set()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['mean_batch_size'] = \
+            float(stats['requests']) / max(stats['batches'], 1)
+        stats['queued'] = self.queue.qsize()
+        if self.translator.cache is not None:
+            stats.update(self.translator.cache.get_stats())
+        return stats
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'Unknown path'})
+        self._reply(200, self.server.batcher.get_stats())
+
+    def do_POST(self):
+        if self.path != '/translate':
+            return self._reply(404, {'error': 'Unknown path'})
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            source = json.loads(self.rfile.read(length))['source']
+            if isinstance(source, unicode):
+                source = source.encode('utf-8')
+        except (ValueError, KeyError, TypeError):
+            return self._reply(400, {'error': 'Expected {"source": "..."}'})
+        try:
+            translation, stats = self.server.batcher.translate(source)
+        except RuntimeError as e:
+            return self._reply(500, {'error': str(e)})
+        self._reply(200, dict(stats, translation=translation))
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class TranslationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes concurrent clients wait for SYN retries
+    request_queue_size = 128
+
+    def __init__(self, address, batcher):
+        HTTPServer.__init__(self, address, TranslationHandler)
+        self.batcher = batcher
+
+
+def main(config, model_path, port, max_batch_size, max_wait_ms,
+         beam_size=None, engine='theano', cache_size=0, cache_file=None):
+    if engine == 'numpy':
+        from numpy_model import NumpyTranslator as translator_class
+    else:
+        translator_class = Translator
+    cache = TranslationCache(cache_size, cache_file) if cache_size else None
+    translator = translator_class(config, model_path, beam_size=beam_size,
+                                  cache=cache)
+    batcher = DynamicBatcher(translator, max_batch_size=max_batch_size,
+                             max_wait_ms=max_wait_ms)
+
+    # Only ever listen on the loopback interface
+    server = TranslationServer(('127.0.0.1', port), batcher)
+    logger.info("Serving on http://127.0.0.1:{}/translate, batches of up "
+                "to {} sentences, waiting up to {} ms".format(
+                    port, max_batch_size, max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Server stats: {}".format(batcher.get_stats()))
+        if cache is not None and cache_file:
+            cache.save()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Serve translations on localhost")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config the model was trained with")
+    parser.add_argument("--engine", choices=['theano', 'numpy'],
+                        default='theano',
+                        help="Run the model with Theano or plain NumPy")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--beam-size", type=int, default=None,
+                        help="Defaults to the beam size of the config")
+    parser.add_argument("--max-batch-size", type=int, default=16,
+                        help="Maximum number of sentences per beam search")
+    parser.add_argument("--max-wait-ms", type=float, default=10.,
+                        help="Maximum time a request waits for others")
+    parser.add_argument("--shortlist", default=None,
+                        help="Prefix of the lexical table written by "
+                             "shortlist.py, defaults to config['shortlist']")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="Number of translations cached, 0 disables "
+                             "the cache")
+    parser.add_argument("--cache-file", default=None,
+                        help="File the cache is loaded from and saved to")
+    args = parser.parse_args()
+
+    config = getattr(config, args.proto)()
+    if args.shortlist:
+        config['shortlist'] = args.shortlist
+    main(config, args.model, args.port, args.max_batch_size,
+         args.max_wait_ms, args.beam_size, args.engine, args.cache_size,
+         args.cache_file)
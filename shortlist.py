@@ -0,0 +1,199 @@
+# Vocabulary selection for the decoder: the output layer is only
+# computed for a shortlist of target words per batch of source sentences,
+# the most frequent target words plus the likely translations of the source
+# words according to a lexical table.
+#
+# The table is built from the binarized training corpus (see binarize.py):
+#
+#   python shortlist.py --proto get_config_wmt15_fi_en_40k --prefix lex
+#
+# which writes
+#   <prefix>.lex.npy       int32 (src_vocab_size, n_translations) target
+#                          words of each source word, best first, -1 padded
+#   <prefix>.frequent.npy  int32 target words by decreasing frequency
+#
+# Translations of a source word are the target words co-occurring with it
+# in the same sentence pairs, ranked by Dice coefficient.
+import argparse
+import logging
+import time
+
+import numpy
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def shortlist_paths(prefix):
+    return '{}.lex.npy'.format(prefix), '{}.frequent.npy'.format(prefix)
+
+
+def _merge_counts(keys, counts, new_keys):
+    keys = numpy.concatenate([keys, new_keys])
+    counts = numpy.concatenate([counts,
+                                numpy.ones(len(new_keys), dtype='int64')])
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    return keys, numpy.bincount(inverse, weights=counts).astype('int64')
+
+
+def build_lexical_table(pairs, src_vocab_size, trg_vocab_size,
+                        n_translations=20, ignore=(0, 1), chunk_size=10 ** 7):
+    """Ranks the target words co-occurring with every source word.
+
+    Parameters
+    ----------
+    pairs : iterable
+        (source, target) index sequences. Indices not smaller than the
+        vocabulary sizes are ignored.
+    src_vocab_size, trg_vocab_size : int
+        Sizes of the vocabularies of the model.
+    n_translations : int
+        Number of target words kept per source word.
+    ignore : tuple of int
+        Indices ignored on both sides, by default EOS and UNK.
+    chunk_size : int
+        Number of co-occurrences counted at once.
+
+    Returns
+    -------
+    table : numpy.ndarray
+        The (src_vocab_size, n_translations) lexical table.
+    frequent : numpy.ndarray
+        Target words sorted by decreasing frequency.
+
+    """
+    src_counts = numpy.zeros(src_vocab_size, dtype='int64')
+    trg_counts = numpy.zeros(trg_vocab_size, dtype='int64')
+    trg_frequencies = numpy.zeros(trg_vocab_size, dtype='int64')
+    keys = numpy.zeros(0, dtype='int64')
+    counts = numpy.zeros(0, dtype='int64')
+    buffered, n_buffered = [], 0
+
+    ignore = numpy.asarray(ignore)
+    for i, (source, target) in enumerate(pairs):
+        source = numpy.asarray(source, dtype='int64')
+        target = numpy.asarray(target, dtype='int64')
+        target = target[target < trg_vocab_size]
+        trg_frequencies += numpy.bincount(target, minlength=trg_vocab_size)
+        # Sentence level co-occurrences of distinct words
+        source = numpy.setdiff1d(source[source < src_vocab_size], ignore)
+        target = numpy.setdiff1d(target, ignore)
+        src_counts[source] += 1
+        trg_counts[target] += 1
+        buffered.append((source[:, None] * trg_vocab_size +
+                         target[None, :]).ravel())
+        n_buffered += len(buffered[-1])
+        if n_buffered >= chunk_size:
+            keys, counts = _merge_counts(keys, counts,
+                                         numpy.concatenate(buffered))
+            buffered, n_buffered = [], 0
+        if i != 0 and i % 1000000 == 0:
+            logger.info("Counted {} sentence pairs, {} co-occurring word "
+                        "pairs".format(i, len(keys)))
+    if buffered:
+        keys, counts = _merge_counts(keys, counts, numpy.concatenate(buffered))
+
+    src_words = keys // trg_vocab_size
+    trg_words = keys % trg_vocab_size
+    dice = 2. * counts / (src_counts[src_words] + trg_counts[trg_words])
+
+    # Best translations first within each source word
+    order = numpy.lexsort((-dice, src_words))
+    src_words = src_words[order]
+    trg_words = trg_words[order]
+    ranks = (numpy.arange(len(order)) -
+             numpy.searchsorted(src_words, src_words))
+    kept = ranks < n_translations
+    table = -numpy.ones((src_vocab_size, n_translations), dtype='int32')
+    table[src_words[kept], ranks[kept]] = trg_words[kept]
+
+    # Ignored words are added to the shortlists explicitly if needed
+    trg_frequencies[ignore[ignore < trg_vocab_size]] = 0
+    frequent = numpy.argsort(-trg_frequencies, kind='mergesort')
+    return table, frequent.astype('int32')
+
+
+class Shortlist(object):
+    """Selects the candidate target words of batches of source sentences.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix the lexical table was saved to.
+    n_frequent : int
+        Number of most frequent target words always included.
+    n_translations : int
+        Number of translations of every source word included, at most
+        the number of translations in the table.
+
+    """
+    def __init__(self, prefix, n_frequent=2000, n_translations=10):
+        table_path, frequent_path = shortlist_paths(prefix)
+        self.table = numpy.load(table_path)[:, :n_translations]
+        self.frequent = numpy.load(frequent_path)[:n_frequent]
+        self.n_frequent = n_frequent
+        self.n_translations = n_translations
+
+    def candidates(self, seqs, include=()):
+        """Returns the sorted shortlist of a batch of source sentences.
+
+        Parameters
+        ----------
+        seqs : list of sequences
+            Source sentences as indices.
+        include : sequence of int
+            Target words always in the shortlist, eg. EOS and UNK.
+
+        """
+        source = numpy.concatenate([numpy.asarray(seq) for seq in seqs])
+        translations = self.table[source[source < len(self.table)]].ravel()
+        return numpy.union1d(
+            numpy.union1d(self.frequent, translations[translations >= 0]),
+            numpy.asarray(include, dtype='int64')).astype('int64')
+
+
+def main(config, prefix, n_translations):
+    # Imported here, decoding with a shortlist does not need Fuel
+    from binarize import load_binarized
+
+    src_tokens, src_offsets = load_binarized(config['binarized_data'], 'src')
+    trg_tokens, trg_offsets = load_binarized(config['binarized_data'], 'trg')
+
+    def pairs():
+        for i in xrange(len(src_offsets) - 1):
+            yield (src_tokens[src_offsets[i]:src_offsets[i + 1]],
+                   trg_tokens[trg_offsets[i]:trg_offsets[i + 1]])
+
+    start_time = time.time()
+    table, frequent = build_lexical_table(
+        pairs(), config['src_vocab_size'], config['trg_vocab_size'],
+        n_translations=n_translations, ignore=(0, config['unk_id']))
+    table_path, frequent_path = shortlist_paths(prefix)
+    numpy.save(table_path, table)
+    numpy.save(frequent_path, frequent)
+    logger.info("Saved the lexical table of {} sentence pairs to {} in {:.1f} "
+                "seconds".format(len(src_offsets) - 1, prefix,
+                                 time.time() - start_time))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Build the lexical table of the decoding shortlist")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config to use for config")
+    parser.add_argument("--prefix", default=None,
+                        help="Output prefix, defaults to config['shortlist']")
+    parser.add_argument("--n-translations", type=int, default=20,
+                        help="Number of translations kept per source word")
+    args = parser.parse_args()
+
+    config = getattr(config, args.proto)()
+    prefix = args.prefix if args.prefix else config['shortlist']
+    if not prefix:
+        raise ValueError("No output prefix given")
+    if not config['binarized_data']:
+        raise ValueError("The lexical table is built from the binarized "
+                         "corpus, see binarize.py")
+    main(config, prefix, args.n_translations)
@@ -5,7 +5,6 @@
 # common words of the raw data
 #
 
-import cPickle
 import os
 
 from picklable_itertools import chain, izip, imap, repeat
@@ -17,6 +16,7 @@ from fuel.streams import DataStream
 from fuel.transformers import Merge, Batch, Filter, Padding, Mapping
 
 from config import get_config_wmt15_fi_en_40k
+from vocab import load_vocabulary
 
 config = get_config_wmt15_fi_en_40k()
 
@@ -51,14 +51,14 @@ class CycleTextFile(TextFile):
         return chain.from_iterable(izip(*[chain.from_iterable(
             imap(open, repeat(f))) for f in self.files]))
 
-en_dataset = CycleTextFile(en_files, cPickle.load(open(en_vocab)), None)
-fr_dataset = CycleTextFile(fr_files, cPickle.load(open(fr_vocab)), None)
+en_dataset = CycleTextFile(en_files, load_vocabulary(en_vocab), None)
+fr_dataset = CycleTextFile(fr_files, load_vocabulary(fr_vocab), None)
 
 stream = Merge([en_dataset.get_example_stream(),
                 fr_dataset.get_example_stream()],
                ('english', 'french'))
 
-dev_dataset = TextFile([dev_file], cPickle.load(open(en_vocab)), None)
+dev_dataset = TextFile([dev_file], load_vocabulary(en_vocab), None)
 dev_stream = DataStream(dev_dataset)
 
 filtered_stream = Filter(stream, predicate=too_long)
@@ -3,51 +3,32 @@
 # Should probably use caching and multiprocessing like in the tutorial
 # The files are those from WMT15, the vocab files are simply the 30,000 most
 # common words of the raw data
+# Setting config['binarized_data'] to a corpus written by binarize.py skips
+# the numberization of the text files altogether
 #
 
-import cPickle
-import numpy
-
 from fuel.datasets import TextFile
-from fuel.schemes import ConstantScheme
 from fuel.streams import DataStream
-from fuel.transformers import (
-    Merge, Batch, Filter, Padding, SortMapping, Unpack, Mapping)
+from fuel.transformers import Merge, Filter, Padding, Mapping
+
+# RemapWordIdx and _oov_to_unk are kept importable from here for old dumps
+from batching import (
+    DATASET_OFFSET, BatchRemapWordIdx, DatasetOffset, RemapWordIdx,
+    ResumableStream, SampledTargetVocabulary, SeekableExamples,
+    SortedGroupBatch, TokenBudgetBatch, _oov_to_unk)
+from binarize import BinarizedParallelText
+from prefetch import PrefetchingDataStream
+from vocab import load_vocabulary
 
 # Everthing here should be wrapped and parameterized by config
 # this import is to workaround for pickling errors when wrapped
 from model import config
 
 
-class RemapWordIdx(object):
-    def __init__(self, mappings):
-        self.mappings = mappings
-
-    def __call__(self, sentence_pair):
-        for mapping in self.mappings:
-            sentence_pair[mapping[0]][numpy.where(
-                sentence_pair[mapping[0]] == mapping[1])] = mapping[2]
-        return sentence_pair
-
-
 def _length(sentence_pair):
     return len(sentence_pair[1])
 
 
-class _oov_to_unk(object):
-    def __init__(self, src_vocab_size=30000, trg_vocab_size=30000,
-                 unk_id=1):
-        self.src_vocab_size = src_vocab_size
-        self.trg_vocab_size = trg_vocab_size
-        self.unk_id = unk_id
-
-    def __call__(self, sentence_pair):
-        return ([x if x < self.src_vocab_size else self.unk_id
-                 for x in sentence_pair[0]],
-                [x if x < self.trg_vocab_size else self.unk_id
-                 for x in sentence_pair[1]])
-
-
 class _too_long(object):
     def __init__(self, seq_len=50):
         self.seq_len = seq_len
@@ -56,38 +37,71 @@ class _too_long(object):
         return all([len(sentence) <= self.seq_len
                     for sentence in sentence_pair])
 
-fi_vocab = config['src_vocab']
-en_vocab = config['trg_vocab']
+fi_vocab = load_vocabulary(config['src_vocab'])
+en_vocab = load_vocabulary(config['trg_vocab'])
 fi_file = config['src_data']
 en_file = config['trg_data']
 
-fi_dataset = TextFile([fi_file], cPickle.load(open(fi_vocab)), None)
-en_dataset = TextFile([en_file], cPickle.load(open(en_vocab)), None)
+if config['binarized_data']:
+    # Pairs are served from memory-mapped arrays written by binarize.py
+    dataset = BinarizedParallelText(config['binarized_data'],
+                                    dictionaries=(fi_vocab, en_vocab))
+    stream = DataStream(dataset)
+else:
+    fi_dataset = TextFile([fi_file], fi_vocab, None)
+    en_dataset = TextFile([en_file], en_vocab, None)
+
+    stream = Merge([fi_dataset.get_example_stream(),
+                    en_dataset.get_example_stream()],
+                   ('source', 'target'))
+
+# Resumed epochs start at the offset in the dataset saved by checkpoints
+stream = examples = SeekableExamples(stream)
+stream = Filter(stream, predicate=_too_long(config['seq_len']))
 
-stream = Merge([fi_dataset.get_example_stream(),
-                en_dataset.get_example_stream()],
-               ('source', 'target'))
+if config['max_tokens_per_batch']:
+    # Batch by length buckets under a token budget
+    stream = batches = TokenBudgetBatch(
+        stream, max_tokens=config['max_tokens_per_batch'],
+        bucket_width=config['bucket_width'], examples=examples)
+else:
+    stream = batches = SortedGroupBatch(
+        stream, examples, config['batch_size'], config['sort_k_batches'],
+        _length)
 
-stream = Filter(stream, predicate=_too_long(config['seq_len']))
-stream = Mapping(stream, _oov_to_unk(
-                 src_vocab_size=config['src_vocab_size'],
-                 trg_vocab_size=config['trg_vocab_size'],
-                 unk_id=config['unk_id']))
-stream = Batch(stream,
-               iteration_scheme=ConstantScheme(
-                   config['batch_size']*config['sort_k_batches']))
-
-stream = Mapping(stream, SortMapping(_length))
-stream = Unpack(stream)
-stream = Batch(stream, iteration_scheme=ConstantScheme(config['batch_size']))
 masked_stream = Padding(stream)
 masked_stream = Mapping(
-    masked_stream, RemapWordIdx([(0, 0, config['src_eos_idx']),
-                                 (2, 0, config['trg_eos_idx'])]))
+    masked_stream, BatchRemapWordIdx(
+        src_vocab_size=config['src_vocab_size'],
+        trg_vocab_size=config['trg_vocab_size'],
+        unk_id=config['unk_id'],
+        src_eos_idx=config['src_eos_idx'],
+        trg_eos_idx=config['trg_eos_idx']))
+
+# Target words of the sampled softmax of every batch, see model.py
+if config['sampled_softmax_size']:
+    masked_stream = Mapping(
+        masked_stream,
+        SampledTargetVocabulary(config['sampled_softmax_size']),
+        add_sources=('target_candidates', 'target_candidate_indices'))
+
+masked_stream = Mapping(masked_stream, DatasetOffset(batches),
+                        add_sources=(DATASET_OFFSET,))
+
+# Assemble batches in background processes
+if config['num_data_workers'] > 0:
+    if config['num_data_workers'] > 1 and not config['binarized_data']:
+        raise ValueError("Multiple data workers require a binarized corpus")
+    masked_stream = PrefetchingDataStream(
+        masked_stream, num_workers=config['num_data_workers'],
+        max_store=config['prefetch_batches'])
+
+# Checkpoints record the positions in the dataset to resume from
+masked_stream = ResumableStream(masked_stream, examples)
 
 # Setup development set stream if necessary
 dev_stream = None
 if 'val_set' in config and config['val_set']:
     dev_file = config['val_set']
-    dev_dataset = TextFile([dev_file], cPickle.load(open(fi_vocab)), None)
+    dev_dataset = TextFile([dev_file], fi_vocab, None)
     dev_stream = DataStream(dev_dataset)
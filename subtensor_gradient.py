@@ -7,15 +7,30 @@ import theano
 from theano import tensor
 from picklable_itertools.extras import equizip
 
-from blocks.algorithms import GradientDescent, AdaDelta, Scale
+from blocks.algorithms import (GradientDescent, AdaDelta, Adam, BasicMomentum,
+                               BasicRMSProp, CompositeRule, Scale)
 from blocks.filter import VariableFilter
 from blocks.bricks.lookup import LookupTable
 from blocks.utils import named_copy, shared_floatx
 from blocks.theano_expressions import l2_norm
 
+from function_cache import compile_function
+
 
 logger = logging.getLogger(__name__)
 
+
+def _param_shape(param):
+    # Without copying the value to the host if it is on the GPU
+    return param.get_value(borrow=True, return_internal_type=True).shape
+
+
+def _zeros_like_param(param):
+    """Returns a shared variable of zeros, without a dense temporary."""
+    return shared_floatx(numpy.zeros(_param_shape(param), dtype=theano.config.floatX),
+                         borrow=True)
+
+
 def subtensor_params(cg, lookups):
     """Extract information used by the subtensor fix
     
@@ -30,12 +45,13 @@ def subtensor_params(cg, lookups):
     Returns
     -------
     subtensor_params : dict
-        Dictionary of the form {parameter: (subparam, canonized_indices, outputs, indices)}
+        Dictionary of the form {parameter: (subparam, canonized_indices, outputs, indices, positions)}
         Where :
             - subparam is the subtensor of the parameter contributing to the gradient
             - canonized_indices is the concatenation of indices without repetition such that param[canonized_indices] = subparam
             - outputs is the list of subtensors in the graph which are result of a lookup
             - indices is the list of indices in the graph which are used in a lookup so that forall i: param[indices[i]] = outputs[i]
+            - positions is the list of the rows of subparam looked up by each of the indices, so that forall i: subparam[positions[i]] = outputs[i]
     """
 
     def extract_ind_app(lookup):
@@ -48,12 +64,17 @@ def subtensor_params(cg, lookups):
             for branch in branches])
         outputs = [branch.owner.inputs[0].owner.inputs[0] for branch in branches]
         indices = [branch.owner.inputs[0].owner.inputs[0].owner.inputs[1] for branch in branches]
-        canonized_indices = tensor.concatenate(indices, axis=0)
-        canonized_indices = canonized_indices % lookup.length # Replace -1 with lookup.length - 1
-        canonized_indices = tensor.extra_ops.Unique()(tensor.sort(canonized_indices))
+        all_indices = tensor.concatenate(indices, axis=0)
+        all_indices = all_indices % lookup.length # Replace -1 with lookup.length - 1
+        canonized_indices, inverse = tensor.extra_ops.Unique(return_inverse=True)(all_indices)
+        positions = []
+        start = 0
+        for indice in indices:
+            positions.append(inverse[start:start + indice.shape[0]])
+            start = start + indice.shape[0]
 
         subparam = param[canonized_indices]
-        return {param: (subparam, canonized_indices, outputs, indices)}
+        return {param: (subparam, canonized_indices, outputs, indices, positions)}
 
     r = {}
     for lookup in lookups:
@@ -67,15 +88,18 @@ class GradientDescent_SubtensorFix(GradientDescent):
     ----------
     subtensor_params : dict
         A dictionary given by the subtensor_params function.
+    function_cache : :class:`FunctionCache`, optional
+        Cache the update function is compiled through.
 
     """
-    def __init__(self, cost, params, subtensor_params={}, step_rule=None, *args, **kwargs):
+    def __init__(self, cost, params, subtensor_params={}, step_rule=None, function_cache=None, *args, **kwargs):
         full_params = params
         self.subtensor_params = subtensor_params
+        self.function_cache = function_cache
 
         # For each LookupTable, we replace it by its subtensors appearing in the graph
         params = [param for param in full_params if param not in subtensor_params]
-        for _, (_, _, outputs, _) in subtensor_params.iteritems():
+        for _, (_, _, outputs, _, _) in subtensor_params.iteritems():
             params.extend(outputs)
 
         super(GradientDescent, self).__init__(cost=cost, params=params, **kwargs)
@@ -86,13 +110,14 @@ class GradientDescent_SubtensorFix(GradientDescent):
             equizip(self.params, tensor.grad(self.cost, self.params)))
 
         # We combine the gradients extracted from the same parameter
-        for param, (subparam, canonized_indices, outputs, indices) in subtensor_params.iteritems():
-            # This is necessary if we want to compute the l2 norm correctly (e.g. for StepClipping)
-            tmp = shared_floatx(param.get_value() * 0.)
-            for (output, indice) in zip(outputs, indices):
-                tmp = tensor.inc_subtensor(tmp[indice], self.gradients[output])
-                del self.gradients[output]
-            self.gradients[subparam] = tmp[canonized_indices]
+        for param, (subparam, _, outputs, _, positions) in subtensor_params.iteritems():
+            # Rows looked up several times are summed, this is necessary if we want to compute
+            # the l2 norm correctly (e.g. for StepClipping). The sum is done in the rows of
+            # subparam, the cost does not depend on the size of the whole parameter
+            gradient = tensor.inc_subtensor(
+                tensor.zeros_like(subparam)[tensor.concatenate(positions, axis=0)],
+                tensor.concatenate([self.gradients.pop(output) for output in outputs], axis=0))
+            self.gradients[subparam] = gradient
 
         # We remove the subtensors from the list of parameters
         self.params = full_params
@@ -114,25 +139,34 @@ class GradientDescent_SubtensorFix(GradientDescent):
         all_updates.extend([(param, param - self.steps[param]) for param in self.params if param not in self.subtensor_params])
 
         # Instead of substracting the gradient to the whole matrix, we only update the subtensor which is actually used
-        for param, (subparam, canonized_indices, _, _) in self.subtensor_params.iteritems():
+        for param, (subparam, canonized_indices, _, _, _) in self.subtensor_params.iteritems():
             new_value = tensor.inc_subtensor(param[canonized_indices], -self.steps[subparam])
             all_updates.append((param, new_value))
 
         all_updates.extend(self.step_rule_updates)
-        self._function = theano.function(self.inputs, [], updates=all_updates)
+        self._function = compile_function(self.function_cache, 'train', self.inputs, [], updates=all_updates)
+
+class _SubtensorFixRule(object):
+    """Step rule applied to the rows of the lookup tables only.
 
-class AdaDelta_SubtensorFix(AdaDelta):
+    The state of the rule is kept for the whole parameter, but only the
+    rows looked up in the batch are read and updated, in
+    `compute_step_subparam(param, indices, previous_step)`. The decay of
+    the rows not looked up is caught up on the next time they are, from
+    the number of steps since their last update given by `_lag`.
+
+    """
     def __init__(self, subtensor_params={}, *args, **kwargs):
-        super(AdaDelta_SubtensorFix, self).__init__(*args, **kwargs)
+        super(_SubtensorFixRule, self).__init__(*args, **kwargs)
         self.subtensor_params = subtensor_params
 
     def compute_steps(self, previous_steps):
-        subparams = [subparam for (subparam, _, _, _) in self.subtensor_params.values()]
+        subparams = [subparam for (subparam, _, _, _, _) in self.subtensor_params.values()]
         keys = [param for param in previous_steps if param not in subparams]
         parameter_wise = [self.compute_step(param, previous_steps[param]) for param in keys]
         
         # We use a special compute_step for lookup tables
-        for param, (subparam, canonized_indices, _, _) in self.subtensor_params.iteritems():
+        for param, (subparam, canonized_indices, _, _, _) in self.subtensor_params.iteritems():
             keys.append(subparam)
             parameter_wise.append(self.compute_step_subparam(param, canonized_indices, previous_steps[subparam]))
 
@@ -142,41 +176,152 @@ class AdaDelta_SubtensorFix(AdaDelta):
         updates = list(itertools.chain(*updates))
         return steps, updates
 
-    def compute_step_subparam(self, param, indices, previous_step):
-        mean_square_step_tm1 = shared_floatx(param.get_value() * 0.)
-        mean_square_delta_x_tm1 = shared_floatx(param.get_value() * 0.)
- 
-        # time is the number of step already computed (+1)
+    def _lag(self, param, indices):
+        """Returns the time, the lag of the rows and the updates of both.
+
+        The time is the number of steps already computed (+1), the lag of
+        a row the number of steps since it was last updated, as a column.
+
+        """
         time = theano.shared(numpy.int32(1))
 
         # last_updated contains the last time each row was updated
-        last_updated = theano.shared(numpy.zeros(param.get_value().shape[0], dtype=numpy.int32))
+        last_updated = theano.shared(numpy.zeros(_param_shape(param)[0], dtype=numpy.int32))
         last_updated_sub = last_updated[indices]
 
-        # We do the substraction as int on the cpu in order to mitigate some of the numeric instability
-        lag = theano.sandbox.cuda.basic_ops.gpu_from_host(tensor.cast(time - last_updated_sub, dtype=theano.config.floatX))
-        
+        # We do the substraction as int in order to mitigate some of the numeric instability,
+        # Theano moves the result to the device of the parameters if needed
+        lag = tensor.shape_padright(tensor.cast(time - last_updated_sub, dtype=theano.config.floatX))
+        updates = [(last_updated, tensor.set_subtensor(last_updated_sub, time)),
+                   (time, time+1)]
+        return time, lag, updates
+
+
+class AdaDelta_SubtensorFix(_SubtensorFixRule, AdaDelta):
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean_square_step_tm1 = _zeros_like_param(param)
+        mean_square_delta_x_tm1 = _zeros_like_param(param)
+        _, lag, updates = self._lag(param, indices)
+
         # We only update the relevant subtensors
         mean_square_delta_x_tm1_sub = mean_square_delta_x_tm1[indices]
         mean_square_step_tm1_sub = mean_square_step_tm1[indices]
- 
-        mean_square_step_t = tensor.set_subtensor(mean_square_step_tm1_sub,
-                tensor.shape_padright(self.decay_rate ** lag) * mean_square_step_tm1_sub +
-                (1 - self.decay_rate) * tensor.sqr(previous_step)
-            )
- 
-        rms_delta_x_tm1 = tensor.sqrt(mean_square_delta_x_tm1_sub * tensor.shape_padright(self.decay_rate ** (lag-1.)) + self.epsilon)
-        rms_step_t = tensor.sqrt(mean_square_step_t[indices] + self.epsilon)
+
+        mean_square_step_t_sub = (self.decay_rate ** lag * mean_square_step_tm1_sub +
+                                  (1 - self.decay_rate) * tensor.sqr(previous_step))
+
+        rms_delta_x_tm1 = tensor.sqrt(mean_square_delta_x_tm1_sub * self.decay_rate ** (lag - 1.) + self.epsilon)
+        rms_step_t = tensor.sqrt(mean_square_step_t_sub + self.epsilon)
         delta_x_t = rms_delta_x_tm1 / rms_step_t * previous_step
- 
-        mean_square_delta_x_t = tensor.set_subtensor(mean_square_delta_x_tm1_sub,
-                tensor.shape_padright(self.decay_rate ** lag) * mean_square_delta_x_tm1_sub +
-                (1 - self.decay_rate) * tensor.sqr(delta_x_t)
-            )
- 
+
+        mean_square_delta_x_t_sub = (self.decay_rate ** lag * mean_square_delta_x_tm1_sub +
+                                     (1 - self.decay_rate) * tensor.sqr(delta_x_t))
+
         step = delta_x_t
-        updates = [(mean_square_step_tm1, mean_square_step_t),
-                   (mean_square_delta_x_tm1, mean_square_delta_x_t),
-                   (last_updated, tensor.set_subtensor(last_updated_sub, time)),
-                   (time, time+1)]
+        updates += [(mean_square_step_tm1, tensor.set_subtensor(mean_square_step_tm1_sub, mean_square_step_t_sub)),
+                    (mean_square_delta_x_tm1, tensor.set_subtensor(mean_square_delta_x_tm1_sub, mean_square_delta_x_t_sub))]
         return step, updates
+
+
+class BasicRMSProp_SubtensorFix(_SubtensorFixRule, BasicRMSProp):
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean_square_step_tm1 = _zeros_like_param(param)
+        _, lag, updates = self._lag(param, indices)
+
+        mean_square_step_tm1_sub = mean_square_step_tm1[indices]
+        mean_square_step_t_sub = (self.decay_rate ** lag * mean_square_step_tm1_sub +
+                                  (1 - self.decay_rate) * tensor.sqr(previous_step))
+        rms_step_t = tensor.maximum(tensor.sqrt(mean_square_step_t_sub), self.epsilon)
+        step = previous_step / rms_step_t
+
+        updates.append((mean_square_step_tm1, tensor.set_subtensor(mean_square_step_tm1_sub, mean_square_step_t_sub)))
+        return step, updates
+
+
+class BasicMomentum_SubtensorFix(_SubtensorFixRule, BasicMomentum):
+    def compute_step_subparam(self, param, indices, previous_step):
+        velocity = _zeros_like_param(param)
+        _, lag, updates = self._lag(param, indices)
+
+        velocity_sub = velocity[indices]
+        decay = self.momentum ** lag
+        velocity_t_sub = decay * velocity_sub + previous_step
+        # The dense rule keeps moving the rows which are not looked up with their decaying
+        # velocity, the sum of these lag - 1 steps is added to the step of the row. It is
+        # momentum + ... + momentum ** (lag - 1), ie. lag - 1 if the momentum is 1
+        constant = tensor.eq(self.momentum, 1)
+        missed = velocity_sub * tensor.switch(
+            constant, lag - 1,
+            (self.momentum - decay) / tensor.switch(constant, 1, 1 - self.momentum))
+        step = velocity_t_sub + missed
+
+        updates.append((velocity, tensor.set_subtensor(velocity_sub, velocity_t_sub)))
+        return step, updates
+
+
+class Adam_SubtensorFix(_SubtensorFixRule, Adam):
+    """Lazy Adam: the moments of a row only decay when it is looked up.
+
+    Unlike the dense rule the rows which are not looked up are not moved
+    by their decaying mean, only their moments catch up on the decay.
+
+    """
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean = _zeros_like_param(param)
+        variance = _zeros_like_param(param)
+        time, lag, updates = self._lag(param, indices)
+
+        t1 = tensor.cast(time, dtype=theano.config.floatX)
+        learning_rate = (self.learning_rate *
+                         tensor.sqrt((1. - (1. - self.beta2)**t1)) /
+                         (1. - (1. - self.beta1)**t1))
+        beta_1t = 1 - (1 - self.beta1) * self.decay_factor ** (t1 - 1)
+
+        mean_sub = mean[indices]
+        variance_sub = variance[indices]
+        mean_t_sub = beta_1t * previous_step + (1. - beta_1t) ** lag * mean_sub
+        variance_t_sub = (self.beta2 * tensor.sqr(previous_step) +
+                          (1. - self.beta2) ** lag * variance_sub)
+        step = learning_rate * mean_t_sub / (tensor.sqrt(variance_t_sub) + self.epsilon)
+
+        updates += [(mean, tensor.set_subtensor(mean_sub, mean_t_sub)),
+                    (variance, tensor.set_subtensor(variance_sub, variance_t_sub))]
+        return step, updates
+
+
+class RMSProp_SubtensorFix(CompositeRule):
+    """RMSProp with the rows of the lookup tables updated lazily."""
+    def __init__(self, subtensor_params={}, learning_rate=1.0, decay_rate=0.9, max_scaling=1e5):
+        basic_rms_prop = BasicRMSProp_SubtensorFix(subtensor_params, decay_rate=decay_rate,
+                                                   max_scaling=max_scaling)
+        scale = Scale(learning_rate=learning_rate)
+        self.learning_rate = scale.learning_rate
+        self.decay_rate = basic_rms_prop.decay_rate
+        self.components = [basic_rms_prop, scale]
+
+
+class Momentum_SubtensorFix(CompositeRule):
+    """Momentum with the rows of the lookup tables updated lazily."""
+    def __init__(self, subtensor_params={}, learning_rate=1.0, momentum=0.):
+        scale = Scale(learning_rate=learning_rate)
+        basic_momentum = BasicMomentum_SubtensorFix(subtensor_params, momentum=momentum)
+        self.learning_rate = scale.learning_rate
+        self.momentum = basic_momentum.momentum
+        self.components = [scale, basic_momentum]
+
+
+def subtensor_step_rule(name, subtensor_params):
+    """Returns the step rule `name` with its default settings, for the lookup tables.
+
+    Scale has no state, the steps of the rows are computed as they are.
+
+    """
+    if name == 'Scale':
+        return Scale()
+    step_rules = {'AdaDelta': AdaDelta_SubtensorFix,
+                  'Adam': Adam_SubtensorFix,
+                  'Momentum': Momentum_SubtensorFix,
+                  'RMSProp': RMSProp_SubtensorFix}
+    if name not in step_rules:
+        raise ValueError("No row-sparse version of the step rule {}".format(name))
+    return step_rules[name](subtensor_params)
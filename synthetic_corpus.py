@@ -0,0 +1,183 @@
+# Generates a synthetic parallel corpus with the layout of the WMT15 fi-en
+# data, to run the stream, training and validation on a machine without it:
+#
+#   python synthetic_corpus.py --proto get_config_synthetic_fi_en
+#
+# writes the files the config points at, ie. the training text files
+# `src_data` and `trg_data`, the development set `val_set` and its reference
+# `val_set_grndtruth`, and the pickled vocabularies `src_vocab` and
+# `trg_vocab`.
+#
+# Words are drawn from a Zipfian distribution over a vocabulary larger than
+# the one of the model, so that there are unknown words. Source lengths are
+# log-normal, the target sentences are longer by a log-normal ratio like
+# English translations of Finnish, and part of their words are translations
+# of the aligned source words so that the model has something to learn.
+import argparse
+import cPickle
+import logging
+import os
+import time
+
+import numpy
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class ZipfSampler(object):
+    """Draws word ranks with probabilities proportional to 1 / rank^exponent.
+
+    Ranks are zero based, rank 0 is the most frequent word.
+
+    """
+    def __init__(self, vocab_size, exponent=1.0):
+        probabilities = 1. / numpy.arange(1, vocab_size + 1) ** exponent
+        self.cumulative = numpy.cumsum(probabilities / probabilities.sum())
+
+    def __call__(self, size, rng):
+        ranks = numpy.searchsorted(self.cumulative, rng.uniform(size=size))
+        return numpy.minimum(ranks, len(self.cumulative) - 1)
+
+
+def _lengths(size, mean, sigma, max_length, rng):
+    # Log-normal with the given mean
+    lengths = rng.lognormal(numpy.log(mean) - sigma ** 2 / 2, sigma, size)
+    return numpy.clip(numpy.round(lengths), 1, max_length).astype('int64')
+
+
+def generate_pairs(n_sentences, src_vocab_size, trg_vocab_size, rng,
+                   exponent=1.0, src_mean_length=14, src_length_sigma=0.5,
+                   length_ratio=1.35, length_ratio_sigma=0.15,
+                   max_length=80, translation_prob=0.5):
+    """Yields (source, target) sentence pairs of word ranks.
+
+    Parameters
+    ----------
+    n_sentences : int
+        Number of sentence pairs.
+    src_vocab_size, trg_vocab_size : int
+        Number of words of each language.
+    rng : :class:`numpy.random.RandomState`
+        Random numbers generator.
+    exponent : float
+        Exponent of the Zipfian distribution of the words.
+    src_mean_length, src_length_sigma : float
+        Mean and log standard deviation of the source lengths.
+    length_ratio, length_ratio_sigma : float
+        Mean and log standard deviation of the ratio of the target length
+        to the source length.
+    max_length : int
+        Sentences are at most this long.
+    translation_prob : float
+        Probability of a target word to be the translation of the aligned
+        source word rather than a random word. The translation of source
+        rank `r` is the target word of the same relative rank.
+
+    """
+    src_sampler = ZipfSampler(src_vocab_size, exponent)
+    trg_sampler = ZipfSampler(trg_vocab_size, exponent)
+    src_lengths = _lengths(n_sentences, src_mean_length, src_length_sigma,
+                           max_length, rng)
+    ratios = rng.lognormal(numpy.log(length_ratio) -
+                           length_ratio_sigma ** 2 / 2,
+                           length_ratio_sigma, n_sentences)
+    trg_lengths = numpy.clip(numpy.round(src_lengths * ratios), 1,
+                             max_length).astype('int64')
+    for src_length, trg_length in zip(src_lengths, trg_lengths):
+        source = src_sampler(src_length, rng)
+        target = trg_sampler(trg_length, rng)
+        aligned = source[numpy.arange(trg_length) * src_length // trg_length]
+        translated = rng.uniform(size=trg_length) < translation_prob
+        target[translated] = (aligned[translated] * trg_vocab_size //
+                              src_vocab_size)
+        yield source, target
+
+
+def words(prefix, vocab_size):
+    """The words of a synthetic language, by decreasing frequency."""
+    return ['{}{}'.format(prefix, rank) for rank in xrange(vocab_size)]
+
+
+def vocabulary(words, eos_idx):
+    """The {word: index} dictionary of the words, like the WMT15 ones.
+
+    Words are numbered from 2 in the given order, skipping `eos_idx`
+    which the stream maps the EOS to, <S> and </S> are 0 and <UNK> is 1.
+
+    """
+    indices = numpy.arange(2, len(words) + 3)
+    indices = indices[indices != eos_idx][:len(words)]
+    vocab = dict(zip(words, indices.tolist()))
+    vocab.update({'<S>': 0, '</S>': 0, '<UNK>': 1})
+    return vocab
+
+
+def write_corpus(paths, n_sentences, src_words, trg_words, rng, **kwargs):
+    """Writes `n_sentences` pairs of `generate_pairs` to two text files."""
+    with open(paths[0], 'w') as src_file, open(paths[1], 'w') as trg_file:
+        for source, target in generate_pairs(
+                n_sentences, len(src_words), len(trg_words), rng, **kwargs):
+            print >> src_file, ' '.join([src_words[i] for i in source])
+            print >> trg_file, ' '.join([trg_words[i] for i in target])
+
+
+def main(config, n_train, n_dev, vocab_factor, seed, **kwargs):
+    rng = numpy.random.RandomState(seed)
+    # The vocabularies of the model are the most frequent words, minus the
+    # special indices
+    src_words = words('fi', int((config['src_vocab_size'] - 3) *
+                                vocab_factor))
+    trg_words = words('en', int((config['trg_vocab_size'] - 3) *
+                                vocab_factor))
+    for path in [config['src_vocab'], config['trg_vocab'],
+                 config['src_data'], config['trg_data'], config['val_set'],
+                 config['val_set_grndtruth']]:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    start_time = time.time()
+    for side, side_words in [('src', src_words), ('trg', trg_words)]:
+        with open(config[side + '_vocab'], 'wb') as f:
+            cPickle.dump(vocabulary(side_words, config[side + '_eos_idx']), f,
+                         cPickle.HIGHEST_PROTOCOL)
+    write_corpus((config['src_data'], config['trg_data']), n_train,
+                 src_words, trg_words, rng, **kwargs)
+    write_corpus((config['val_set'], config['val_set_grndtruth']), n_dev,
+                 src_words, trg_words, rng, **kwargs)
+    logger.info("Wrote {} training and {} development sentence pairs with "
+                "{} source and {} target words in {:.1f} seconds".format(
+                    n_train, n_dev, len(src_words), len(trg_words),
+                    time.time() - start_time))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic parallel corpus")
+    parser.add_argument("--proto", default="get_config_synthetic_fi_en",
+                        help="Prototype config whose files are written")
+    parser.add_argument("--train-sentences", type=int, default=1000000)
+    parser.add_argument("--dev-sentences", type=int, default=1000)
+    parser.add_argument("--vocab-factor", type=float, default=1.25,
+                        help="Size of the vocabularies relative to the "
+                             "ones of the model")
+    parser.add_argument("--exponent", type=float, default=1.0,
+                        help="Exponent of the Zipfian word distribution")
+    parser.add_argument("--src-mean-length", type=float, default=14,
+                        help="Mean length of the source sentences")
+    parser.add_argument("--length-ratio", type=float, default=1.35,
+                        help="Mean ratio of target to source lengths")
+    parser.add_argument("--translation-prob", type=float, default=0.5,
+                        help="Fraction of target words translating the "
+                             "aligned source word")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    main(getattr(config, args.proto)(), args.train_sentences,
+         args.dev_sentences, args.vocab_factor, args.seed,
+         exponent=args.exponent, src_mean_length=args.src_mean_length,
+         length_ratio=args.length_ratio,
+         translation_prob=args.translation_prob)
@@ -0,0 +1,279 @@
+# Translates stdin to stdout with a model saved by the BleuValidator
+#
+#   python translate.py --proto get_config_wmt15_fi_en_40k \
+#       refBlocks3/best_bleu_model_<time>_BLEU<score>.npz < in.fi > out.en
+#
+# Input is read in chunks of batch_size * sort_k_batches sentences, sorted
+# by length and decoded batch_size sentences per beam search, every chunk
+# is written in the input order as soon as it is translated.
+#
+# With --engine numpy the model is run by numpy_model.py instead of Theano,
+# which starts instantly and does not need Theano or Blocks installed.
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy
+
+import config
+
+from cache import TranslationCache, param_fingerprint
+from checkpoint import load_param_values
+from shortlist import Shortlist
+from vocab import (
+    ids_to_sentence, invert_vocabulary, load_vocabulary, sentence_to_ids)
+
+logger = logging.getLogger(__name__)
+
+
+def build_search_model(config):
+    """Builds the sampling graph of the encoder and the decoder only.
+
+    Returns
+    -------
+    search_model : :class:`Model`
+        Model of the generated sequences, taking the `input` and
+        `input_mask` source batches.
+    samples : :class:`tensor.TensorVariable`
+        The generated outputs, as needed by the beam search.
+
+    """
+    from theano import tensor
+    from blocks.filter import VariableFilter
+    from blocks.graph import ComputationGraph
+    from blocks.model import Model
+    # Imported here, model parses the command line when imported
+    from model import BidirectionalEncoder, Decoder
+
+    sampling_input = tensor.lmatrix('input')
+    sampling_input_mask = tensor.matrix('input_mask')
+
+    encoder = BidirectionalEncoder(config['src_vocab_size'],
+                                   config['enc_embed'], config['enc_nhids'])
+    decoder = Decoder(config['trg_vocab_size'], config['dec_embed'],
+                      config['dec_nhids'], config['enc_nhids'] * 2)
+    sampling_representation = encoder.apply(
+        sampling_input, sampling_input_mask)
+    generated = decoder.generate(sampling_input, sampling_representation,
+                                 sampling_input_mask)
+    search_model = Model(generated)
+    samples, = VariableFilter(
+        bricks=[decoder.sequence_generator], name="outputs")(
+            ComputationGraph(generated[1]))  # generated[1] is the next_outputs
+    return search_model, samples
+
+
+class Translator(object):
+    """Translates batches of sentences with a saved model.
+
+    The beam search runs the sampling graph of :func:`build_search_model`,
+    subclasses can replace it by overriding `_build`, and keep quantized
+    parameters as they are by setting `dequantize` to ``False``. If
+    ``config['shortlist']`` is set, the output words are restricted to the
+    :class:`Shortlist` of each batch unless disabled for a call.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration the model was trained with.
+    model_path : str
+        An .npz file of parameters, eg. a model saved by the BleuValidator.
+    beam_size : int, optional
+        Defaults to ``config['beam_size']``.
+    cache : :class:`TranslationCache`, optional
+        Translations are looked up in the cache before decoding.
+
+    """
+    dequantize = True
+
+    def __init__(self, config, model_path, beam_size=None, cache=None):
+        self.config = config
+        self.beam_size = beam_size or config['beam_size']
+        self.vocab = load_vocabulary(config['src_vocab'])
+        self.unk_idx = config['unk_id']
+        self.eos_idx = config['src_eos_idx']
+        self.trg_eos_idx = config['trg_eos_idx']
+        self.trg_ivocab = invert_vocabulary(
+            load_vocabulary(config['trg_vocab']))
+        self.shortlist = None
+        if config.get('shortlist'):
+            self.shortlist = Shortlist(config['shortlist'],
+                                       config['shortlist_frequent'],
+                                       config['shortlist_translations'])
+
+        logger.info("Loading parameters from {}".format(model_path))
+        params = load_param_values(model_path, dequantize=self.dequantize)
+        self.cache = cache
+        if cache is not None:
+            self.fingerprint = '{}-beam{}'.format(param_fingerprint(params),
+                                                  self.beam_size)
+        self._build(params)
+
+    def _build(self, params):
+        """Sets `beam_search` and the keys of its `input_values`.
+
+        The step functions are loaded from the function cache of the
+        training run if ``config['function_cache']`` is set.
+
+        """
+        from beam_search import BatchedBeamSearch
+        from function_cache import FunctionCache
+
+        self.model, samples = build_search_model(self.config)
+        self.model.set_param_values(params)
+        inputs = {var.name: var for var in self.model.inputs}
+        self.source_sentence = inputs['input']
+        self.source_sentence_mask = inputs['input_mask']
+        function_cache = None
+        if self.config.get('function_cache'):
+            function_cache = FunctionCache(
+                os.path.join(self.config['saveto'],
+                             self.config['function_cache']), self.config)
+        self.beam_search = BatchedBeamSearch(beam_size=self.beam_size,
+                                             samples=samples,
+                                             function_cache=function_cache)
+
+    def translate(self, seqs, use_shortlist=None):
+        """Returns the best translation of each source index sequence.
+
+        The shortlist is used by default if there is one, `use_shortlist`
+        overrides this for the call.
+
+        """
+        if use_shortlist is None:
+            use_shortlist = self.shortlist is not None
+        if self.cache is None:
+            return self._decode(seqs, use_shortlist)
+        fingerprint = self.fingerprint
+        if use_shortlist:
+            fingerprint += '-shortlist{}x{}'.format(
+                self.shortlist.n_frequent, self.shortlist.n_translations)
+        translations = [self.cache.get(fingerprint, seq) for seq in seqs]
+        missing = [i for i, trans in enumerate(translations) if trans is None]
+        if missing:
+            for i, trans in zip(missing,
+                                self._decode([seqs[i] for i in missing],
+                                             use_shortlist)):
+                translations[i] = trans
+                self.cache.put(fingerprint, seqs[i], trans)
+        return translations
+
+    def _decode(self, seqs, use_shortlist):
+        input_, input_mask = self.beam_search.prepare_inputs(seqs,
+                                                             self.eos_idx)
+        shortlist = None
+        if use_shortlist:
+            shortlist = self.shortlist.candidates(
+                seqs, include=[self.trg_eos_idx, self.unk_idx])
+        results = self.beam_search.search(
+            input_values={self.source_sentence: input_,
+                          self.source_sentence_mask: input_mask},
+            max_lengths=[3*len(seq) for seq in seqs],
+            eol_symbol=self.trg_eos_idx, ignore_first_eol=True,
+            shortlist=shortlist)
+        translations = []
+        for trans, costs in results:
+            best = trans[numpy.argmin(costs)]
+            translations.append(best[:-1])
+        return translations
+
+    def translate_lines(self, lines, batch_size, use_shortlist=None):
+        """Translates sentences of words, in batches of similar lengths."""
+        seqs = [sentence_to_ids(line, self.vocab,
+                                self.config['src_vocab_size'],
+                                self.unk_idx, self.eos_idx)
+                for line in lines]
+        order = numpy.argsort([len(seq) for seq in seqs], kind='mergesort')
+        translations = [None] * len(seqs)
+        for start in range(0, len(seqs), batch_size):
+            batch_idx = order[start:start + batch_size]
+            batch = [seqs[i] for i in batch_idx]
+            for i, trans in zip(batch_idx,
+                                self.translate(batch, use_shortlist)):
+                translations[i] = ids_to_sentence(trans, self.trg_ivocab)
+        return translations
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main(config, model_path, beam_size, batch_size, sort_k_batches,
+         engine='theano', cache_size=0, cache_file=None,
+         source=sys.stdin, target=sys.stdout):
+    if engine == 'numpy':
+        from numpy_model import NumpyTranslator as translator_class
+    else:
+        translator_class = Translator
+    cache = TranslationCache(cache_size, cache_file) if cache_size else None
+    translator = translator_class(config, model_path, beam_size=beam_size,
+                                  cache=cache)
+
+    n_sentences = n_source_tokens = n_target_tokens = 0
+    start_time = time.time()
+    for lines in _chunks(source, batch_size * sort_k_batches):
+        for translation in translator.translate_lines(lines, batch_size):
+            print >> target, translation
+            n_target_tokens += len(translation.split())
+        target.flush()
+        n_sentences += len(lines)
+        n_source_tokens += sum(len(line.split()) for line in lines)
+        logger.info("Translated {} sentences".format(n_sentences))
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logger.info("Translated {} sentences in {:.1f} seconds: {:.2f} "
+                "sentences/s, {:.1f} source tokens/s, {:.1f} target "
+                "tokens/s".format(n_sentences, elapsed,
+                                  n_sentences / elapsed,
+                                  n_source_tokens / elapsed,
+                                  n_target_tokens / elapsed))
+    if cache is not None:
+        logger.info("Translation cache: {}".format(cache.get_stats()))
+        if cache_file:
+            cache.save()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Translate stdin with a trained model")
+    parser.add_argument("model", help="Saved parameters (.npz)")
+    parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k",
+                        help="Prototype config the model was trained with")
+    parser.add_argument("--engine", choices=['theano', 'numpy'],
+                        default='theano',
+                        help="Run the model with Theano or plain NumPy")
+    parser.add_argument("--beam-size", type=int, default=None,
+                        help="Defaults to the beam size of the config")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Sentences per beam search, defaults to "
+                             "val_batch_size of the config")
+    parser.add_argument("--sort-k-batches", type=int, default=None,
+                        help="Batches sorted by length together, defaults "
+                             "to sort_k_batches of the config")
+    parser.add_argument("--shortlist", default=None,
+                        help="Prefix of the lexical table written by "
+                             "shortlist.py, defaults to config['shortlist']")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="Number of translations cached, 0 disables "
+                             "the cache")
+    parser.add_argument("--cache-file", default=None,
+                        help="File the cache is loaded from and saved to")
+    args = parser.parse_args()
+
+    config = getattr(config, args.proto)()
+    if args.shortlist:
+        config['shortlist'] = args.shortlist
+    main(config, args.model, args.beam_size,
+         args.batch_size or config['val_batch_size'],
+         args.sort_k_batches or config['sort_k_batches'], args.engine,
+         args.cache_size, args.cache_file)
@@ -0,0 +1,80 @@
+# Validation worker of the asynchronous BleuValidator, see sampling.py
+#
+#   python validate.py <saveto>/val_config.pkl
+#
+# The BleuValidator starts it in a new interpreter rather than forking the
+# training process, whose device context does not survive a fork. The
+# worker builds the sampling graph and a synchronous BleuValidator of its
+# own, so that the snapshots are decoded and scored exactly like without
+# config['val_async']. It reads one JSON job per line on stdin,
+#
+#   {"iteration": 2000, "snapshot": "<saveto>/val_snapshot_2000.npz"}
+#
+# and writes one JSON line per job to stdout, with the BLEU score or the
+# traceback of the failure. Other output of the worker goes to stderr. It
+# exits at the end of its input.
+import argparse
+import cPickle
+import json
+import logging
+import os
+import sys
+import traceback
+
+from fuel.datasets import TextFile
+from fuel.streams import DataStream
+
+from checkpoint import load_param_values
+from sampling import BleuValidator
+from translate import build_search_model
+from vocab import invert_vocabulary, load_vocabulary
+
+logger = logging.getLogger(__name__)
+
+
+def build_validator(config):
+    """Returns a synchronous :class:`BleuValidator` of the dev set."""
+    search_model, samples = build_search_model(config)
+    inputs = {var.name: var for var in search_model.inputs}
+
+    dev_stream = DataStream(TextFile([config['val_set']],
+                                     load_vocabulary(config['src_vocab']),
+                                     None))
+    return BleuValidator(
+        inputs['input'], source_sentence_mask=inputs['input_mask'],
+        samples=samples, model=search_model, data_stream=dev_stream,
+        config=dict(config, val_async=False, reload=False),
+        trg_ivocab=invert_vocabulary(load_vocabulary(config['trg_vocab'])),
+        src_eos_idx=config['src_eos_idx'],
+        trg_eos_idx=config['trg_eos_idx'])
+
+
+def main(config, jobs, results):
+    validator = build_validator(config)
+    for line in iter(jobs.readline, ''):
+        job = json.loads(line)
+        try:
+            validator.model.set_param_values(
+                load_param_values(job['snapshot']))
+            job['bleu'] = validator._evaluate_model()
+        except Exception:
+            job['error'] = traceback.format_exc()
+        print >> results, json.dumps(job)
+        results.flush()
+        if 'error' in job:
+            break
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Validate the snapshots of a training run")
+    parser.add_argument("config", help="Pickled configuration")
+    args = parser.parse_args()
+
+    # Results have stdout for themselves, prints go to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    with open(args.config, 'rb') as f:
+        config = cPickle.load(f)
+    main(config, sys.stdin, results)
@@ -0,0 +1,247 @@
+# Compact, memory-mapped vocabularies replacing the cPickle'd dicts
+#
+# A vocabulary converted from a pickled {word: index} dict is stored as
+# numpy arrays next to `prefix`:
+#   <prefix>.strings.npy  uint8, all words concatenated, sorted by index
+#   <prefix>.offsets.npy  int64, word i is strings[o[i]:o[i+1]]
+#   <prefix>.ids.npy      int32, index of each word
+#   <prefix>.index.npy    int32, open addressing hash table (crc32, linear
+#                         probing) of word numbers, -1 for empty slots
+#   <prefix>.inverse.npy  int32, word number of each index, -1 if unused
+#
+# Both directions are served straight from the memory maps, so loading is
+# instant and processes reading the same vocabulary share the page cache.
+import argparse
+import cPickle
+import logging
+import numpy
+import zlib
+
+logger = logging.getLogger(__name__)
+
+_SUFFIXES = ('strings', 'offsets', 'ids', 'index', 'inverse')
+
+# Vocabularies loaded so far, shared by all the users of the same file
+_vocabularies = {}
+
+
+def vocabulary_paths(prefix):
+    return ['{}.{}.npy'.format(prefix, suffix) for suffix in _SUFFIXES]
+
+
+def _hash(word):
+    return zlib.crc32(word)
+
+
+def save_vocabulary(dictionary, prefix):
+    """Converts a {word: index} dictionary to the memory-mapped format."""
+    entries = sorted(
+        ((word.encode('utf-8') if isinstance(word, unicode) else word, idx)
+         for word, idx in dictionary.iteritems()),
+        key=lambda entry: (entry[1], entry[0]))
+    words = [word for word, _ in entries]
+    ids = numpy.asarray([idx for _, idx in entries], dtype='int32')
+
+    offsets = numpy.zeros(len(words) + 1, dtype='int64')
+    numpy.cumsum([len(word) for word in words], out=offsets[1:])
+    strings = numpy.fromstring(''.join(words), dtype='uint8')
+
+    size = 1
+    while size < 2 * len(words):
+        size *= 2
+    index = -numpy.ones(size, dtype='int32')
+    for i, word in enumerate(words):
+        slot = _hash(word) & (size - 1)
+        while index[slot] >= 0:
+            slot = (slot + 1) & (size - 1)
+        index[slot] = i
+
+    # Several words can share an index (eg. <S> and </S>), the first word
+    # in sorted order is used for the inverse direction
+    inverse = -numpy.ones(ids.max() + 1, dtype='int32')
+    unique_ids, first = numpy.unique(ids, return_index=True)
+    inverse[unique_ids] = first
+
+    for path, array in zip(vocabulary_paths(prefix),
+                           [strings, offsets, ids, index, inverse]):
+        numpy.save(path, array)
+
+
+class Vocabulary(object):
+    """A read-only {word: index} mapping backed by memory-mapped arrays.
+
+    Implements the parts of the dict interface used by fuel's TextFile and
+    the sampling extensions, so that it can be used wherever the pickled
+    dictionaries were.
+
+    Parameters
+    ----------
+    prefix : str
+        Prefix the vocabulary was saved to with :func:`save_vocabulary`.
+
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._load()
+
+    def _load(self):
+        # Plain ndarray views of the maps, much faster to index than memmap
+        (self._strings, self._offsets, self._ids,
+         self._index, self._inverse) = [
+            numpy.asarray(numpy.load(path, mmap_mode='r'))
+            for path in vocabulary_paths(self.prefix)]
+        self._mask = len(self._index) - 1
+
+    def _word(self, i):
+        return self._strings[self._offsets[i]:self._offsets[i + 1]].tostring()
+
+    def _find(self, word):
+        slot = _hash(word) & self._mask
+        while True:
+            i = self._index[slot]
+            if i < 0:
+                return None
+            if self._word(i) == word:
+                return i
+            slot = (slot + 1) & self._mask
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, word):
+        return self._find(word) is not None
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i is None:
+            raise KeyError(word)
+        return int(self._ids[i])
+
+    def get(self, word, default=None):
+        i = self._find(word)
+        return default if i is None else int(self._ids[i])
+
+    def iteritems(self):
+        for i in xrange(len(self)):
+            yield self._word(i), int(self._ids[i])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [word for word, _ in self.iteritems()]
+
+    def values(self):
+        return self._ids.tolist()
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._word(i)
+
+    def word(self, idx):
+        """Returns the word of an index or None if it is not used."""
+        if 0 <= idx < len(self._inverse) and self._inverse[idx] >= 0:
+            return self._word(self._inverse[idx])
+        return None
+
+    def inverse(self):
+        """Returns an {index: word} view of this vocabulary."""
+        return InverseVocabulary(self)
+
+    def __getstate__(self):
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+
+class InverseVocabulary(object):
+    """An {index: word} view of a :class:`Vocabulary`.
+
+    Entries can be overridden (eg. the EOS index mapped to ``</S>``),
+    overrides are only visible through this view.
+
+    """
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.overrides = {}
+
+    def __contains__(self, idx):
+        return idx in self.overrides or \
+            self.vocabulary.word(idx) is not None
+
+    def __getitem__(self, idx):
+        word = self.get(idx)
+        if word is None:
+            raise KeyError(idx)
+        return word
+
+    def __setitem__(self, idx, word):
+        self.overrides[idx] = word
+
+    def get(self, idx, default=None):
+        if idx in self.overrides:
+            return self.overrides[idx]
+        word = self.vocabulary.word(idx)
+        return default if word is None else word
+
+
+def load_vocabulary(path):
+    """Loads a pickled dict (.pkl) or a :class:`Vocabulary` prefix.
+
+    Every vocabulary is loaded once per process, later calls with the same
+    path return the same object.
+    """
+    if path not in _vocabularies:
+        if path.endswith('.pkl'):
+            _vocabularies[path] = cPickle.load(open(path))
+        else:
+            _vocabularies[path] = Vocabulary(path)
+    return _vocabularies[path]
+
+
+def invert_vocabulary(vocabulary):
+    """Returns an {index: word} mapping of a dict or a Vocabulary."""
+    if isinstance(vocabulary, Vocabulary):
+        return vocabulary.inverse()
+    return {v: k for k, v in vocabulary.items()}
+
+
+def sentence_to_ids(line, vocabulary, vocab_size, unk_idx, eos_idx):
+    """Maps the words of a sentence to indices and appends `eos_idx`.
+
+    Words that are not in the vocabulary, or whose index is not smaller
+    than `vocab_size`, are mapped to `unk_idx`.
+
+    """
+    words = line.split()
+    seq = numpy.zeros(len(words) + 1, dtype='int64')
+    for i, word in enumerate(words):
+        seq[i] = vocabulary.get(word, unk_idx)
+    seq[seq >= vocab_size] = unk_idx
+    seq[-1] = eos_idx
+    return seq
+
+
+def ids_to_sentence(seq, inverse_vocabulary, unk_token='<UNK>'):
+    """Maps indices back to a sentence of space separated words."""
+    return " ".join([inverse_vocabulary.get(idx, unk_token) for idx in seq])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Convert a pickled vocabulary dict")
+    parser.add_argument("vocab", help="Pickled {word: index} dict")
+    parser.add_argument("--prefix", default=None,
+                        help="Output prefix, defaults to the vocabulary "
+                             "path without .pkl")
+    args = parser.parse_args()
+
+    prefix = args.prefix
+    if not prefix:
+        prefix = args.vocab[:-4] if args.vocab.endswith('.pkl') \
+            else args.vocab
+    save_vocabulary(cPickle.load(open(args.vocab)), prefix)
+    logger.info("Saved vocabulary {} to {}".format(args.vocab, prefix))